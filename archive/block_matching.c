@@ -115,8 +115,9 @@ bool motionEstARPS(MotionEstContext *c) {
 
     // We will be storing the positions of points where the checking has been already done in an array
     // that is initialised to zero. As one point is checked, we set the corresponding element in the array to one.
-    int checkArray[2 * p + 1][2 * p + 1];
-    memset(checkArray, 0, sizeof(checkArray[0][0]) * pow(2 * p + 1, 2));
+    // Offsets -p..p are stored at index offset + p + 1
+    int checkArray[2 * p + 2][2 * p + 2];
+    memset(checkArray, 0, sizeof(checkArray));
 
     //int computations = 0;
     c->max = 0;
@@ -191,6 +192,8 @@ bool motionEstARPS(MotionEstContext *c) {
                 if( refBlkVer < 0 || refBlkVer + mbSize - 1 > h - 1 || 
                         refBlkHor < 0 || refBlkHor + mbSize - 1 > w - 1)
                     continue; //outside image boundary
+                if (abs(LDSP[k][0]) > p || abs(LDSP[k][1]) > p)
+                    continue; //outside search window
                 if (k == 2 || stepSize == 0)
                     continue; //center point already calculated
 
@@ -270,7 +273,7 @@ bool motionEstARPS(MotionEstContext *c) {
             c->max = mmax(c->max, vectors->mag2);
             vectors++;
             memset(costs, UINT32_MAX, 6 * sizeof(int));
-            memset(checkArray, 0, sizeof(checkArray[0][0]) * pow(2 * p + 1, 2));
+            memset(checkArray, 0, sizeof(checkArray));
         }
     }
 
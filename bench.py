@@ -0,0 +1,473 @@
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+import cv2 as cv
+import numpy as np
+
+# Times each stage of the host pipeline on its own and the whole pipeline end
+# to end, on the dashcam clip and on generated clips, with the emulated board
+# from esp32emu standing in for the serial device. Every stage runs in a fresh
+# process so its peak RSS is its own.
+#
+#   python bench.py run --output bench.json
+#   python bench.py compare baseline.json bench.json
+#
+# compare exits with status 1 if any stage got slower or bigger than the
+# baseline by more than the threshold.
+
+DASHCAM = os.path.join("src", "DashcamFootage.mp4")
+STAGES = {}
+
+
+def stage(name):
+    """
+    Register a stage. It is called with the clip path and frame count and
+    returns per-frame latencies in seconds, or a dict of them for stages that
+    time more than one thing in the same loop.
+    """
+    def wrap(function):
+        STAGES[name] = function
+        return function
+    return wrap
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None  # Windows
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 ** 2 if sys.platform == "darwin" else 1024)
+
+
+def generate_clip(path, frames=300, size=(640, 360), speed=(2.0, 1.0), fps=30.0, seed=0):
+    """
+    Write a clip of a smooth random texture moving speed pixels per frame.
+    """
+    width, height = size
+    rng = np.random.default_rng(seed)
+    margin = int(np.ceil(max(abs(s) for s in speed) * frames)) + 1
+    texture = rng.integers(0, 256, (height + margin, width + margin, 3), dtype=np.uint8)
+    texture = cv.GaussianBlur(texture, (9, 9), 0)
+    writer = cv.VideoWriter(path, cv.VideoWriter_fourcc(*"mp4v"), fps, size)
+    try:
+        for i in range(frames):
+            x = int(round(margin - 1 - speed[0] * i)) if speed[0] > 0 else int(round(-speed[0] * i))
+            y = int(round(margin - 1 - speed[1] * i)) if speed[1] > 0 else int(round(-speed[1] * i))
+            writer.write(texture[y:y + height, x:x + width])
+    finally:
+        writer.release()
+    return path
+
+
+def load_frames(path, count, roi_size=None, halo=0):
+    from framesource import video_frames
+    return list(video_frames(path, count, roi_size, halo))
+
+
+def _timed(function, items):
+    latencies = []
+    for item in items:
+        start = time.perf_counter()
+        function(item)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+@stage("decode")
+def bench_decode(path, count):
+    cap = cv.VideoCapture(path)
+    latencies = []
+    try:
+        for _ in range(count):
+            start = time.perf_counter()
+            ret, _ = cap.read()
+            if not ret:
+                break
+            latencies.append(time.perf_counter() - start)
+    finally:
+        cap.release()
+    return latencies
+
+
+@stage("decode_roi")
+def bench_decode_roi(path, count):
+    from framesource import capture_frames
+    from preprocess import BLUR_HALO
+    cap = cv.VideoCapture(path)
+    latencies = []
+    try:
+        frames = capture_frames(cap, count, roi_size=16, halo=BLUR_HALO)
+        while True:
+            start = time.perf_counter()
+            if next(frames, None) is None:
+                break
+            latencies.append(time.perf_counter() - start)
+    finally:
+        cap.release()
+    return latencies
+
+
+@stage("preprocess")
+def bench_preprocess(path, count):
+    # preprocess_frame on full frames, the chain with deflicker into one
+    # buffer on the ROI crops, and the whole stack of crops in one call
+    from preprocess import BLUR_HALO, FramePreprocessor, preprocess_frame
+    out = {"preprocess": _timed(preprocess_frame, load_frames(path, count))}
+    crops = np.stack(load_frames(path, count, 16, BLUR_HALO))
+    chain = FramePreprocessor(deflicker=True)
+    buffer = np.empty(256, dtype=np.uint8)
+    out["preprocess_deflicker"] = _timed(lambda frame: chain(frame, buffer), crops)
+    start = time.perf_counter()
+    FramePreprocessor(deflicker=True).stack(crops)
+    out["preprocess_batch"] = {"frames": len(crops), "seconds": time.perf_counter() - start}
+    return out
+
+
+@stage("serial")
+def bench_serial(path, count):
+    # One frame in flight at a time so writing and waiting for the reply can
+    # be told apart. The emulated board computes while the frame is written so
+    # serial_write includes it
+    from esp32emu import EmulatedSerial
+    from preprocess import BLUR_HALO, preprocess_frame, read_optical_flow_vector, send_frame_to_esp32
+    frames = [preprocess_frame(f) for f in load_frames(path, count, 16, BLUR_HALO)]
+    ser = EmulatedSerial(timeout=2)
+    write, wait = [], []
+    for i, frame in enumerate(frames):
+        start = time.perf_counter()
+        send_frame_to_esp32(frame, ser)
+        sent = time.perf_counter()
+        write.append(sent - start)
+        if i:
+            read_optical_flow_vector(ser)
+            wait.append(time.perf_counter() - sent)
+    ser.close()
+    return {"serial_write": write, "serial_wait": wait}
+
+
+@stage("farneback")
+def bench_farneback(path, count):
+    from opencvlk import FARNEBACK_PARAMS
+    frames = [cv.cvtColor(f, cv.COLOR_BGR2GRAY) for f in load_frames(path, count, 8)]
+    return _timed(lambda pair: cv.calcOpticalFlowFarneback(pair[0], pair[1], None, *FARNEBACK_PARAMS),
+                  zip(frames, frames[1:]))
+
+
+@stage("reference")
+def bench_reference(path, count):
+    # Every reference engine on its centre window, one engine instance per run
+    from opencvlk import REFERENCE_ENGINES, reference_engine
+    out = {}
+    for name in REFERENCE_ENGINES:
+        engine = reference_engine(name)
+        frames = [cv.cvtColor(f, cv.COLOR_BGR2GRAY) for f in load_frames(path, count, engine.window)]
+        out[f"ref_{name.replace('-', '_')}"] = _timed(lambda pair: engine(*pair), zip(frames, frames[1:]))
+    return out
+
+
+def _per_sample(function, data, repeats=20):
+    # Whole array calls, each repeat gives the mean time per sample
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function(data)
+        latencies.append((time.perf_counter() - start) / max(len(data), 1))
+    return latencies
+
+
+def _trace(count):
+    from flowtrace import FlowTrace
+    rng = np.random.default_rng(0)
+    u, v = rng.normal(0, 2, (2, count))
+    return FlowTrace.from_arrays(np.arange(1, count + 1), u, v)
+
+
+@stage("magnitude")
+def bench_magnitude(path, count):
+    from main import compute_magnitude_and_angle
+    return _per_sample(compute_magnitude_and_angle, _trace(count))
+
+
+@stage("filter")
+def bench_filter(path, count):
+    from main import compute_magnitude_and_angle, filter_data
+    magnitude, angle = compute_magnitude_and_angle(_trace(count))
+    return {"filter": _per_sample(filter_data, magnitude),
+            "filter_circular": _per_sample(lambda a: filter_data(a, circular=True), angle)}
+
+
+@stage("esp_pipeline")
+def bench_esp_pipeline(path, count):
+    # Decode, preprocess and the pipelined round trip together, latency is the
+    # time between consecutive replies
+    from framesource import VideoFrameSource
+    from preprocess import BLUR_HALO, open_port, preprocess_frame, stream_flow_vectors
+    ser = open_port("emu")
+    frames = VideoFrameSource(path, count, roi_size=16, halo=BLUR_HALO)
+    latencies = []
+    last = time.perf_counter()
+    try:
+        for _ in stream_flow_vectors(ser, (preprocess_frame(f) for f in frames)):
+            now = time.perf_counter()
+            latencies.append(now - last)
+            last = now
+    finally:
+        ser.close()
+    return latencies
+
+
+@stage("wire")
+def bench_wire(path, count):
+    # Both protocols against the emulator paced like the 500000 baud link,
+    # latency is the time between consecutive replies
+    from preprocess import BLUR_HALO, make_link, open_port, preprocess_frame, stream_flow_vectors
+    from tracing import LinkTrace
+    frames = [preprocess_frame(f) for f in load_frames(path, count, 16, BLUR_HALO)]
+    out = {}
+    for protocol in ("raw", "framed"):
+        ser = open_port("emu-baud", protocol=protocol)
+        trace = LinkTrace()
+        latencies = []
+        last = time.perf_counter()
+        try:
+            for _ in stream_flow_vectors(ser, frames, window=3, trace=trace, link=make_link(protocol)):
+                now = time.perf_counter()
+                latencies.append(now - last)
+                last = now
+        finally:
+            ser.close()
+        out[f"wire_{protocol}"] = {"latencies": latencies,
+                                   "bytes_per_frame": trace.counters["tx_bytes"] / max(len(frames), 1)}
+    return out
+
+
+@stage("pool")
+def bench_pool(path, count):
+    # devicepool over 1, 2 and 4 emulated boards paced like the 500000 baud
+    # link, latency is the time between consecutive replies
+    from devicepool import DevicePool
+    from preprocess import BLUR_HALO, preprocess_frame
+    frames = [preprocess_frame(f) for f in load_frames(path, count, 16, BLUR_HALO)]
+    out = {}
+    for boards in (1, 2, 4):
+        latencies = []
+        with DevicePool(["emu-baud"] * boards) as pool:
+            last = time.perf_counter()
+            for _ in pool.map(frames):
+                now = time.perf_counter()
+                latencies.append(now - last)
+                last = now
+        out[f"pool_{boards}"] = latencies
+    return out
+
+
+@stage("sparse")
+def bench_sparse(path, count):
+    # 300 points: the pyramidal LK tracker at full resolution against
+    # Farneback on a mosaic of a window around every point, one sample for
+    # the whole run
+    from opencvlk import flowFarnebackGrid, trackPyrLK
+    frames = load_frames(path, count)
+    out = {}
+    for name, run in (("sparse_pyrlk", lambda: trackPyrLK(frames, 300)),
+                      ("sparse_farneback", lambda: flowFarnebackGrid(frames, (20, 15), mode="roi"))):
+        start = time.perf_counter()
+        run()
+        out[name] = {"frames": max(len(frames) - 1, 0), "seconds": time.perf_counter() - start}
+    return out
+
+
+@stage("schedule")
+def bench_schedule(path, count):
+    # processdata over the link paced like 500000 baud, sending every frame
+    # and leaving out static ones, one sample for the whole run. The error is
+    # the endpoint error against the run that sent every frame
+    from framescheduler import FrameScheduler
+    from preprocess import processdata
+    out = {}
+    full = None
+    for name, scheduler in (("schedule_all", None), ("schedule_skip", FrameScheduler()),
+                            ("schedule_interp", FrameScheduler(fill="interpolate"))):
+        start = time.perf_counter()
+        trace = processdata(path, count, port="emu-baud", scheduler=scheduler)
+        elapsed = time.perf_counter() - start
+        full = trace if full is None else full
+        flow, reference = trace.finite().align(full.valid())
+        summary = scheduler.summary() if scheduler is not None else {"skipped": 0, "dropped": 0}
+        out[name] = {"frames": count, "seconds": elapsed, "skipped": summary["skipped"],
+                     "dropped": summary["dropped"],
+                     "epe": float(np.mean(np.hypot(flow.u - reference.u, flow.v - reference.v))) if len(flow) else None}
+    return out
+
+
+@stage("end_to_end")
+def bench_end_to_end(path, count):
+    # main.preprocess_video_data without the cache, one sample for the whole run
+    from main import preprocess_video_data
+    start = time.perf_counter()
+    _, _, _, _, length = preprocess_video_data(path, max_frames=count, port="emu")
+    elapsed = time.perf_counter() - start
+    return {"end_to_end": {"frames": count, "seconds": elapsed, "samples": int(length)}}
+
+
+def summarise(latencies):
+    if isinstance(latencies, dict) and "latencies" in latencies:  # Latencies plus other figures
+        extra = dict(latencies)
+        return dict(summarise(extra.pop("latencies")), **extra)
+    if isinstance(latencies, dict):  # Whole run only, plus other figures
+        extra = {k: v for k, v in latencies.items() if k not in ("frames", "seconds")}
+        summary = dict({"frames": latencies["frames"], "fps": latencies["frames"] / latencies["seconds"],
+                        "p50_ms": None, "p99_ms": None}, **extra)
+    else:
+        latencies = np.asarray(latencies) * 1e3
+        total = latencies.sum()
+        summary = {"frames": len(latencies), "fps": len(latencies) / (total / 1e3) if total > 0 else None,
+                   "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+                   "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None}
+    return summary
+
+
+def _run_stage(name, path, count, results):
+    try:
+        timings = STAGES[name](path, count)
+        if not isinstance(timings, dict):
+            timings = {name: timings}
+        rss = peak_rss_mb()
+        results.put({key: dict(summarise(value), peak_rss_mb=rss) for key, value in timings.items()})
+    except Exception as e:
+        results.put(e)
+
+
+def run_stage(name, path, count):
+    """
+    Run one stage in a fresh process, returns {result name: summary}.
+    """
+    ctx = mp.get_context("spawn")
+    results = ctx.Queue()
+    process = ctx.Process(target=_run_stage, args=(name, path, count, results))
+    process.start()
+    out = results.get()
+    process.join()
+    if isinstance(out, Exception):
+        raise out
+    return out
+
+
+def clips(names, frames, workdir):
+    """
+    (name, path) of each requested clip, generated clips are written to workdir.
+    Paths are absolute since framesource looks up relative names in src/.
+    """
+    for name in names:
+        if name == "dashcam":
+            yield name, os.path.abspath(DASHCAM)
+        elif name == "generated":
+            yield name, generate_clip(os.path.join(workdir, "generated.mp4"), frames)
+        elif name == "generated-static":
+            yield name, generate_clip(os.path.join(workdir, "generated-static.mp4"), frames, speed=(0.0, 0.0))
+        elif os.path.exists(name):
+            yield os.path.basename(name), os.path.abspath(name)
+        else:
+            raise ValueError(f"Unknown clip {name!r}")
+
+
+def run(clip_names=("dashcam", "generated"), stages=None, frames=300, quiet=False):
+    report = {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv.__version__,
+        "frames": frames,
+        "clips": {},
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        for clip, path in clips(clip_names, frames, workdir):
+            results = report["clips"][clip] = {}
+            for name in stages or STAGES:
+                for key, summary in run_stage(name, path, frames).items():
+                    results[key] = summary
+                    if not quiet:
+                        print(format_row(clip, key, summary))
+    return report
+
+
+def _fmt(value, spec):
+    return "-" if value is None else format(value, spec)
+
+
+def format_row(clip, name, summary):
+    return (f"{clip:<12} {name:<16} {_fmt(summary['fps'], '10.1f')} fps  p50 {_fmt(summary['p50_ms'], '8.3f')} ms"
+            f"  p99 {_fmt(summary['p99_ms'], '8.3f')} ms  rss {_fmt(summary['peak_rss_mb'], '6.1f')} MiB"
+            + (f"  {summary['bytes_per_frame']:.1f} B/frame" if "bytes_per_frame" in summary else "")
+            + (f"  {summary['skipped']} skipped  {summary['dropped']} dropped  epe {_fmt(summary['epe'], '.3f')} px"
+               if "skipped" in summary else ""))
+
+
+def compare(baseline, current, threshold=0.10):
+    """
+    (clip, stage, metric, baseline, current) for every metric that is worse than
+    the baseline by more than threshold (a fraction): lower fps, higher
+    latency or higher peak RSS. Stages missing from either side are skipped.
+    """
+    regressions = []
+    for clip, stages in current["clips"].items():
+        for name, summary in stages.items():
+            base = baseline.get("clips", {}).get(clip, {}).get(name)
+            if base is None:
+                continue
+            for metric, higher_is_better in (("fps", True), ("p50_ms", False), ("p99_ms", False),
+                                             ("peak_rss_mb", False), ("bytes_per_frame", False),
+                                             ("epe", False)):
+                old, new = base.get(metric), summary.get(metric)
+                if not old or new is None:
+                    continue
+                change = (new - old) / old
+                if (-change if higher_is_better else change) > threshold:
+                    regressions.append((clip, name, metric, old, new))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the host pipeline")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="time every stage and write JSON")
+    run_parser.add_argument("--clips", nargs="+", default=["dashcam", "generated"],
+                            help="dashcam, generated, generated-static or a video path")
+    run_parser.add_argument("--stages", nargs="+", choices=sorted(STAGES), help="default all")
+    run_parser.add_argument("--frames", type=int, default=300)
+    run_parser.add_argument("--output", default="bench.json")
+    compare_parser = commands.add_parser("compare", help="flag regressions against a baseline")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.10, help="allowed change, 0.10 = 10%%")
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        report = run(args.clips, args.stages, args.frames)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.output}")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    regressions = compare(baseline, current, args.threshold)
+    for clip, name, metric, old, new in regressions:
+        print(f"REGRESSION {clip} {name} {metric}: {old:.3f} -> {new:.3f} ({(new - old) / old:+.1%})")
+    if not regressions:
+        print("No regressions")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
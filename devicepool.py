@@ -0,0 +1,323 @@
+import argparse
+import collections
+import queue
+import threading
+import time
+import numpy as np
+from flowtrace import FlowTrace
+from preprocess import open_port, preprocess_frame, preprocess_stream, stream_flow_vectors
+from serialproto import PairLink
+
+# Spreads the ESP32 path over several boards. Every job is a self-contained
+# pair of consecutive frames sent as one FRAME_PAIR packet (serialproto.py,
+# firmware built with FRAMED_PROTOCOL 1), so any board can take any pair and
+# a pair that times out on one board is sent again on another. Each board runs
+# its own stream_flow_vectors with up to `window` pairs in flight; results
+# come back in frame order like a single board's.
+#
+#   pool = DevicePool(["COM5", "COM6", "COM7"])
+#   for frame_count, u, v in pool.map(preprocessed_frames): ...
+#
+# Ports are anything open_port takes ("emu-baud" for emulated boards) or
+# already open serial objects. A pair costs about 380 bytes on the wire
+# instead of about 115 for a delta frame of a single stream, so pooling pays
+# off from the second board on; throughput grows with every board added as
+# long as the host keeps up.
+
+ROUND_ROBIN = "round-robin"  # Every board gets its turn, a slow board holds up the others
+LEAST_LOADED = "least-loaded"  # The board with the fewest pairs in flight gets the next
+
+
+class _Device:
+    def __init__(self, index, ser, window):
+        self.index = index
+        self.ser = ser
+        self.window = window
+        self.jobs = queue.Queue()  # Pairs for the board's stream, None ends it
+        self.assigned = {}  # frame_count -> pair, handed to the board and not answered yet
+        self.alive = True
+        self.failures = 0  # Failed replies in a row
+        self.completed = 0
+        self.failed = 0
+        self.thread = None
+
+    @property
+    def port(self):
+        return getattr(self.ser, "port", str(self.index))
+
+
+class DevicePool:
+    """
+    Boards on ports, each with up to window pairs in flight and one more
+    queued. A pair whose reply fails is retried on a board it hasn't been
+    tried on, up to retries times, then reported as (frame_count, None,
+    None). A board failing max_failures replies in a row is retired and its
+    pairs are moved to the others.
+    """
+
+    def __init__(self, ports, baudrate=500000, timeout=2, window=2, schedule=LEAST_LOADED, retries=2,
+                 max_failures=3):
+        if schedule not in (ROUND_ROBIN, LEAST_LOADED):
+            raise ValueError(f"Unknown schedule {schedule!r}, expected {ROUND_ROBIN!r} or {LEAST_LOADED!r}")
+        if not ports:
+            raise ValueError("At least one port is needed")
+        self.schedule = schedule
+        self.retries = retries
+        self.max_failures = max_failures
+        self.devices = []
+        try:
+            for index, port in enumerate(ports):
+                ser = open_port(port, baudrate, timeout, protocol='framed') if isinstance(port, str) else port
+                self.devices.append(_Device(index, ser, window))
+        except Exception:
+            self.close()
+            raise
+        self.turn = 0  # Next board for round robin
+        self.retried = 0
+        self.lost = 0
+
+    def close(self):
+        for device in self.devices:
+            device.ser.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _run_device(self, device, events):
+        # Pairs are numbered by the board's stream, map them back to frames
+        frame_counts = {}
+
+        def pairs():
+            for local, job in enumerate(iter(device.jobs.get, None)):
+                frame_counts[local] = job[0]
+                yield job[1]
+
+        try:
+            for local, u, v in stream_flow_vectors(device.ser, pairs(), device.window, link=PairLink()):
+                events.put((device, frame_counts.pop(local), u, v))
+        except Exception as e:
+            print(f"Board on {device.port} failed: {e}")
+            events.put((device, None, e, None))
+
+    def _pick(self, tried):
+        """
+        Board for a pair already tried on the boards in tried, None if every
+        board that could take it is full.
+        """
+        alive = [d for d in self.devices if d.alive]
+        candidates = [d for d in alive if d.index not in tried] or alive
+        if self.schedule == ROUND_ROBIN:
+            for step in range(len(self.devices)):
+                device = self.devices[(self.turn + step) % len(self.devices)]
+                if device in candidates:
+                    if len(device.assigned) > device.window:
+                        return None
+                    self.turn = device.index + 1
+                    return device
+            return None
+        open_devices = [d for d in candidates if len(d.assigned) <= d.window]
+        if not open_devices:
+            return None
+        # Ties go round
+        device = min(open_devices, key=lambda d: (len(d.assigned), (d.index - self.turn) % len(self.devices)))
+        self.turn = device.index + 1
+        return device
+
+    def _retire(self, device, waiting):
+        device.alive = False
+        print(f"Retiring board on {device.port}.")
+        while True:
+            try:
+                device.jobs.get_nowait()
+            except queue.Empty:
+                break
+        device.jobs.put(None)
+        for frame_count, pair in device.assigned.items():
+            waiting.appendleft((frame_count, pair))
+        device.assigned.clear()
+
+    def map(self, frames, ahead=None):
+        """
+        Yields (frame_count, u, v) with the scaled flow between every pair of
+        consecutive frames (flat uint8, as sent to the board) in frame order,
+        frame_count being the position of the second frame. At most ahead
+        frames past the oldest unanswered one are read from frames.
+        """
+        if ahead is None:
+            ahead = 4 * sum(d.window + 1 for d in self.devices)
+        events = queue.Queue()
+        for device in self.devices:
+            device.thread = threading.Thread(target=self._run_device, args=(device, events), daemon=True)
+            device.thread.start()
+
+        frames = enumerate(frames)
+        prev = None
+        exhausted = False
+        waiting = collections.deque()  # Pairs to send again, oldest first
+        tried = {}  # frame_count -> indices of the boards a pair went to
+        finished = {}  # frame_count -> (u, v), waiting for earlier frames
+        next_frame = 1
+        in_flight = 0
+        try:
+            while True:
+                # Hand out retries first, then new pairs, while boards have room
+                while any(d.alive for d in self.devices):
+                    if waiting:
+                        job = waiting[0]
+                    elif not exhausted and (prev is None or prev[0] + 1 - next_frame < ahead):
+                        try:
+                            frame_count, frame = next(frames)
+                        except StopIteration:
+                            exhausted = True
+                            break
+                        frame = np.array(frame, dtype=np.uint8).reshape(-1)  # Kept until the pair is answered
+                        last, prev = prev, (frame_count, frame)
+                        if last is None:
+                            continue
+                        job = (frame_count, (last[1], frame))
+                        waiting.append(job)
+                    else:
+                        break
+                    device = self._pick(tried.setdefault(job[0], set()))
+                    if device is None:
+                        break
+                    waiting.popleft()
+                    tried[job[0]].add(device.index)
+                    device.assigned[job[0]] = job[1]
+                    device.jobs.put(job)
+                    in_flight += 1
+
+                if not any(d.alive for d in self.devices):
+                    # Nothing left to send the remaining pairs to
+                    for frame_count, _ in waiting:
+                        finished[frame_count] = (None, None)
+                        self.lost += 1
+                    waiting.clear()
+                    if not exhausted:
+                        for frame_count, _ in frames:
+                            if frame_count > 0:
+                                finished[frame_count] = (None, None)
+                                self.lost += 1
+                        exhausted = True
+
+                while next_frame in finished:
+                    u, v = finished.pop(next_frame)
+                    tried.pop(next_frame, None)
+                    yield next_frame, u, v
+                    next_frame += 1
+
+                if in_flight == 0 and not waiting and exhausted:
+                    break
+
+                device, frame_count, u, v = events.get()
+                if frame_count is None:
+                    # The board's stream ended with an error
+                    in_flight -= len(device.assigned)
+                    if device.alive:
+                        self._retire(device, waiting)
+                    continue
+                pair = device.assigned.pop(frame_count, None)
+                if pair is None:
+                    continue  # Already moved to another board
+                in_flight -= 1
+                if u is not None:
+                    device.failures = 0
+                    device.completed += 1
+                    finished[frame_count] = (u, v)
+                    continue
+                device.failures += 1
+                device.failed += 1
+                if len(tried[frame_count]) <= self.retries:
+                    self.retried += 1
+                    waiting.appendleft((frame_count, pair))
+                else:
+                    finished[frame_count] = (None, None)
+                    self.lost += 1
+                if device.alive and device.failures >= self.max_failures:
+                    in_flight -= len(device.assigned)
+                    self._retire(device, waiting)
+        finally:
+            for device in self.devices:
+                if device.alive:
+                    while True:
+                        try:
+                            device.jobs.get_nowait()
+                        except queue.Empty:
+                            break
+                    device.jobs.put(None)
+            for device in self.devices:
+                device.thread.join()
+
+    def summary(self):
+        out = {"retried": self.retried, "lost": self.lost}
+        for device in self.devices:
+            out[f"{device.index}:{device.port}"] = {"completed": device.completed, "failed": device.failed,
+                                                   "alive": device.alive}
+        return out
+
+
+# process_frames for a list of ports, same FlowTrace of flow vectors in pixels
+def process_frames_pool(frames, ports, baudrate=500000, window=2, preprocess=True, schedule=LEAST_LOADED,
+                        timeout=2, deflicker=False):
+    processed_frames = preprocess_stream(frames, deflicker) if preprocess else frames
+    flow_vectors = FlowTrace()
+    with DevicePool(ports, baudrate, timeout, window, schedule) as pool:
+        for frame_count, u, v in pool.map(processed_frames):
+            if u is not None and v is not None:
+                flow_vectors.append(frame_count, u / 100.0, v / 100.0, time.perf_counter())
+            else:
+                print("Failed to receive optical flow data.")
+                flow_vectors.failed(frame_count, time.perf_counter())
+    return flow_vectors
+
+
+def main():
+    # Runs the pool against emulated boards paced like the 500000 baud link,
+    # checks the vectors against a single board streaming the same frames, and
+    # with one board that stops answering part way through
+    from esp32emu import EmulatedSerial, FramedESP32Device
+    from framesource import video_frames
+    from preprocess import BLUR_HALO, process_frames
+
+    parser = argparse.ArgumentParser(description="Run the device pool against emulated boards")
+    parser.add_argument("video", nargs="?", default="DashcamFootage.mp4", help="video in src/")
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--boards", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--window", type=int, default=2)
+    parser.add_argument("--schedule", choices=(ROUND_ROBIN, LEAST_LOADED), default=LEAST_LOADED)
+    args = parser.parse_args()
+
+    frames = [preprocess_frame(f) for f in video_frames(args.video, args.frames, 16, BLUR_HALO)]
+    start = time.perf_counter()
+    expected = process_frames(frames, "emu-baud", window=args.window, preprocess=False, protocol="framed")
+    print(f"single stream: {len(expected) / (time.perf_counter() - start):.0f} fps")
+
+    for boards in args.boards:
+        start = time.perf_counter()
+        vectors = process_frames_pool(frames, ["emu-baud"] * boards, window=args.window, preprocess=False,
+                                      schedule=args.schedule)
+        elapsed = time.perf_counter() - start
+        print(f"{boards} board(s): {len(vectors) / elapsed:.0f} fps, "
+              f"{'same as' if vectors.equals(expected) else 'DIFFERENT from'} the single stream")
+
+    class Dying(FramedESP32Device):
+        # Stops answering after some packets, like a board that was unplugged
+        def feed(self, data):
+            out = super().feed(data)
+            return out if self.frames_received < args.frames // 4 else b""
+
+    ports = [EmulatedSerial(Dying(), throttled=True, timeout=0.2)] + ["emu-baud"] * 2
+    with DevicePool(ports, timeout=0.2, window=args.window, schedule=args.schedule) as pool:
+        vectors = FlowTrace()
+        for frame_count, u, v in pool.map(frames):
+            if u is not None:
+                vectors.append(frame_count, u / 100.0, v / 100.0)
+        print(f"one board dying: {pool.summary()}, "
+              f"{'same as' if vectors.equals(expected) else 'DIFFERENT from'} the single stream")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import numpy as np
+
+# Flow engines by name. Every engine is made for a frame size and called as
+# engine(prev, cur) with two grayscale uint8 frames, returning a (rows, cols, 2)
+# array of (u, v). Dense engines give one vector per pixel, block matching one
+# per block. Engines are imported when created so the native ones are only
+# compiled when asked for.
+
+_ENGINES = {}
+
+
+def register(name):
+    """
+    Decorator adding a factory(width, height, **options) under name.
+    """
+    def wrap(factory):
+        _ENGINES[name] = factory
+        return factory
+    return wrap
+
+
+def available_engines():
+    return sorted(_ENGINES)
+
+
+def create_engine(name, width, height, **options):
+    if name not in _ENGINES:
+        raise ValueError(f"Unknown engine {name!r}, expected one of {available_engines()}")
+    return _ENGINES[name](width, height, **options)
+
+
+def _lucas_kanade(method, negate=False):
+    from lucaskanade import dense_lucas_kanade
+
+    def engine(prev, cur):
+        flow = dense_lucas_kanade(np.stack([prev, cur]), method)[0]
+        if negate:
+            np.negative(flow, out=flow)
+        return flow
+    return engine
+
+
+@register("lk-firmware")
+def _lk_firmware(width, height):
+    return _lucas_kanade("firmware")
+
+
+@register("lk-validation3")
+def _lk_validation3(width, height):
+    # validation3's kernels give the flow against the motion, negated to point along it
+    return _lucas_kanade("validation3", negate=True)
+
+
+@register("farneback")
+def _farneback(width, height, params=None):
+    import cv2 as cv
+    from opencvlk import FARNEBACK_PARAMS
+    params = params or FARNEBACK_PARAMS
+
+    def engine(prev, cur):
+        return cv.calcOpticalFlowFarneback(prev, cur, None, *params)
+    return engine
+
+
+@register("native-lk")
+def _native_lk(width, height):
+    import nativeflow
+    return nativeflow.NativeMotionEngine(nativeflow.LK_OPTICAL_FLOW, width, height)
+
+
+@register("native-arps")
+def _native_arps(width, height, block_size=8, search_param=7):
+    import nativeflow
+    return nativeflow.NativeMotionEngine(nativeflow.BLOCK_MATCHING_ARPS, width, height, block_size, search_param)
+
+
+@register("native-epzs")
+def _native_epzs(width, height, block_size=8, search_param=7):
+    import nativeflow
+    return nativeflow.NativeMotionEngine(nativeflow.BLOCK_MATCHING_EPZS, width, height, block_size, search_param)
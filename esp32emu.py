@@ -0,0 +1,329 @@
+import os
+import threading
+import time
+import numpy as np
+import serialproto
+
+# Host side emulation of esp32test/espSerial/espSerial.ino so the ESP path can
+# run without the board attached
+
+ARRAY_SIZE = 256  # 16x16 = 256 bytes
+SCALE_FACTOR = 100
+BITS_PER_BYTE = 10  # 8N1 framing, start + 8 data + stop bits
+
+
+def compute_optical_flow(frame1, frame2, x, y):
+    """
+    Port of computeOpticalFlow(x, y) from the firmware, returning the scaled
+    (u, v) as they would be sent. Arithmetic is done in float32 like the ESP32.
+    """
+    G = np.zeros((2, 2), dtype=np.float32)
+    b = np.zeros(2, dtype=np.float32)
+
+    for i in range(-1, 2):
+        for j in range(-1, 2):
+            xCoord = x + i
+            yCoord = y + j
+
+            if 0 <= xCoord < 16 and 0 <= yCoord < 16:
+                I_x = np.float32(int(frame1[yCoord, xCoord + 1]) - int(frame1[yCoord, xCoord - 1]))
+                I_y = np.float32(int(frame1[yCoord + 1, xCoord]) - int(frame1[yCoord - 1, xCoord]))
+                I_t = np.float32(int(frame2[yCoord, xCoord]) - int(frame1[yCoord, xCoord]))
+
+                G[0, 0] += I_x * I_x
+                G[0, 1] += I_x * I_y
+                G[1, 0] += I_x * I_y
+                G[1, 1] += I_y * I_y
+
+                b[0] += I_x * I_t
+                b[1] += I_y * I_t
+
+    det = G[0, 0] * G[1, 1] - G[0, 1] * G[1, 0]
+
+    if det == 0:
+        u = np.float32(0)
+        v = np.float32(0)
+    else:
+        # Solve for (u, v) using Cramer's rule
+        u = -(b[0] * G[1, 1] - b[1] * G[0, 1]) / det
+        v = -(b[1] * G[0, 0] - b[0] * G[1, 0]) / det
+
+    # (int) casts truncate towards zero
+    scaled_u = int(u * np.float32(SCALE_FACTOR))
+    scaled_v = int(v * np.float32(SCALE_FACTOR))
+    return scaled_u, scaled_v
+
+
+def pack_flow_vector(scaled_u, scaled_v):
+    """
+    Pack (u, v) the way the firmware writes them, high byte first keeping only
+    the low 16 bits of each value.
+    """
+    return bytes([(scaled_u >> 8) & 0xFF, scaled_u & 0xFF,
+                  (scaled_v >> 8) & 0xFF, scaled_v & 0xFF])
+
+
+class ESP32Device:
+    """
+    State machine of the firmware loop(). Bytes go in through feed() and the
+    bytes the board would send back come out.
+    """
+
+    def __init__(self, x=8, y=8):
+        self.x = x
+        self.y = y
+        self.receivedData1 = np.zeros((16, 16), dtype=np.uint8)  # First frame
+        self.receivedData2 = np.zeros((16, 16), dtype=np.uint8)  # Second frame
+        self.dataCount = 0
+        self.isFirstFrame = True
+        self.frames_received = 0
+
+    def feed(self, data):
+        out = bytearray()
+        data = np.frombuffer(bytes(data), dtype=np.uint8)
+        pos = 0
+        while pos < len(data):
+            # Copy as much of the current frame as is available at once
+            take = min(ARRAY_SIZE - self.dataCount, len(data) - pos)
+            target = self.receivedData1 if self.isFirstFrame else self.receivedData2
+            target.reshape(-1)[self.dataCount:self.dataCount + take] = data[pos:pos + take]
+            self.dataCount += take
+            pos += take
+
+            # Once a full frame is received, process it
+            if self.dataCount >= ARRAY_SIZE:
+                self.frames_received += 1
+                if not self.isFirstFrame:
+                    out += self.on_frame()
+                    self.receivedData1[...] = self.receivedData2
+                self.isFirstFrame = False
+                self.dataCount = 0
+        return bytes(out)
+
+    def on_frame(self):
+        return pack_flow_vector(*compute_optical_flow(self.receivedData1, self.receivedData2, self.x, self.y))
+
+    def needed(self):
+        # Bytes until the next reply can be sent
+        return ARRAY_SIZE - self.dataCount
+
+
+class FramedESP32Device:
+    """
+    The firmware built with FRAMED_PROTOCOL 1: frames arrive in serialproto
+    packets, raw or as deltas, and every packet is answered with a reply
+    carrying its sequence number. A CONFIG packet switches the reply from the
+    single vector at (x, y) to every interior point or a list of points,
+    computed for all points at once with lucaskanade, which gives the same
+    numbers as the firmware's per-point loop.
+    """
+
+    def __init__(self, x=8, y=8):
+        self.x = x
+        self.y = y
+        self.parser = serialproto.PacketParser()
+        self.decoder = serialproto.FrameDecoder()
+        self.mode = serialproto.MODE_POINT
+        self.points = ()
+        self.frames_received = 0
+        self.bytes_received = 0
+
+    def feed(self, data):
+        self.bytes_received += len(data)
+        out = bytearray()
+        for packet_type, seq, payload, crc_ok in self.parser.feed(bytes(data)):
+            if crc_ok and packet_type == serialproto.CONFIG:
+                out += self.configure(seq, payload)
+                continue
+            status, frames = self.decoder.handle(packet_type, payload, crc_ok)
+            if frames is not None or status == serialproto.STATUS_NO_FLOW:
+                self.frames_received += 1
+            if frames is None:
+                out += serialproto.pack_reply(seq, status)
+            else:
+                out += serialproto.pack_reply(seq, status, *self.on_frame(*frames))
+        return bytes(out)
+
+    def configure(self, seq, payload):
+        config = serialproto.parse_config(payload)
+        if config is None:
+            return serialproto.pack_reply(seq, serialproto.STATUS_BAD_PACKET)
+        self.mode, self.points = config
+        return serialproto.pack_reply(seq, serialproto.STATUS_NO_FLOW)
+
+    def on_frame(self, prev, cur):
+        """
+        (payload, reply type) for a pair of frames in the current mode.
+        """
+        prev = prev.reshape(16, 16)
+        cur = cur.reshape(16, 16)
+        if self.mode == serialproto.MODE_POINT:
+            return pack_flow_vector(*compute_optical_flow(prev, cur, self.x, self.y)), serialproto.REPLY_FLOW
+        from lucaskanade import dense_lucas_kanade
+        flow = dense_lucas_kanade(np.stack([prev, cur]))[0]
+        # (int) casts truncate towards zero
+        scaled = np.trunc(flow * np.float32(SCALE_FACTOR))
+        first, last = serialproto.FIELD_FIRST, serialproto.FIELD_LAST
+        if self.mode == serialproto.MODE_FIELD:
+            size = last - first + 1
+            header = bytes([first, first, size, size])
+            values = scaled[first:last + 1, first:last + 1]
+            return header + serialproto.pack_flow_values(values), serialproto.REPLY_FIELD
+        xs, ys = np.array(self.points).T
+        return bytes([len(self.points)]) + serialproto.pack_flow_values(scaled[ys, xs]), serialproto.REPLY_POINTS
+
+    def needed(self):
+        return self.parser.needed()
+
+
+class EmulatedSerial:
+    """
+    Drop-in replacement for serial.Serial talking to an ESP32Device.
+
+    With throttled=False replies are available as soon as they are computed.
+    With throttled=True every byte costs BITS_PER_BYTE / baudrate seconds on
+    each direction of the wire and compute_time is added per reply, so reads
+    block the same way they would against the board.
+    """
+
+    def __init__(self, device=None, baudrate=500000, timeout=2, throttled=False, compute_time=0.0):
+        self.device = device if device is not None else ESP32Device()
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.throttled = throttled
+        self.compute_time = compute_time
+        self.is_open = True
+        self.port = "emu"
+        self._rx = bytearray()  # Bytes sent by the device, oldest first
+        self._rx_ready = []  # Time each byte in _rx is available to the host
+        self._tx_free = 0.0  # Time the host to device line is idle again
+        self._reply_free = 0.0  # Time the device to host line is idle again
+        self._cond = threading.Condition()
+        self.bytes_written = 0
+        self.bytes_read = 0
+
+    @property
+    def byte_time(self):
+        return BITS_PER_BYTE / self.baudrate
+
+    def write(self, data):
+        data = bytes(data)
+        with self._cond:
+            if not self.throttled:
+                reply = self.device.feed(data)
+                self._rx += reply
+                self._rx_ready += [0.0] * len(reply)
+            else:
+                # Feed one frame boundary at a time so every reply is stamped
+                # with the time its last input byte lands on the device
+                start = max(time.monotonic(), self._tx_free)
+                pos = 0
+                while pos < len(data):
+                    take = min(len(data) - pos, self.device.needed())
+                    reply = self.device.feed(data[pos:pos + take])
+                    pos += take
+                    if reply:
+                        arrival = start + pos * self.byte_time
+                        begin = max(arrival + self.compute_time, self._reply_free)
+                        ready = begin + self.byte_time * np.arange(1, len(reply) + 1)
+                        self._reply_free = float(ready[-1])
+                        self._rx += reply
+                        self._rx_ready += ready.tolist()
+                self._tx_free = start + len(data) * self.byte_time
+            self.bytes_written += len(data)
+            self._cond.notify_all()
+        return len(data)
+
+    def _available(self, now):
+        if not self.throttled:
+            return len(self._rx)
+        count = 0
+        for ready in self._rx_ready:
+            if ready > now:
+                break
+            count += 1
+        return count
+
+    def read(self, size=1):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                available = self._available(now)
+                if available >= size:
+                    break
+                if deadline is not None and now >= deadline:
+                    break
+                # Sleep until the next byte is due, the deadline, or a write
+                wake = deadline
+                if available < len(self._rx_ready):
+                    due = self._rx_ready[available]
+                    wake = due if wake is None else min(wake, due)
+                self._cond.wait(None if wake is None else max(wake - now, 0))
+            count = min(size, available)
+            data = bytes(self._rx[:count])
+            del self._rx[:count]
+            del self._rx_ready[:count]
+            self.bytes_read += count
+            return data
+
+    @property
+    def in_waiting(self):
+        with self._cond:
+            return self._available(time.monotonic())
+
+    def reset_input_buffer(self):
+        with self._cond:
+            count = self._available(time.monotonic())
+            del self._rx[:count]
+            del self._rx_ready[:count]
+
+    def flush(self):
+        if self.throttled:
+            delay = self._tx_free - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    def close(self):
+        self.is_open = False
+
+
+def serve_pty(device=None, baudrate=500000, throttled=False, compute_time=0.0):
+    """
+    Run an emulated board behind a Linux pseudo terminal. Returns the path of
+    the pty to open with serial.Serial and a function that stops the emulator.
+    """
+    import tty
+
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    path = os.ttyname(slave)
+    emulator = EmulatedSerial(device, baudrate, timeout=0.1, throttled=throttled, compute_time=compute_time)
+    stop = threading.Event()
+
+    def pump_in():
+        while not stop.is_set():
+            try:
+                data = os.read(master, 4096)
+            except OSError:
+                break
+            if not data:
+                break
+            emulator.write(data)
+
+    def pump_out():
+        while not stop.is_set():
+            data = emulator.read(1)
+            if data:
+                os.write(master, data + emulator.read(emulator.in_waiting))
+
+    threads = [threading.Thread(target=pump_in, daemon=True), threading.Thread(target=pump_out, daemon=True)]
+    for thread in threads:
+        thread.start()
+
+    def close():
+        stop.set()
+        os.close(master)
+        os.close(slave)
+
+    return path, close
@@ -1,6 +1,12 @@
 #include <Arduino.h>
 
 #define ARRAY_SIZE 256  // 16x16 = 256 bytes
+
+// 0: raw 256 byte frames and 4 byte replies (host protocol='raw')
+// 1: framed packets with sequence numbers, CRC and delta frames, see
+//    serialproto.py (host protocol='framed')
+#define FRAMED_PROTOCOL 0
+
 uint8_t receivedData1[16][16];  // First frame
 uint8_t receivedData2[16][16];  // Second frame
 int dataCount = 0;  // Track the position in the array
@@ -10,7 +16,7 @@ const int SCALE_FACTOR = 100;
 
 
 
-void computeOpticalFlow(int x, int y) {
+void computeFlowVector(int x, int y, int *scaled_u, int *scaled_v) {
   // Gradients (float for precision)
   float I_x = 0.0f, I_y = 0.0f, I_t = 0.0f;
 
@@ -64,8 +70,13 @@ void computeOpticalFlow(int x, int y) {
   }
 
   // Scale the flow vectors by the SCALE_FACTOR and convert to integers
-  int scaled_u = (int)(u * SCALE_FACTOR);
-  int scaled_v = (int)(v * SCALE_FACTOR);
+  *scaled_u = (int)(u * SCALE_FACTOR);
+  *scaled_v = (int)(v * SCALE_FACTOR);
+}
+
+void computeOpticalFlow(int x, int y) {
+  int scaled_u, scaled_v;
+  computeFlowVector(x, y, &scaled_u, &scaled_v);
 
   // Send the scaled optical flow vector back
   Serial.write((uint8_t)(scaled_u >> 8));  // High byte of u
@@ -82,6 +93,281 @@ void setup() {
 }
 
 
+#if FRAMED_PROTOCOL
+
+#define SYNC0 0xA5
+#define SYNC1 0x5A
+#define PROTOCOL_VERSION 1
+#define HEADER_SIZE 7  // sync, version, type, seq, length
+#define MAX_PAYLOAD 512
+
+#define FRAME_RAW 0x01
+#define FRAME_DELTA 0x02
+#define FRAME_RESET 0x03
+#define CONFIG 0x04
+#define FRAME_PAIR 0x05  // Previous frame raw, then the current frame raw or as a delta
+#define REPLY_FLOW 0x81
+#define REPLY_FIELD 0x82
+#define REPLY_POINTS 0x83
+
+// Reply modes, set by a CONFIG packet
+#define MODE_POINT 0   // (u, v) at (8, 8)
+#define MODE_FIELD 1   // every point of FIELD_FIRST..FIELD_LAST in both directions
+#define MODE_POINTS 2  // a list of points
+#define FIELD_FIRST 2  // Closest points to the edge with a full 3x3 window of central differences
+#define FIELD_LAST 13
+#define MAX_POINTS ((FIELD_LAST - FIELD_FIRST + 1) * (FIELD_LAST - FIELD_FIRST + 1))
+
+#define STATUS_OK 0
+#define STATUS_NO_FLOW 1
+#define STATUS_BAD_CRC 2
+#define STATUS_NO_REFERENCE 3
+#define STATUS_BAD_PACKET 4
+
+uint8_t packet[HEADER_SIZE + MAX_PAYLOAD + 2];
+int packetLength = 0;  // Bytes of the current packet received so far
+bool hasReference = false;  // receivedData1 holds the previous frame
+uint8_t replyMode = MODE_POINT;
+uint8_t pointCount = 0;
+uint8_t pointX[MAX_POINTS];
+uint8_t pointY[MAX_POINTS];
+
+// CRC-16/CCITT-FALSE, continued from crc
+uint16_t crc16Update(uint16_t crc, const uint8_t *data, int length) {
+  for (int i = 0; i < length; i++) {
+    crc ^= (uint16_t)data[i] << 8;
+    for (int bit = 0; bit < 8; bit++) {
+      crc = (crc & 0x8000) ? (uint16_t)((crc << 1) ^ 0x1021) : (uint16_t)(crc << 1);
+    }
+  }
+  return crc;
+}
+
+uint16_t crc16(const uint8_t *data, int length) {
+  return crc16Update(0xFFFF, data, length);
+}
+
+void sendReply(uint8_t seq, uint8_t status, bool hasFlow, int scaled_u, int scaled_v) {
+  uint8_t reply[8 + 4 + 2];
+  int length = hasFlow ? 4 : 0;
+  reply[0] = SYNC0;
+  reply[1] = SYNC1;
+  reply[2] = PROTOCOL_VERSION;
+  reply[3] = REPLY_FLOW;
+  reply[4] = seq;
+  reply[5] = status;
+  reply[6] = 0;
+  reply[7] = length;
+  if (hasFlow) {
+    reply[8] = (uint8_t)(scaled_u >> 8);
+    reply[9] = (uint8_t)(scaled_u & 0xFF);
+    reply[10] = (uint8_t)(scaled_v >> 8);
+    reply[11] = (uint8_t)(scaled_v & 0xFF);
+  }
+  uint16_t crc = crc16(reply + 2, 6 + length);
+  reply[8 + length] = (uint8_t)(crc >> 8);
+  reply[9 + length] = (uint8_t)(crc & 0xFF);
+  Serial.write(reply, 10 + length);
+}
+
+// Apply a delta payload to receivedData1, writing receivedData2. Residuals are
+// zigzagged and coded as nibbles: 1-14 literal, 0 n = n + 1 zeros, 15 h l = (h << 4) | l
+bool decodeDelta(const uint8_t *payload, int length) {
+  uint8_t *prev = &receivedData1[0][0];
+  uint8_t *cur = &receivedData2[0][0];
+  int nibbles = length * 2;
+  int n = 0;  // Next nibble
+  int pixel = 0;
+  while (pixel < ARRAY_SIZE && n < nibbles) {
+    uint8_t value = (n & 1) ? (payload[n >> 1] & 0x0F) : (payload[n >> 1] >> 4);
+    int run = 1;
+    uint8_t code;
+    if (value == 0) {
+      if (n + 1 >= nibbles) return false;
+      n++;
+      run = ((n & 1) ? (payload[n >> 1] & 0x0F) : (payload[n >> 1] >> 4)) + 1;
+      code = 0;
+    } else if (value == 15) {
+      if (n + 2 >= nibbles) return false;
+      uint8_t high = ((n + 1) & 1) ? (payload[(n + 1) >> 1] & 0x0F) : (payload[(n + 1) >> 1] >> 4);
+      uint8_t low = ((n + 2) & 1) ? (payload[(n + 2) >> 1] & 0x0F) : (payload[(n + 2) >> 1] >> 4);
+      code = (high << 4) | low;
+      n += 2;
+    } else {
+      code = value;
+    }
+    n++;
+    if (pixel + run > ARRAY_SIZE) return false;
+    uint8_t residual = (code >> 1) ^ (uint8_t)(0 - (code & 1));
+    for (int i = 0; i < run; i++, pixel++) {
+      cur[pixel] = (uint8_t)(prev[pixel] + residual);
+    }
+  }
+  return pixel == ARRAY_SIZE && nibbles - n <= 1;
+}
+
+// Reply with (u, v) for every point of the current mode, written as it is
+// computed with the CRC kept running, so the payload is never buffered
+void sendPointsReply(uint8_t seq) {
+  uint8_t head[8 + 4];
+  int count = replyMode == MODE_FIELD ? MAX_POINTS : pointCount;
+  int headerLength = replyMode == MODE_FIELD ? 4 : 1;
+  int length = headerLength + 4 * count;
+  head[0] = SYNC0;
+  head[1] = SYNC1;
+  head[2] = PROTOCOL_VERSION;
+  head[3] = replyMode == MODE_FIELD ? REPLY_FIELD : REPLY_POINTS;
+  head[4] = seq;
+  head[5] = STATUS_OK;
+  head[6] = (uint8_t)(length >> 8);
+  head[7] = (uint8_t)(length & 0xFF);
+  if (replyMode == MODE_FIELD) {
+    head[8] = FIELD_FIRST;  // x0
+    head[9] = FIELD_FIRST;  // y0
+    head[10] = FIELD_LAST - FIELD_FIRST + 1;  // cols
+    head[11] = FIELD_LAST - FIELD_FIRST + 1;  // rows
+  } else {
+    head[8] = pointCount;
+  }
+  uint16_t crc = crc16Update(0xFFFF, head + 2, 6 + headerLength);
+  Serial.write(head, 8 + headerLength);
+
+  for (int i = 0; i < count; i++) {
+    int x, y;
+    if (replyMode == MODE_FIELD) {
+      // Row by row
+      x = FIELD_FIRST + i % (FIELD_LAST - FIELD_FIRST + 1);
+      y = FIELD_FIRST + i / (FIELD_LAST - FIELD_FIRST + 1);
+    } else {
+      x = pointX[i];
+      y = pointY[i];
+    }
+    int scaled_u, scaled_v;
+    computeFlowVector(x, y, &scaled_u, &scaled_v);
+    uint8_t value[4] = {(uint8_t)(scaled_u >> 8), (uint8_t)(scaled_u & 0xFF),
+                        (uint8_t)(scaled_v >> 8), (uint8_t)(scaled_v & 0xFF)};
+    crc = crc16Update(crc, value, 4);
+    Serial.write(value, 4);
+  }
+  uint8_t tail[2] = {(uint8_t)(crc >> 8), (uint8_t)(crc & 0xFF)};
+  Serial.write(tail, 2);
+}
+
+bool configure(const uint8_t *payload, int length) {
+  if (length < 1) return false;
+  if (payload[0] == MODE_POINT || payload[0] == MODE_FIELD) {
+    if (length != 1) return false;
+    replyMode = payload[0];
+    return true;
+  }
+  if (payload[0] != MODE_POINTS || length < 2 || payload[1] == 0 || payload[1] > MAX_POINTS
+      || length != 2 + 2 * payload[1]) return false;
+  for (int i = 0; i < payload[1]; i++) {
+    uint8_t x = payload[2 + 2 * i];
+    uint8_t y = payload[3 + 2 * i];
+    if (x < FIELD_FIRST || x > FIELD_LAST || y < FIELD_FIRST || y > FIELD_LAST) return false;
+  }
+  pointCount = payload[1];
+  for (int i = 0; i < pointCount; i++) {
+    pointX[i] = payload[2 + 2 * i];
+    pointY[i] = payload[3 + 2 * i];
+  }
+  replyMode = MODE_POINTS;
+  return true;
+}
+
+void handlePacket(int payloadLength) {
+  uint8_t type = packet[3];
+  uint8_t seq = packet[4];
+  const uint8_t *payload = packet + HEADER_SIZE;
+  uint16_t crc = ((uint16_t)packet[HEADER_SIZE + payloadLength] << 8) | packet[HEADER_SIZE + payloadLength + 1];
+  if (crc16(packet + 2, HEADER_SIZE - 2 + payloadLength) != crc) {
+    sendReply(seq, STATUS_BAD_CRC, false, 0, 0);
+    return;
+  }
+
+  if (type == CONFIG) {
+    sendReply(seq, configure(payload, payloadLength) ? STATUS_NO_FLOW : STATUS_BAD_PACKET, false, 0, 0);
+    return;
+  }
+
+  if (type == FRAME_PAIR) {
+    // Self-contained pair, the previous frame replaces the reference
+    if (payloadLength <= ARRAY_SIZE || payloadLength > 2 * ARRAY_SIZE) {
+      sendReply(seq, STATUS_BAD_PACKET, false, 0, 0);
+      return;
+    }
+    memcpy(receivedData1, payload, ARRAY_SIZE);
+    hasReference = true;
+    if (payloadLength == 2 * ARRAY_SIZE) {
+      memcpy(receivedData2, payload + ARRAY_SIZE, ARRAY_SIZE);
+    } else if (!decodeDelta(payload + ARRAY_SIZE, payloadLength - ARRAY_SIZE)) {
+      hasReference = false;
+      sendReply(seq, STATUS_BAD_PACKET, false, 0, 0);
+      return;
+    }
+  } else if (type == FRAME_RAW || type == FRAME_RESET) {
+    if (payloadLength != ARRAY_SIZE) {
+      sendReply(seq, STATUS_BAD_PACKET, false, 0, 0);
+      return;
+    }
+    memcpy(receivedData2, payload, ARRAY_SIZE);
+  } else if (type == FRAME_DELTA) {
+    if (!hasReference) {
+      sendReply(seq, STATUS_NO_REFERENCE, false, 0, 0);
+      return;
+    }
+    if (!decodeDelta(payload, payloadLength)) {
+      sendReply(seq, STATUS_BAD_PACKET, false, 0, 0);
+      return;
+    }
+  } else {
+    sendReply(seq, STATUS_BAD_PACKET, false, 0, 0);
+    return;
+  }
+
+  if (type == FRAME_RESET || !hasReference) {
+    sendReply(seq, STATUS_NO_FLOW, false, 0, 0);
+  } else if (replyMode != MODE_POINT) {
+    sendPointsReply(seq);
+  } else {
+    int scaled_u, scaled_v;
+    computeFlowVector(8, 8, &scaled_u, &scaled_v);
+    sendReply(seq, STATUS_OK, true, scaled_u, scaled_v);
+  }
+  memcpy(receivedData1, receivedData2, sizeof(receivedData1));
+  hasReference = true;
+}
+
+void receiveByte(uint8_t byteReceived) {
+  // Hunt for the sync bytes, then collect the header and the rest of the packet
+  if (packetLength == 0 && byteReceived != SYNC0) return;
+  if (packetLength == 1 && byteReceived != SYNC1) {
+    packetLength = byteReceived == SYNC0 ? 1 : 0;
+    return;
+  }
+  packet[packetLength++] = byteReceived;
+  if (packetLength < HEADER_SIZE) return;
+
+  int payloadLength = ((int)packet[5] << 8) | packet[6];
+  if (packet[2] != PROTOCOL_VERSION || payloadLength > MAX_PAYLOAD) {
+    packetLength = 0;  // Not a real header
+    return;
+  }
+  if (packetLength == HEADER_SIZE + payloadLength + 2) {
+    handlePacket(payloadLength);
+    packetLength = 0;
+  }
+}
+
+void loop() {
+  while (Serial.available() > 0) {
+    receiveByte(Serial.read());
+  }
+}
+
+#else
+
 void loop() {
   if (Serial.available() > 0) {
     uint8_t byteReceived = Serial.read();
@@ -111,4 +397,6 @@ void loop() {
       dataCount = 0;
     }
   }
-}
\ No newline at end of file
+}
+
+#endif
@@ -0,0 +1,227 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
+
+# Accuracy of the ESP path against the Farneback reference over a corpus of
+# videos. Every video is decoded once in a worker process and fed to both
+# paths, the ESP vectors coming from the emulator or from a recorded session
+# (serialrecord.py) of the board. Per video it computes
+#
+#   endpoint error    |(u, v)_esp - (u, v)_reference| in pixels per frame
+#   magnitude RMSE    of |(u, v)| in pixels per frame, without the x10 of the plots
+#   angle error       |angle difference| wrapped to [0, 180] degrees, only
+#                     where both vectors are longer than min_magnitude
+#
+# and writes the per-frame samples and per-video metrics as columns of one
+# .npz plus an aggregate summary in .json:
+#
+#   python evaluate.py src/clips --output results.npz
+#   python evaluate.py manifest.json --sessions recordings/ --workers 8
+#
+# A manifest is a JSON list of video paths or of {"video", "session",
+# "protocol", "frames"} objects, or a text file with a video path per line.
+
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mov", ".mkv", ".m4v")
+METRICS = ("epe_mean", "epe_median", "epe_p95", "magnitude_rmse", "angle_error_deg", "angle_samples", "frames",
+           "esp_failures", "seconds")
+
+
+def load_manifest(path, sessions=None, frames=900, protocol="raw"):
+    """
+    Jobs as dicts with video, session (None for the emulator), protocol and
+    frames, from a directory of videos or a manifest file. With sessions a
+    video without a session of its own uses <sessions>/<video name>.session
+    if there is one.
+    """
+    if os.path.isdir(path):
+        entries = [os.path.join(path, name) for name in sorted(os.listdir(path))
+                   if name.lower().endswith(VIDEO_EXTENSIONS)]
+    elif path.endswith(".json"):
+        with open(path) as f:
+            entries = json.load(f)
+        base = os.path.dirname(os.path.abspath(path))
+    else:
+        with open(path) as f:
+            entries = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+        base = os.path.dirname(os.path.abspath(path))
+
+    jobs = []
+    for entry in entries:
+        job = {"video": entry} if isinstance(entry, str) else dict(entry)
+        if not os.path.isdir(path):
+            # Relative paths in a manifest are relative to the manifest
+            job["video"] = os.path.join(base, job["video"])
+            if job.get("session"):
+                job["session"] = os.path.join(base, job["session"])
+        job["video"] = os.path.abspath(job["video"])
+        job.setdefault("frames", frames)
+        job.setdefault("protocol", protocol)
+        if not job.get("session") and sessions is not None:
+            candidate = os.path.join(sessions, os.path.splitext(os.path.basename(job["video"]))[0] + ".session")
+            if os.path.exists(candidate):
+                job["session"] = os.path.abspath(candidate)
+        job.setdefault("session", None)
+        jobs.append(job)
+    return jobs
+
+
+def flow_errors(esp, reference, min_magnitude=0.1):
+    """
+    Metrics between two (n, 2) arrays of (u, v) for the same frames, and the
+    per-frame endpoint errors.
+    """
+    esp = np.asarray(esp, dtype=np.float64).reshape(-1, 2)
+    reference = np.asarray(reference, dtype=np.float64).reshape(-1, 2)
+    epe = np.hypot(*(esp - reference).T)
+    magnitude_esp = np.hypot(*esp.T)
+    magnitude_reference = np.hypot(*reference.T)
+    moving = (magnitude_esp > min_magnitude) & (magnitude_reference > min_magnitude)
+    angle = np.arctan2(esp[:, 1], esp[:, 0]) - np.arctan2(reference[:, 1], reference[:, 0])
+    angle_error = np.abs(np.angle(np.exp(1j * angle[moving])))
+    nan = float("nan")
+    metrics = {
+        "epe_mean": float(epe.mean()) if len(epe) else nan,
+        "epe_median": float(np.median(epe)) if len(epe) else nan,
+        "epe_p95": float(np.percentile(epe, 95)) if len(epe) else nan,
+        "magnitude_rmse": float(np.sqrt(np.mean((magnitude_esp - magnitude_reference) ** 2))) if len(epe) else nan,
+        "angle_error_deg": float(np.degrees(angle_error.mean())) if len(angle_error) else nan,
+        "angle_samples": int(moving.sum()),
+    }
+    return metrics, epe
+
+
+def evaluate_video(job, min_magnitude=0.1, window=2):
+    """
+    Runs both paths over one video. Returns the metrics and the per-frame
+    columns.
+    """
+    from framesource import VideoFrameSource, run_consumers
+    from opencvlk import flowFarnebackFrames
+    from preprocess import BLUR_HALO, process_frames
+
+    start = time.perf_counter()
+    port = "replay:" + job["session"] if job["session"] else "emu"
+    frames = VideoFrameSource(job["video"], job["frames"], roi_size=16, halo=BLUR_HALO)
+    reference, esp = run_consumers(frames, [partial(flowFarnebackFrames, showVid=False),
+                                            partial(process_frames, port=port, window=window,
+                                                    protocol=job["protocol"])])
+    if not len(reference):
+        raise ValueError("no frame pairs decoded")
+
+    # Only the frames both paths have a sample for
+    esp_failures = max(len(reference) - len(esp.valid()), 0)
+    esp, reference = esp.valid().align(reference)
+    metrics, epe = flow_errors(esp.uv, reference.uv, min_magnitude)
+    metrics["frames"] = len(esp)
+    metrics["esp_failures"] = esp_failures
+    metrics["seconds"] = time.perf_counter() - start
+    columns = {"frame": esp.frame.astype(np.int32), "esp": esp.uv, "reference": reference.uv,
+               "epe": epe.astype(np.float32)}
+    return metrics, columns
+
+
+def _evaluate(job, min_magnitude, window):
+    # In the worker, a failing video gives its error message instead of metrics
+    try:
+        return evaluate_video(job, min_magnitude, window)
+    except Exception as e:
+        return f"{type(e).__name__}: {e}", None
+
+
+def summarise(metrics):
+    """
+    Aggregate of per-video metrics, each weighted by the samples it was
+    computed on, so the result is the same as for all frames pooled.
+    """
+    frames = np.asarray(metrics["frames"], dtype=np.float64)
+    summary = {"videos": len(frames), "frames": int(frames.sum())}
+    for name in ("epe_mean", "magnitude_rmse", "angle_error_deg"):
+        values = np.asarray(metrics[name], dtype=np.float64)
+        weights = np.asarray(metrics["angle_samples"] if name == "angle_error_deg" else frames, dtype=np.float64)
+        valid = ~np.isnan(values) & (weights > 0)
+        if name == "magnitude_rmse":
+            # RMSE of all frames together, not the mean of the RMSEs
+            value = np.sqrt(np.sum(values[valid] ** 2 * weights[valid]) / weights[valid].sum()) if valid.any() else None
+        else:
+            value = np.average(values[valid], weights=weights[valid]) if valid.any() else None
+        summary[name] = None if value is None else float(value)
+    return summary
+
+
+def run(jobs, output="results.npz", workers=None, min_magnitude=0.1, window=2, quiet=False):
+    """
+    Evaluates every job in a process pool and writes output (.npz) and the
+    summary next to it (.json). Returns the summary.
+    """
+    results = [None] * len(jobs)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_evaluate, job, min_magnitude, window) for job in jobs]
+        for i, future in enumerate(futures):
+            results[i] = future.result()
+            if not quiet:
+                metrics = results[i][0]
+                name = os.path.basename(jobs[i]["video"])
+                if isinstance(metrics, str):
+                    print(f"{name:<32} failed: {metrics}")
+                else:
+                    print(f"{name:<32} {metrics['frames']:6d} frames  epe {metrics['epe_mean']:7.3f}  "
+                          f"rmse {metrics['magnitude_rmse']:7.3f}  angle {metrics['angle_error_deg']:6.1f} deg")
+
+    # Per-video columns, failed videos keep NaN metrics and their error
+    table = {name: np.full(len(jobs), np.nan) for name in METRICS}
+    errors = np.array([""] * len(jobs), dtype=object)
+    samples = {"video_index": [], "frame": [], "esp": [], "reference": [], "epe": []}
+    for i, (metrics, columns) in enumerate(results):
+        if isinstance(metrics, str):
+            errors[i] = metrics
+            continue
+        for name in METRICS:
+            table[name][i] = metrics[name]
+        samples["video_index"].append(np.full(len(columns["frame"]), i, dtype=np.int32))
+        for name in ("frame", "esp", "reference", "epe"):
+            samples[name].append(columns[name])
+    empty = {"video_index": np.zeros(0, np.int32), "frame": np.zeros(0, np.int32),
+             "esp": np.zeros((0, 2), np.float32), "reference": np.zeros((0, 2), np.float32),
+             "epe": np.zeros(0, np.float32)}
+    samples = {name: np.concatenate(parts) if parts else empty[name] for name, parts in samples.items()}
+
+    np.savez(output, video=np.array([job["video"] for job in jobs]),
+             session=np.array([job["session"] or "" for job in jobs]), error=errors.astype(str),
+             **{f"video_{name}": values for name, values in table.items()},
+             **{f"sample_{name}": values for name, values in samples.items()})
+
+    ok = ~np.isnan(table["frames"])
+    summary = summarise({name: values[ok] for name, values in table.items()})
+    summary["failed"] = int((~ok).sum())
+    worst = np.argsort(-np.nan_to_num(table["epe_mean"], nan=-np.inf))[:5]
+    summary["worst"] = [{"video": jobs[i]["video"], "epe_mean": float(table["epe_mean"][i])} for i in worst if ok[i]]
+    with open(os.path.splitext(output)[0] + ".json", "w") as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ESP vs Farneback accuracy over a corpus of videos")
+    parser.add_argument("corpus", help="directory of videos or manifest (.json or one path per line)")
+    parser.add_argument("--sessions", help="directory of recorded sessions named <video>.session")
+    parser.add_argument("--frames", type=int, default=900)
+    parser.add_argument("--protocol", choices=("raw", "framed"), default="raw")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--min-magnitude", type=float, default=0.1,
+                        help="shortest vectors, in pixels, whose angle is compared")
+    parser.add_argument("--output", default="results.npz")
+    args = parser.parse_args()
+
+    jobs = load_manifest(args.corpus, args.sessions, args.frames, args.protocol)
+    if not jobs:
+        parser.error(f"No videos in {args.corpus}")
+    summary = run(jobs, args.output, args.workers, args.min_magnitude)
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
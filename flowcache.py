@@ -0,0 +1,171 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+import numpy as np
+
+# On-disk cache for decoded ROI stacks and reference flow traces. Entries are
+# keyed by a hash of the video content plus every parameter that changes the
+# result, so a warm run with the same video and settings skips decoding.
+
+CACHE_DIR = ".flowcache"
+MAX_BYTES = 2 * 1024 ** 3
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """
+    sha256 of a file's content.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FlowCache:
+    """
+    Arrays stored as .npy files under root, loaded memory mapped. index.json
+    keeps the size and last use of every entry for LRU eviction once the
+    total goes over max_bytes, and remembers video hashes by path, size and
+    mtime so unchanged videos aren't hashed again.
+    """
+
+    def __init__(self, root=CACHE_DIR, max_bytes=MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(root, "index.json")
+        os.makedirs(root, exist_ok=True)
+        try:
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {"videos": {}, "entries": {}}
+
+    def _save_index(self):
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp, self.index_path)
+
+    def _path(self, key):
+        return os.path.join(self.root, key + ".npy")
+
+    def video_hash(self, video_path):
+        stat = os.stat(video_path)
+        known = self.index["videos"].get(os.path.abspath(video_path))
+        if known and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+            return known[2]
+        digest = file_hash(video_path)
+        self.index["videos"][os.path.abspath(video_path)] = [stat.st_size, stat.st_mtime_ns, digest]
+        self._save_index()
+        return digest
+
+    def key(self, video_path, kind, **params):
+        """
+        Cache key for a result of kind computed from video_path with params.
+        params must be JSON serialisable.
+        """
+        description = {"video": self.video_hash(video_path), "kind": kind, "params": params}
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def load(self, key):
+        """
+        The cached array memory mapped read only, or None.
+        """
+        entry = self.index["entries"].get(key)
+        if entry is None:
+            return None
+        try:
+            array = np.load(self._path(key), mmap_mode="r")
+        except (OSError, ValueError):
+            self._remove(key)
+            self._save_index()
+            return None
+        entry["used"] = time.time()
+        self._save_index()
+        return array
+
+    def store(self, key, array, video=None, kind=None):
+        array = np.asarray(array)
+        path = self._path(key)
+        tmp = path + ".tmp.npy"
+        np.save(tmp, array)
+        os.replace(tmp, path)
+        self.index["entries"][key] = {"video": video, "kind": kind, "bytes": os.path.getsize(path),
+                                      "used": time.time()}
+        self.evict()
+        self._save_index()
+        if key not in self.index["entries"]:
+            return array  # Bigger than the whole cache
+        return np.load(path, mmap_mode="r")
+
+    def get_or_compute(self, video_path, kind, compute, **params):
+        """
+        Load the entry for (video_path, kind, params) or compute, store and
+        return it.
+        """
+        key = self.key(video_path, kind, **params)
+        array = self.load(key)
+        if array is None:
+            array = self.store(key, compute(), self.video_hash(video_path), kind)
+        return array
+
+    def _remove(self, key):
+        self.index["entries"].pop(key, None)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        """
+        Drop least recently used entries until the cache fits in max_bytes.
+        """
+        entries = self.index["entries"]
+        total = sum(entry["bytes"] for entry in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k]["used"]):
+            if total <= self.max_bytes:
+                break
+            total -= entries[key]["bytes"]
+            self._remove(key)
+
+    def invalidate(self, video_path=None):
+        """
+        Remove every entry computed from video_path, or everything. Returns the
+        number of entries removed.
+        """
+        if video_path is None:
+            keys = list(self.index["entries"])
+            self.index["videos"] = {}
+        else:
+            digest = self.video_hash(video_path)
+            keys = [k for k, entry in self.index["entries"].items() if entry["video"] == digest]
+        for key in keys:
+            self._remove(key)
+        self._save_index()
+        return len(keys)
+
+    def size(self):
+        return sum(entry["bytes"] for entry in self.index["entries"].values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the flow cache")
+    parser.add_argument("--root", default=CACHE_DIR)
+    commands = parser.add_subparsers(dest="command", required=True)
+    invalidate = commands.add_parser("invalidate", help="remove cached entries")
+    invalidate.add_argument("video", nargs="?", help="only entries of this video (path)")
+    commands.add_parser("info", help="show cache size")
+    args = parser.parse_args()
+
+    cache = FlowCache(args.root)
+    if args.command == "invalidate":
+        print(f"Removed {cache.invalidate(args.video)} entries")
+    else:
+        print(f"{len(cache.index['entries'])} entries, {cache.size() / 1024 ** 2:.1f} MiB in {cache.root}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import numpy as np
+
+# Flow samples of one path (the ESP32, Farneback, ...) as a structured array
+# with a row per frame pair: the frame number of the second frame, (u, v) in
+# pixels, when the sample was produced (time.perf_counter() seconds, NaN if
+# unknown) and a status. Rows are appended into preallocated space that grows
+# by doubling, columns are views of the array without copying, and a trace is
+# saved with np.save and loaded memory mapped.
+
+FLOW_DTYPE = np.dtype([("frame", np.int64), ("u", np.float32), ("v", np.float32), ("timestamp", np.float64),
+                       ("status", np.uint8)])
+
+STATUS_OK = 0
+STATUS_FAILED = 1  # No reply, or a bad one, for this frame, u and v are NaN
+STATUS_SKIPPED = 2  # Not sent as it barely changed, u and v filled in (framescheduler.py)
+STATUS_DROPPED = 3  # Not sent as the link was behind, u and v filled in or NaN
+
+
+def polar(u, v):
+    """
+    (magnitude, angle) of flow vectors, the angle in radians in [0, 2*pi).
+    """
+    u = np.asarray(u, dtype=np.float64)
+    v = np.asarray(v, dtype=np.float64)
+    return np.hypot(u, v), np.mod(np.arctan2(v, u), 2 * np.pi)
+
+
+class FlowTrace:
+    """
+    Growable trace of flow samples. data is the structured array of the
+    rows so far, frame, u, v, timestamp and status are its columns.
+    """
+
+    def __init__(self, capacity=1024, data=None):
+        if data is None:
+            self._data = np.empty(max(capacity, 1), dtype=FLOW_DTYPE)
+            self._size = 0
+        else:
+            self._data = data
+            self._size = len(data)
+
+    @classmethod
+    def from_arrays(cls, frame, u, v, timestamp=None, status=None):
+        frame = np.asarray(frame)
+        data = np.empty(len(frame), dtype=FLOW_DTYPE)
+        data["frame"] = frame
+        data["u"] = u
+        data["v"] = v
+        data["timestamp"] = np.nan if timestamp is None else timestamp
+        data["status"] = STATUS_OK if status is None else status
+        return cls(data=data)
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        data = np.load(path, mmap_mode=mmap_mode)
+        if data.dtype != FLOW_DTYPE:
+            raise ValueError(f"{path} doesn't hold a flow trace")
+        return cls(data=data)
+
+    @classmethod
+    def concatenate(cls, traces):
+        return cls(data=np.concatenate([trace.data for trace in traces]) if traces else None)
+
+    def save(self, path):
+        np.save(path, self.data)
+
+    def _reserve(self, count):
+        needed = self._size + count
+        if needed <= len(self._data) and self._data.flags.writeable:
+            return
+        grown = np.empty(max(2 * len(self._data), needed, 1), dtype=FLOW_DTYPE)
+        grown[:self._size] = self._data[:self._size]
+        self._data = grown
+
+    def append(self, frame, u, v, timestamp=np.nan, status=STATUS_OK):
+        self._reserve(1)
+        self._data[self._size] = (frame, u, v, timestamp, status)
+        self._size += 1
+
+    def failed(self, frame, timestamp=np.nan):
+        self.append(frame, np.nan, np.nan, timestamp, STATUS_FAILED)
+
+    def extend(self, other):
+        self._reserve(len(other))
+        self._data[self._size:self._size + len(other)] = other.data
+        self._size += len(other)
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index):
+        """
+        Rows selected by an index, slice, mask or index array, as a trace.
+        """
+        if isinstance(index, (int, np.integer)):
+            index = [index]
+        return FlowTrace(data=self.data[index])
+
+    @property
+    def data(self):
+        return self._data[:self._size]
+
+    @property
+    def frame(self):
+        return self.data["frame"]
+
+    @property
+    def u(self):
+        return self.data["u"]
+
+    @property
+    def v(self):
+        return self.data["v"]
+
+    @property
+    def timestamp(self):
+        return self.data["timestamp"]
+
+    @property
+    def status(self):
+        return self.data["status"]
+
+    @property
+    def uv(self):
+        return np.stack([self.u, self.v], axis=1)
+
+    @property
+    def magnitude(self):
+        return polar(self.u, self.v)[0]
+
+    @property
+    def angle(self):
+        return polar(self.u, self.v)[1]
+
+    @property
+    def ok(self):
+        return self.status == STATUS_OK
+
+    def valid(self):
+        """
+        The samples with a measured vector.
+        """
+        return self[self.ok]
+
+    def finite(self):
+        """
+        The samples with a vector, measured or filled in (skipped or dropped
+        frames a FrameScheduler gave a value).
+        """
+        return self[np.isfinite(self.u) & np.isfinite(self.v)]
+
+    def align(self, other):
+        """
+        This trace and other cut down to the frames both have, in frame order.
+        """
+        _, mine, theirs = np.intersect1d(self.frame, other.frame, return_indices=True)
+        return self[mine], other[theirs]
+
+    def equals(self, other):
+        """
+        Same frames, vectors and status, timestamps aside.
+        """
+        return (len(self) == len(other) and np.array_equal(self.frame, other.frame)
+                and np.array_equal(self.status, other.status)
+                and np.array_equal(self.u, other.u, equal_nan=True) and np.array_equal(self.v, other.v, equal_nan=True))
+
+    def __repr__(self):
+        return f"FlowTrace({len(self)} samples, {int(np.count_nonzero(self.status == STATUS_FAILED))} failed)"
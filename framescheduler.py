@@ -0,0 +1,165 @@
+import threading
+import time
+import cv2
+import numpy as np
+from flowtrace import STATUS_DROPPED, STATUS_SKIPPED, FlowTrace
+
+# Decides which preprocessed frames go to the ESP32. A frame that differs from
+# the last one sent by less than skip_threshold (mean absolute difference in
+# grey levels over the 16x16 region) is skipped, the board never sees it. The
+# next reply is then the flow since the last frame sent, over several frames,
+# and is spread evenly over them; frames no reply covers get zero flow, or are
+# interpolated from the frames around them. With
+# drop=True the source is read on its own thread and only the newest frame is
+# kept for the link, so when the link (or max_fps) can't keep up older frames
+# are dropped instead of queueing up latency; meant for live feeds, a video
+# file read this way loses most of its frames. Counts of both are in summary().
+#
+#   scheduler = FrameScheduler(skip_threshold=1.0)
+#   flow = processdata("DashcamFootage.mp4", 900, port="emu", scheduler=scheduler)
+#   print(scheduler.summary())
+
+SKIP_THRESHOLD = 1.0  # Mean absolute difference below which a frame counts as static
+MAX_SKIP = 30  # Frames skipped in a row before one is sent anyway
+
+
+class FrameScheduler:
+    """
+    Filters a stream of preprocessed frames (flat uint8) before the link.
+    source_frame(k) is the position in the source of the k-th frame sent,
+    fill(trace) adds the frames that weren't sent to a trace of the sent
+    ones. A reply spanning n frames is divided by n and given to each of
+    them. For frames without such a reply (after the last one, or before a
+    failed one) fill "zero" gives skipped frames zero flow and dropped ones
+    NaN, "interpolate" interpolates both from the frames around them.
+    """
+
+    def __init__(self, skip_threshold=SKIP_THRESHOLD, max_skip=MAX_SKIP, drop=False, max_fps=None, fill="zero"):
+        if fill not in ("zero", "interpolate"):
+            raise ValueError(f"Unknown fill {fill!r}, expected 'zero' or 'interpolate'")
+        self.skip_threshold = skip_threshold
+        self.max_skip = max_skip
+        self.drop = drop
+        self.max_fps = max_fps
+        self.fill_mode = fill
+        self.sent = []  # Source position of every frame sent
+        self.skipped = []
+        self.dropped = []
+        self.frames = 0  # Frames read from the source
+        self._cond = threading.Condition()
+        self._latest = None  # (position, frame) waiting for the link
+        self._done = False
+        self._closed = False
+
+    def _static(self, frame, reference, run):
+        if reference is None or self.skip_threshold is None or run >= self.max_skip:
+            return False
+        return cv2.norm(frame, reference, cv2.NORM_L1) < self.skip_threshold * frame.size
+
+    def _read_latest(self, frames):
+        # Keeps only the newest frame, anything it replaces wasn't sent in time
+        try:
+            for position, frame in enumerate(frames):
+                with self._cond:
+                    if self._closed:
+                        break
+                    if self._latest is not None:
+                        self.dropped.append(self._latest[0])
+                    self._latest = (position, np.array(frame, dtype=np.uint8).reshape(-1))
+                    self.frames = position + 1
+                    self._cond.notify_all()
+        finally:
+            with self._cond:
+                self._done = True
+                self._cond.notify_all()
+
+    def _newest(self, frames):
+        thread = threading.Thread(target=self._read_latest, args=(frames,), daemon=True)
+        thread.start()
+        while True:
+            with self._cond:
+                while self._latest is None and not self._done and not self._closed:
+                    self._cond.wait()
+                if self._latest is None or self._closed:
+                    return
+                item, self._latest = self._latest, None
+            yield item
+
+    def _counted(self, frames):
+        for position, frame in enumerate(frames):
+            self.frames = position + 1
+            yield position, frame
+
+    def schedule(self, frames):
+        """
+        The frames to send.
+        """
+        reference = None
+        run = 0  # Frames skipped since the last one sent
+        interval = 1.0 / self.max_fps if self.max_fps else 0.0
+        last_sent = None
+        for position, frame in (self._newest(frames) if self.drop else self._counted(frames)):
+            if self._static(frame, reference, run):
+                self.skipped.append(position)
+                run += 1
+                continue
+            if interval and last_sent is not None:
+                # Newer frames keep replacing this one while the rate is held
+                wait = last_sent + interval - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+            if reference is None:
+                reference = np.empty_like(frame)
+            np.copyto(reference, frame)
+            run = 0
+            last_sent = time.perf_counter()
+            self.sent.append(position)
+            yield frame
+
+    def source_frame(self, sent_index):
+        return self.sent[sent_index]
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def fill(self, trace):
+        """
+        trace (indexed by source frame) with a row for every frame skipped or
+        dropped after the first one sent, in frame order.
+        """
+        first = self.sent[0] if self.sent else 0
+        skipped = [p for p in self.skipped if p > first]
+        dropped = [p for p in self.dropped if p > first]
+        status = np.r_[np.full(len(skipped), STATUS_SKIPPED), np.full(len(dropped), STATUS_DROPPED)]
+        extra = FlowTrace.from_arrays(np.array(skipped + dropped, dtype=np.int64), np.nan, np.nan, status=status)
+        merged = FlowTrace.concatenate([trace, extra])
+        merged = merged[np.argsort(merged.frame, kind="stable")]
+        # Every frame takes its share of the reply for the next frame sent
+        sent = np.asarray(self.sent, dtype=np.int64)
+        if len(sent) > 1 and len(merged):
+            following = np.searchsorted(sent, merged.frame)  # Next frame sent, or the frame itself
+            covered = (following > 0) & (following < len(sent))
+            following = np.minimum(following, len(sent) - 1)
+            reply = np.minimum(np.searchsorted(merged.frame, sent[following]), len(merged) - 1)
+            covered &= merged.frame[reply] == sent[following]  # The reply has a row
+            span = sent[following[covered]] - sent[following[covered] - 1]
+            merged.u[covered] = merged.u[reply[covered]] / span
+            merged.v[covered] = merged.v[reply[covered]] / span
+        missing = np.isin(merged.status, (STATUS_SKIPPED, STATUS_DROPPED)) & np.isnan(merged.u)
+        if self.fill_mode == "zero":
+            zero = missing & (merged.status == STATUS_SKIPPED)
+            merged.u[zero] = 0
+            merged.v[zero] = 0
+        else:
+            known = np.isfinite(merged.u) & np.isfinite(merged.v)
+            if known.any() and missing.any():
+                merged.u[missing] = np.interp(merged.frame[missing], merged.frame[known], merged.u[known])
+                merged.v[missing] = np.interp(merged.frame[missing], merged.frame[known], merged.v[known])
+        return merged
+
+    def summary(self):
+        frames = max(self.frames, 1)
+        return {"frames": self.frames, "sent": len(self.sent), "skipped": len(self.skipped),
+                "dropped": len(self.dropped), "link_saved": (len(self.skipped) + len(self.dropped)) / frames}
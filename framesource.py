@@ -0,0 +1,424 @@
+import os
+import queue
+import threading
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import cv2
+import numpy as np
+
+# Decodes a video once and hands every frame to several consumers, either
+# threads reading bounded queues or worker processes reading a shared memory
+# ring buffer. Every consumer sees the same frames in the same order, so frame
+# numbers line up between the ESP path and the reference path.
+
+_END = None
+
+
+def roi_bounds(width, height, roi_size, halo=0):
+    """
+    (x0, y0, x1, y1) of the centred roi_size square grown by halo pixels on
+    every side and clipped to the frame. The centre of the crop is the centre
+    of the frame, so code that takes the centre of a frame gets the same pixels
+    from the crop.
+    """
+    start_x = (width - roi_size) // 2
+    start_y = (height - roi_size) // 2
+    return (max(start_x - halo, 0), max(start_y - halo, 0),
+            min(start_x + roi_size + halo, width), min(start_y + roi_size + halo, height))
+
+
+def capture_frames(cap, datacount, roi_size=None, halo=0, step=1):
+    """
+    Yield up to datacount frames read from an open cv2.VideoCapture, cropped
+    like video_frames.
+    """
+    bounds = None
+    frame_count = 0
+    while frame_count < datacount:
+        # Frames that will be dropped are only grabbed, never decoded to pixels
+        for _ in range(step - 1):
+            if not cap.grab():
+                return
+        ret, frame = cap.read()
+        if not ret:
+            break  # End of video
+        if roi_size is not None:
+            if bounds is None:
+                bounds = roi_bounds(frame.shape[1], frame.shape[0], roi_size, halo)
+            x0, y0, x1, y1 = bounds
+            # Copy so the full frame can be freed straight away
+            frame = frame[y0:y1, x0:x1].copy()
+        yield frame
+        frame_count += 1
+
+
+def seek_capture(cap, frame_index):
+    """
+    Position cap so the next read returns frame frame_index. The backend seeks
+    to the keyframe before the target and decodes forward from there. If it
+    can't land on the exact frame the capture is rewound and frames are
+    grabbed up to the target instead.
+    """
+    if frame_index <= 0:
+        return True
+    if cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index) and int(cap.get(cv2.CAP_PROP_POS_FRAMES)) == frame_index:
+        return True
+    cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    for _ in range(frame_index):
+        if not cap.grab():
+            return False
+    return True
+
+
+def video_frames(videoname, datacount, roi_size=None, halo=0, step=1, start=0):
+    """
+    Yield up to datacount BGR frames of src/<videoname> starting at frame
+    start, keeping every step-th frame. With roi_size only the centred
+    roi_size square plus halo pixels of context is kept, before any colour
+    conversion.
+    """
+    cap = cv2.VideoCapture(os.path.join("src", videoname))
+    try:
+        if seek_capture(cap, start):
+            yield from capture_frames(cap, datacount, roi_size, halo, step)
+    finally:
+        cap.release()
+
+
+def video_fps(videoname, default=30.0):
+    """
+    Frame rate of src/<videoname> from its header, default if it has none.
+    """
+    cap = cv2.VideoCapture(os.path.join("src", videoname))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    cap.release()
+    return fps if fps > 0 else default
+
+
+class VideoFrameSource:
+    """
+    Same frames as video_frames but decoded on a background thread that keeps
+    up to prefetch frames ready in a bounded queue, so decoding overlaps with
+    whatever consumes the frames.
+    """
+
+    def __init__(self, videoname, datacount, roi_size=None, halo=0, step=1, prefetch=8):
+        self.videoname = videoname
+        self.datacount = datacount
+        self.roi_size = roi_size
+        self.halo = halo
+        self.step = step
+        self.prefetch = prefetch
+
+    def __iter__(self):
+        frames = queue.Queue(self.prefetch)
+        stop = threading.Event()
+        errors = []
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    frames.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def decode():
+            try:
+                for frame in video_frames(self.videoname, self.datacount, self.roi_size, self.halo, self.step):
+                    if stop.is_set():
+                        break
+                    put(frame)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                put(_END)
+
+        thread = threading.Thread(target=decode, daemon=True)
+        thread.start()
+        try:
+            while True:
+                frame = frames.get()
+                if frame is _END:
+                    break
+                yield frame
+        finally:
+            stop.set()
+            thread.join()
+        if errors:
+            raise errors[0]
+
+
+class Subscription:
+    """
+    Frames for one consumer of a FrameBroadcaster. Iterating yields frames
+    until the source ends, stopping early closes the subscription so the
+    producer doesn't wait on it any more.
+    """
+
+    def __init__(self, maxsize):
+        self.queue = queue.Queue(maxsize)
+        self.closed = threading.Event()
+
+    def __iter__(self):
+        try:
+            while True:
+                frame = self.queue.get()
+                if frame is _END:
+                    break
+                yield frame
+        finally:
+            self.close()
+
+    def close(self):
+        self.closed.set()
+        # Unblock a producer waiting on a full queue
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+
+    def put(self, frame):
+        while not self.closed.is_set():
+            try:
+                self.queue.put(frame, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+
+class FrameBroadcaster:
+    """
+    Decodes on a background thread and puts every frame in the bounded queue
+    of each subscription, so the slowest consumer sets the pace and at most
+    maxsize frames per consumer are buffered.
+    """
+
+    def __init__(self, frames, maxsize=8):
+        self.frames = frames
+        self.maxsize = maxsize
+        self.subscriptions = []
+        self.thread = None
+        self.error = None
+
+    def subscribe(self):
+        if self.thread is not None:
+            raise RuntimeError("subscribe before start")
+        subscription = Subscription(self.maxsize)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def run(self):
+        try:
+            for frame in self.frames:
+                if all(s.closed.is_set() for s in self.subscriptions):
+                    break
+                for subscription in self.subscriptions:
+                    subscription.put(frame)
+        except Exception as e:
+            self.error = e
+        finally:
+            for subscription in self.subscriptions:
+                subscription.put(_END)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def join(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+class RingReader:
+    """
+    Picklable reading end of a SharedFrameRing for one consumer process.
+    Frames are copied out of the ring so the slot can be reused straight away.
+    """
+
+    def __init__(self, name, shape, dtype, slots, free, filled, index, closed):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+        self.slots = slots
+        self.free = free
+        self.filled = filled
+        self.index = index
+        self.closed = closed
+
+    def __iter__(self):
+        shm = shared_memory.SharedMemory(name=self.name)
+        try:
+            ring = np.ndarray((self.slots,) + self.shape, dtype=self.dtype, buffer=shm.buf)
+            slot = 0
+            while True:
+                self.filled.acquire()
+                if self.index[slot] < 0:
+                    break
+                frame = ring[slot].copy()
+                self.free.release()
+                yield frame
+                slot = (slot + 1) % self.slots
+        finally:
+            self.closed.value = 1
+            del ring
+            shm.close()
+
+
+class SharedFrameRing:
+    """
+    Ring buffer of decoded frames in shared memory read by worker processes.
+    A slot is only overwritten once every consumer has copied it out, each
+    consumer has its own pair of free/filled semaphores for backpressure.
+    """
+
+    def __init__(self, frames, consumers, slots=8, ctx=None):
+        self.ctx = ctx if ctx is not None else mp.get_context()
+        self.frames = iter(frames)
+        self.first = next(self.frames, None)
+        self.slots = slots
+        if self.first is None:
+            self.shape, self.dtype = (1,), np.dtype(np.uint8)
+        else:
+            self.shape, self.dtype = self.first.shape, self.first.dtype
+        nbytes = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+        self.shm = shared_memory.SharedMemory(create=True, size=slots * nbytes)
+        self.free = [self.ctx.Semaphore(slots) for _ in range(consumers)]
+        self.filled = [self.ctx.Semaphore(0) for _ in range(consumers)]
+        self.closed = [self.ctx.Value('b', 0) for _ in range(consumers)]
+        self.failed = self.ctx.Value('b', 0)  # Set by a consumer that raised, stops the ring
+        self.index = self.ctx.Array('q', slots, lock=False)
+        self.processes = None
+
+    def reader(self, consumer):
+        return RingReader(self.shm.name, self.shape, self.dtype, self.slots,
+                          self.free[consumer], self.filled[consumer], self.index, self.closed[consumer])
+
+    def _acquire_free(self, consumer):
+        # A consumer that stopped reading, or whose process is gone, is left out
+        while not self.free[consumer].acquire(timeout=0.1):
+            if self.closed[consumer].value:
+                return False
+            if self.processes is not None and not self.processes[consumer].is_alive():
+                return False
+        return True
+
+    def _publish(self, slot, frame_count):
+        # Wait for every consumer still reading to hand the slot back
+        active = [c for c in range(len(self.free)) if self._acquire_free(c)]
+        self.index[slot] = frame_count
+        return active
+
+    def run(self, processes=None):
+        """
+        Feed every frame through the ring. processes are the consumer
+        processes, one that exits is no longer waited for. Stops early once
+        a consumer has failed, the others then see the end of the frames.
+        """
+        self.processes = processes
+        ring = np.ndarray((self.slots,) + self.shape, dtype=self.dtype, buffer=self.shm.buf)
+        frame_count = 0
+        frames = [] if self.first is None else [self.first]
+        try:
+            for frame in (f for src in (frames, self.frames) for f in src):
+                if self.failed.value:
+                    break
+                slot = frame_count % self.slots
+                active = self._publish(slot, frame_count)
+                if not active:
+                    break
+                ring[slot] = frame
+                for c in active:
+                    self.filled[c].release()
+                frame_count += 1
+        finally:
+            slot = frame_count % self.slots
+            for c in self._publish(slot, -1):
+                self.filled[c].release()
+            del ring
+            if hasattr(self.frames, "close"):
+                self.frames.close()  # Stops a decoding thread when the ring ended early
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+def _consume_in_process(consumer, frames, results, position, failed):
+    try:
+        results.put((position, consumer(frames)))
+    except Exception as e:
+        failed.value = 1
+        results.put((position, e))
+    finally:
+        # The consumer may have raised before reading any frame
+        frames.closed.value = 1
+
+
+def run_consumers(frames, consumers, mode="thread", maxsize=8):
+    """
+    Decode frames once and call every consumer with an iterable of the same
+    frames, returning their results in order.
+
+    In "thread" mode the first consumer runs on the calling thread (so it can
+    use cv.imshow) and the others on threads. In "process" mode every consumer
+    runs in its own process, so consumers must be picklable, for example
+    module level functions or functools.partial of them.
+    """
+    if mode == "thread":
+        broadcaster = FrameBroadcaster(frames, maxsize)
+        subscriptions = [broadcaster.subscribe() for _ in consumers]
+        results = [None] * len(consumers)
+        errors = []
+
+        def work(position):
+            try:
+                results[position] = consumers[position](subscriptions[position])
+            except Exception as e:
+                errors.append(e)
+            finally:
+                subscriptions[position].close()
+
+        broadcaster.start()
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(1, len(consumers))]
+        for thread in threads:
+            thread.start()
+        work(0)
+        for thread in threads:
+            thread.join()
+        broadcaster.join()
+        if errors:
+            raise errors[0]
+        return results
+
+    if mode == "process":
+        ring = SharedFrameRing(frames, len(consumers), maxsize)
+        ctx = ring.ctx
+        queue_results = ctx.Queue()
+        processes = [ctx.Process(target=_consume_in_process, args=(consumer, ring.reader(i), queue_results, i, ring.failed))
+                     for i, consumer in enumerate(consumers)]
+        try:
+            for process in processes:
+                process.start()
+            ring.run(processes)
+            results = [None] * len(consumers)
+            for _ in consumers:
+                while True:
+                    try:
+                        position, result = queue_results.get(timeout=0.5)
+                        break
+                    except queue.Empty:
+                        if not any(process.is_alive() for process in processes):
+                            raise RuntimeError("frame consumer process exited without a result")
+                if isinstance(result, Exception):
+                    raise result
+                results[position] = result
+            for process in processes:
+                process.join()
+        finally:
+            ring.close()
+        return results
+
+    raise ValueError(f"Unknown mode {mode!r}, expected 'thread' or 'process'")
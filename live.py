@@ -0,0 +1,221 @@
+import argparse
+import os
+import threading
+import time
+import cv2 as cv
+import numpy as np
+import matplotlib.pyplot as plt
+from framesource import capture_frames
+from flowtrace import polar
+from main import MAGNITUDE_SCALE
+from opencvlk import FARNEBACK_PARAMS
+from preprocess import BLUR_HALO, open_port, preprocess_frame, stream_flow_vectors
+from streamfilter import StreamFilter
+
+# Live view of the ESP32 and OpenCV flow while frames are still coming in.
+# Acquisition runs on its own thread and only writes samples into fixed length
+# ring buffers, the plot reads them at a capped refresh rate and redraws just
+# the line data with blitting.
+
+
+class RingBuffer:
+    """
+    Last length samples of a stream, written in O(1) with no allocation.
+    """
+
+    def __init__(self, length):
+        self.data = np.full(length, np.nan)
+        self.count = 0
+
+    def push(self, value):
+        self.data[self.count % len(self.data)] = value
+        self.count += 1
+
+    def ordered(self):
+        """
+        Samples oldest first, padded with NaN at the start until full.
+        """
+        return np.roll(self.data, -(self.count % len(self.data)))
+
+
+def open_source(source):
+    """
+    A camera index ("0") or a video file, looked up in src/ if not found as is.
+    Returns the capture and the delay between frames to play a file at its
+    native rate, None for cameras which pace themselves.
+    """
+    if str(source).isdigit():
+        return cv.VideoCapture(int(source)), None
+    path = source if os.path.exists(source) else os.path.join("src", source)
+    cap = cv.VideoCapture(path)
+    fps = cap.get(cv.CAP_PROP_FPS)
+    return cap, (1.0 / fps if fps > 0 else None)
+
+
+class LiveFlow:
+    """
+    Pulls frames from a source, runs the ESP32 path and the Farneback centre
+    window reference on them, and keeps the filtered magnitude and angle of
+    both in ring buffers.
+    """
+
+    def __init__(self, source, port="COM5", baudrate=500000, length=300, max_frames=10 ** 9, filtered=True):
+        self.source = source
+        self.port = port
+        self.baudrate = baudrate
+        self.max_frames = max_frames
+        self.buffers = {name: RingBuffer(length) for name in
+                        ("magnitudeESP", "angleESP", "magnitudeOpenCV", "angleOpenCV")}
+        self.filters = {name: StreamFilter(circular=name.startswith("angle")) if filtered else None
+                        for name in self.buffers}
+        self.stop = threading.Event()
+        self.push_time = 0.0  # Time spent handing samples to the plot
+        self.pushes = 0
+        self.error = None
+
+    def _push(self, name, value):
+        start = time.perf_counter()
+        flt = self.filters[name]
+        for sample in (flt.update(value) if flt is not None else [value]):
+            self.buffers[name].push(sample)
+        self.push_time += time.perf_counter() - start
+        self.pushes += 1
+
+    def _frames(self, cap, delay):
+        # Runs on the ESP sender thread, the reference is computed here too so
+        # both paths see exactly the same frames
+        prvs_roi = None
+        deadline = time.monotonic()
+        for frame in capture_frames(cap, self.max_frames, roi_size=16, halo=BLUR_HALO):
+            if self.stop.is_set():
+                break
+            if delay is not None:
+                deadline += delay
+                time.sleep(max(deadline - time.monotonic(), 0))
+
+            # Centre 8x8 window of the 16x16 crop, same as flowFarneback
+            h, w = frame.shape[:2]
+            next_roi = cv.cvtColor(frame[h // 2 - 4:h // 2 + 4, w // 2 - 4:w // 2 + 4], cv.COLOR_BGR2GRAY)
+            if prvs_roi is not None:
+                flow = cv.calcOpticalFlowFarneback(prvs_roi, next_roi, None, *FARNEBACK_PARAMS)
+                mag, ang = polar(flow[4, 4, 0], flow[4, 4, 1])
+                self._push("magnitudeOpenCV", float(mag))
+                self._push("angleOpenCV", float(ang))
+            prvs_roi = next_roi
+            yield preprocess_frame(frame)
+
+    def run(self):
+        cap, delay = open_source(self.source)
+        ser = open_port(self.port, self.baudrate, timeout=2)
+        try:
+            for frame_count, u, v in stream_flow_vectors(ser, self._frames(cap, delay)):
+                if u is None:
+                    continue
+                magnitude, angle = polar(u / 100.0, v / 100.0)
+                self._push("magnitudeESP", float(magnitude) * MAGNITUDE_SCALE)
+                self._push("angleESP", float(angle))
+                if self.stop.is_set():
+                    break
+        except Exception as e:
+            self.error = e
+        finally:
+            cap.release()
+            ser.close()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+class BlitPlot:
+    """
+    Magnitude and angle axes with one line per trace. Only the lines are
+    redrawn on each refresh, over a cached background of the axes.
+    """
+
+    def __init__(self, buffers, max_magnitude=20):
+        self.buffers = buffers
+        self.fig, (self.ax_mag, self.ax_ang) = plt.subplots(2, 1, figsize=(10, 8))
+        length = len(next(iter(buffers.values())).data)
+        self.x = np.arange(length)
+        styles = {"ESP": dict(color='blue', alpha=0.7), "OpenCV": dict(color='red', alpha=0.7)}
+        self.lines = {}
+        for name in buffers:
+            ax = self.ax_mag if name.startswith("magnitude") else self.ax_ang
+            side = "ESP" if name.endswith("ESP") else "OpenCV"
+            label = f"{'ESP32' if side == 'ESP' else 'OpenCV'} Flow {'Magnitude' if ax is self.ax_mag else 'Angle'}"
+            (self.lines[name],) = ax.plot(self.x, np.full(length, np.nan), label=label, animated=True, **styles[side])
+        self.ax_mag.set_ylim(0, max_magnitude)
+        self.ax_mag.set_ylabel("Magnitude of Flow Vector")
+        self.ax_ang.set_ylim(0, 360)
+        self.ax_ang.set_ylabel("Angle of Flow Vector (Degrees)")
+        for ax in (self.ax_mag, self.ax_ang):
+            ax.set_xlim(0, length - 1)
+            ax.set_xlabel("Sample")
+            ax.legend(loc="upper left")
+            ax.grid(True)
+        self.background = None
+        self.fig.canvas.mpl_connect("draw_event", self._on_draw)
+
+    def _on_draw(self, event):
+        # Window resized or first shown, grab a new background
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        self._draw_lines()
+
+    def _draw_lines(self):
+        for line in self.lines.values():
+            self.fig.draw_artist(line)
+
+    def refresh(self):
+        if self.background is None:
+            self.fig.canvas.draw()
+        canvas = self.fig.canvas
+        canvas.restore_region(self.background)
+        for name, line in self.lines.items():
+            y = self.buffers[name].ordered()
+            line.set_ydata(np.degrees(y) if name.startswith("angle") else y)
+        self._draw_lines()
+        canvas.blit(self.fig.bbox)
+        canvas.flush_events()
+
+
+def run_live(source, port="COM5", baudrate=500000, length=300, refresh_rate=20, max_frames=10 ** 9):
+    live = LiveFlow(source, port, baudrate, length, max_frames)
+    plot = BlitPlot(live.buffers)
+    plt.show(block=False)
+    live.start()
+
+    period = 1.0 / refresh_rate
+    redraws = 0
+    try:
+        while live.thread.is_alive() and plt.fignum_exists(plot.fig.number):
+            start = time.monotonic()
+            plot.refresh()
+            redraws += 1
+            time.sleep(max(period - (time.monotonic() - start), 0))
+    finally:
+        live.stop.set()
+        live.thread.join()
+    if live.error is not None:
+        raise live.error
+
+    if live.pushes:
+        print(f"{live.pushes} samples, {live.push_time / live.pushes * 1e6:.1f} us per sample "
+              f"on the acquisition thread, {redraws} redraws")
+    return live
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Live ESP32 vs OpenCV flow plots")
+    parser.add_argument("source", help="camera index or video file")
+    parser.add_argument("--port", default="COM5")
+    parser.add_argument("--baudrate", type=int, default=500000)
+    parser.add_argument("--length", type=int, default=300, help="samples kept on screen")
+    parser.add_argument("--refresh-rate", type=float, default=20, help="maximum redraws per second")
+    parser.add_argument("--max-frames", type=int, default=10 ** 9)
+    args = parser.parse_args()
+    run_live(args.source, args.port, args.baudrate, args.length, args.refresh_rate, args.max_frames)
+
+
+if __name__ == "__main__":
+    main()
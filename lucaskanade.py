@@ -0,0 +1,104 @@
+import numpy as np
+
+# Vectorised Lucas-Kanade over stacks of preprocessed frames. Gives the same
+# numbers as the per-pixel code it replaces but for every interior pixel of
+# every consecutive pair in one call.
+
+METHODS = ("firmware", "validation3")
+BORDER = 2  # Pixels on each side without a full neighbourhood for either method
+
+
+def _box_sum(a, k):
+    """
+    Sum every k x k window of the last two axes using an integral image.
+    Result index [i, j] is the window whose top left corner is at [i, j].
+    """
+    c = np.cumsum(np.cumsum(a, axis=-2), axis=-1)
+    c = np.pad(c, [(0, 0)] * (a.ndim - 2) + [(1, 0), (1, 0)])
+    return c[..., k:, k:] - c[..., :-k, k:] - c[..., k:, :-k] + c[..., :-k, :-k]
+
+
+def _solve(G00, G01, G11, b0, b1):
+    """
+    Closed form 2x2 solve of G [u v]^T = -b, zero where G is singular.
+    """
+    det = G00 * G11 - G01 * G01
+    singular = det == 0
+    det = np.where(singular, 1, det)
+    u = np.where(singular, 0, -(b0 * G11 - b1 * G01) / det)
+    v = np.where(singular, 0, -(b1 * G00 - b0 * G01) / det)
+    return u, v
+
+
+def _firmware_tensors(f1, f2):
+    """
+    Central difference gradients of the first frame summed over a 3x3 window,
+    as in computeOpticalFlow in espSerial.ino. Sums are exact integers, cast to
+    float32 afterwards they match the float32 accumulation on the ESP32.
+    """
+    Ix = np.zeros(f1.shape, dtype=np.int64)
+    Iy = np.zeros(f1.shape, dtype=np.int64)
+    Ix[..., :, 1:-1] = f1[..., :, 2:] - f1[..., :, :-2]
+    Iy[..., 1:-1, :] = f1[..., 2:, :] - f1[..., :-2, :]
+    It = (f2 - f1).astype(np.int64)
+
+    # Window centred on (y, x) starts at (y - 1, x - 1), keep centres BORDER..-BORDER
+    sums = [_box_sum(p, 3)[..., 1:-1, 1:-1].astype(np.float32)
+            for p in (Ix * Ix, Ix * Iy, Iy * Iy, Ix * It, Iy * It)]
+    return sums
+
+
+def _validation3_tensors(f1, f2):
+    """
+    2x2 averaging kernels from archive/validation3.py over both frames, each
+    point summing the 4x4 gradient cells of its 5x5 neighbourhood.
+    """
+    f1 = f1.astype(np.float64)
+    f2 = f2.astype(np.float64)
+    s = f1 + f2
+    # Cell [r, c] is the 2x2 block whose top left corner is at [r, c]
+    Ix = 0.25 * (s[..., :-1, 1:] - s[..., :-1, :-1] + s[..., 1:, 1:] - s[..., 1:, :-1])
+    Iy = 0.25 * (s[..., 1:, :-1] - s[..., :-1, :-1] + s[..., 1:, 1:] - s[..., :-1, 1:])
+    d = f1 - f2
+    It = 0.25 * (d[..., :-1, :-1] + d[..., :-1, 1:] + d[..., 1:, :-1] + d[..., 1:, 1:])
+
+    # Point (x, y) sums the cells starting at (x - 2, y - 2)
+    return [_box_sum(p, 4) for p in (Ix * Ix, Ix * Iy, Iy * Iy, Ix * It, Iy * It)]
+
+
+def dense_lucas_kanade(frames, method="firmware", chunk_size=4096):
+    """
+    Compute dense optical flow between every consecutive pair of frames.
+
+    frames is a stack of N grayscale frames, either (N, H, W) or (N, 256) as
+    flattened by preprocess_frame. Returns an (N - 1, H, W, 2) array of (u, v)
+    with NaN in the BORDER pixels that have no full neighbourhood, so
+    flow[:, 8, 8] is the same coordinate computeOpticalFlow(8, 8) uses.
+
+    method "firmware" uses the central difference 3x3 window of the ESP32 in
+    float32, "validation3" the 2x2 averaging kernels of validation3 in float64.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown method {method!r}, expected one of {METHODS}")
+
+    frames = np.asarray(frames)
+    if frames.ndim == 2 and frames.shape[1] == 256:
+        frames = frames.reshape(-1, 16, 16)
+    if frames.ndim != 3:
+        raise ValueError("frames must be a stack of 2D frames")
+
+    n, height, width = frames.shape
+    tensors = _firmware_tensors if method == "firmware" else _validation3_tensors
+    dtype = np.float32 if method == "firmware" else np.float64
+    flow = np.full((max(n - 1, 0), height, width, 2), np.nan, dtype=dtype)
+
+    # Chunks overlap by one frame so every pair is covered
+    for start in range(0, n - 1, chunk_size):
+        stop = min(start + chunk_size, n - 1)
+        f1 = frames[start:stop].astype(np.int32)
+        f2 = frames[start + 1:stop + 1].astype(np.int32)
+        u, v = _solve(*tensors(f1, f2))
+        flow[start:stop, BORDER:height - BORDER, BORDER:width - BORDER, 0] = u
+        flow[start:stop, BORDER:height - BORDER, BORDER:width - BORDER, 1] = v
+
+    return flow
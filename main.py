@@ -1,23 +1,35 @@
-from preprocess import processdata
-from opencvlk import flowFarneback as validate
-import matplotlib.pyplot as plt
+import argparse
+import json
+import os
+import sys
+from functools import partial
+from flowcache import FlowCache
+from flowtrace import STATUS_FAILED, FlowTrace
 import numpy as np
-from scipy.ndimage import median_filter
+
+# Command line entry point, python main.py <command> --help for the flags:
+#
+#   run        ESP32 and OpenCV flow side by side, filtered and plotted
+#   reference  the OpenCV Farneback reference trace of a video
+#   compare    error metrics between two saved traces
+#   record     the ESP32 path, logging the serial session
+#   replay     the ESP32 path against a recorded session
+#   bench      bench.py
+#
+# --config job.json (before the command) sets defaults for any flag from a
+# JSON object keyed by flag name, e.g. {"video": "DashcamFootage.mp4",
+# "port": "COM7", "frames": 300}; flags on the command line still win.
+# OpenCV, pyserial, scipy and matplotlib are imported by the commands that use
+# them, so a command only pays for what it runs.
+
+MAGNITUDE_SCALE = 10  # Scale factor for visualization
 
 def compute_magnitude_and_angle(flowList):
     """
-    Separate the flow data into magnitudes and angles.
+    Separate the flow data of a FlowTrace into magnitudes and angles, the
+    angles in [0, 2*pi).
     """
-    magnitudes = []
-    angles = []
-    for flow in flowList:
-        _, u, v = flow
-        magnitude = np.sqrt(u**2 + v**2) * 10  # Scale factor for visualization
-        angle = np.arctan2(v, u)  
-        angle = np.where(angle < 0, angle + 2*np.pi, angle)  # Ensure angle is positive
-        magnitudes.append(magnitude)
-        angles.append(angle)
-    return np.array(magnitudes), np.array(angles)
+    return flowList.magnitude * MAGNITUDE_SCALE, flowList.angle
 
 def moving_average(data, window_size):
     """
@@ -25,52 +37,119 @@ def moving_average(data, window_size):
     """
     return np.convolve(data, np.ones(window_size) / window_size, mode='valid')
 
-def filter_data(data, moving_avg_window_size=5, median_filter_size=8):
+def circular_moving_average(angles, window_size):
+    """
+    Apply a moving average to angles in radians by averaging unit vectors.
+    """
+    mean = np.arctan2(moving_average(np.sin(angles), window_size), moving_average(np.cos(angles), window_size))
+    return np.mod(mean, 2*np.pi)
+
+def filter_data(data, moving_avg_window_size=5, median_filter_size=8, circular=False):
     """
-    Apply a moving average and median filter to the data.
+    Apply a moving average and median filter to the data. With circular the
+    data are angles in radians and wrapping from 2*pi to 0 isn't a jump.
+    streamfilter.StreamFilter gives the same output one sample at a time.
     """
+    from scipy.ndimage import median_filter
+    if circular:
+        filtered_data = circular_moving_average(data, moving_avg_window_size)
+        filtered_data = median_filter(np.unwrap(filtered_data), size=median_filter_size)
+        return np.mod(filtered_data, 2*np.pi)
     filtered_data = moving_average(data, moving_avg_window_size)
     filtered_data = median_filter(filtered_data, size=median_filter_size)
     return filtered_data
 
-def preprocess_video_data(video_name, video=False, max_frames=900):
+def preprocess_video_data(video_name, video=False, max_frames=900, port='COM5', mode="thread", cache=None, record=None,
+                          deflicker=False, overlay=None, baudrate=500000, engine="farneback", window=2,
+                          protocol='raw'):
     """
-    Process and compute both ESP32 and OpenCV flow data.
+    Process and compute both ESP32 and OpenCV flow data. record=<path> logs
+    the serial session, port="replay:<path>" runs against a logged one.
+    deflicker=True evens out the brightness of the frames sent to the ESP32.
+    overlay=<path> writes the video with the OpenCV flow drawn on it, without
+    a display. engine picks the OpenCV reference (opencvlk.REFERENCE_ENGINES).
+    window and protocol set the frames in flight and the protocol of the link.
     """
-    # Process the video file and send frames to ESP32
-    flowListESP = processdata(video_name, max_frames)
+    from framesource import VideoFrameSource, run_consumers, video_fps
+    from opencvlk import FARNEBACK_PARAMS, flowReferenceFrames as validate
+    from preprocess import BLUR_HALO, BLUR_KERNEL, process_frames, process_frames_with_stack
+
+    full_frames = video or overlay is not None
+    # Look up the preprocessed frames and the OpenCV trace in the cache, the
+    # preview and overlay need the decoded video so they always run without the cache
+    stack = flowListOfMagAndAngOpenCV = None
+    if cache is not None and not full_frames:
+        src_path = os.path.join("src", video_name)
+        roi_key = cache.key(src_path, "roi", size=16, halo=BLUR_HALO, blur=BLUR_KERNEL, frames=max_frames,
+                            deflicker=deflicker, window=window, protocol=protocol)
+        if engine == "farneback":
+            reference_key = cache.key(src_path, "farneback-trace", window=8, params=FARNEBACK_PARAMS,
+                                      frames=max_frames)
+        else:
+            reference_key = cache.key(src_path, f"{engine}-trace", frames=max_frames)
+        stack = cache.load(roi_key)
+        flowListOfMagAndAngOpenCV = cache.load(reference_key)
+        if flowListOfMagAndAngOpenCV is not None:
+            flowListOfMagAndAngOpenCV = FlowTrace(data=flowListOfMagAndAngOpenCV)
+
+    # Decode the video once and feed the same frames to the OpenCV Farneback
+    # validation and to the ESP32, mode "process" runs each in its own process.
+    # Unless the preview is shown only the centre of each frame is kept
+    consumers = {}
+    results = {}
+    if flowListOfMagAndAngOpenCV is None:
+        consumers["opencv"] = partial(validate, engine=engine, showVid=video, overlay=overlay,
+                                      fps=video_fps(video_name) if overlay else 30.0)
+    if stack is None:
+        consumers["esp"] = partial(process_frames_with_stack, port=port, baudrate=baudrate, window=window,
+                                   protocol=protocol, record=record, deflicker=deflicker)
+    if consumers:
+        frames = VideoFrameSource(video_name, max_frames, roi_size=None if full_frames else 16, halo=BLUR_HALO)
+        results = dict(zip(consumers, run_consumers(frames, list(consumers.values()), mode)))
+
+    if "opencv" in results:
+        flowListOfMagAndAngOpenCV = results["opencv"]
+        if cache is not None and not full_frames:
+            cache.store(reference_key, flowListOfMagAndAngOpenCV.data, cache.video_hash(src_path), engine)
+
+    if stack is None:
+        flowListESP, stack = results["esp"]
+        if cache is not None and not full_frames:
+            cache.store(roi_key, stack, cache.video_hash(src_path), "roi")
+    else:
+        # Frames come straight from the cache, nothing is decoded
+        flowListESP = process_frames(stack, port=port, baudrate=baudrate, window=window, preprocess=False,
+                                     protocol=protocol, record=record)
 
-    # Validate the optical flow vectors using OpenCV Farneback method
-    flowListOfMagAndAngOpenCV = validate(video_name, max_frames, video)
+    # Keep only the frames both sides produced a sample for
+    flowListESP, flowListOpenCV = flowListESP.valid().align(flowListOfMagAndAngOpenCV.valid())
 
     # Compute magnitudes and angles for ESP32 data
     magnitudeESP, angleESP = compute_magnitude_and_angle(flowListESP)
 
-    # Extract magnitudes and angles from OpenCV data
-    magnitudeOpenCV = np.array([item[0] for item in flowListOfMagAndAngOpenCV])
-    angleOpenCV = np.array([item[1] for item in flowListOfMagAndAngOpenCV])
+    # Magnitudes and angles of the OpenCV data
+    magnitudeOpenCV = flowListOpenCV.magnitude
+    angleOpenCV = flowListOpenCV.angle
 
     # Filter magnitudes and angles
     magnitudeESP = filter_data(magnitudeESP)
-    angleESP = filter_data(angleESP)
+    angleESP = filter_data(angleESP, circular=True)
     magnitudeOpenCV = filter_data(magnitudeOpenCV)
-    angleOpenCV = filter_data(angleOpenCV)
+    angleOpenCV = filter_data(angleOpenCV, circular=True)
 
-    # Truncate or align lengths of both arrays
-    min_length = min(len(magnitudeESP), len(magnitudeOpenCV), len(angleESP), len(angleOpenCV))
-
-    # Make sure all arrays are the same length
-    magnitudeESP = magnitudeESP[:min_length]
-    magnitudeOpenCV = magnitudeOpenCV[:min_length]
-    angleESP = angleESP[:min_length]
-    angleOpenCV = angleOpenCV[:min_length]
+    # Both sides cover the same frames so the filtered arrays are the same length
+    min_length = len(magnitudeESP)
 
     return magnitudeESP, magnitudeOpenCV, angleESP, angleOpenCV, min_length
 
-def plot_data(time_axis, magnitudeESP, magnitudeOpenCV, angleESP, angleOpenCV):
+def plot_data(time_axis, magnitudeESP, magnitudeOpenCV, angleESP, angleOpenCV, save=None):
     """
-    Apply plotting for magnitudes and angles of optical flow vectors.
+    Apply plotting for magnitudes and angles of optical flow vectors. With
+    save the figures are written to <save>_magnitude.png and
+    <save>_angle.png instead of shown.
     """
+    import matplotlib.pyplot as plt
+
     # Plotting the magnitudes in a separate window
     plt.figure(figsize=(10, 6))
     plt.plot(time_axis, magnitudeESP, label="ESP32 Flow Magnitude (Filtered)", color='blue', alpha=0.7)
@@ -80,7 +159,7 @@ def plot_data(time_axis, magnitudeESP, magnitudeOpenCV, angleESP, angleOpenCV):
     plt.title("Comparison of Flow Vector Magnitudes")
     plt.legend()
     plt.grid(True)
-    plt.show()  # Show the first figure
+    _show(plt, save, "magnitude")  # Show the first figure
 
     # Plotting the angles in a separate window
     plt.figure(figsize=(10, 6))
@@ -91,19 +170,186 @@ def plot_data(time_axis, magnitudeESP, magnitudeOpenCV, angleESP, angleOpenCV):
     plt.title("Comparison of Flow Vector Angles")
     plt.legend()
     plt.grid(True)
-    plt.show()  # Show the second figure
+    _show(plt, save, "angle")  # Show the second figure
+
+def _show(plt, save, name):
+    if save is None:
+        plt.show()
+    else:
+        plt.savefig(f"{save}_{name}.png")
+        plt.close()
 
-def main():
+def run_command(args):
     """
-    Main function to run the flow processing, filtering, and plotting.
+    Run the flow processing, filtering, and plotting.
     """
-    video_name = "test.mp4"
-
     # Step 1: Preprocess the video data
-    magnitudeESP, magnitudeOpenCV, angleESP, angleOpenCV, min_length = preprocess_video_data(video_name, video=True)
-    
-    time_axis = np.arange(1, min_length + 1)
-    plot_data(time_axis, magnitudeESP, magnitudeOpenCV, angleESP, angleOpenCV)
+    magnitudeESP, magnitudeOpenCV, angleESP, angleOpenCV, min_length = preprocess_video_data(
+        args.video, video=args.show, max_frames=args.frames, port=args.port, mode=args.mode,
+        cache=None if args.no_cache else FlowCache(), record=args.record, deflicker=args.deflicker,
+        overlay=args.overlay, baudrate=args.baudrate, engine=args.engine, window=args.window,
+        protocol=args.protocol)
+    print(f"{min_length} frames compared")
+
+    if args.plots != "none":
+        time_axis = np.arange(1, min_length + 1)
+        plot_data(time_axis, magnitudeESP, magnitudeOpenCV, angleESP, angleOpenCV,
+                  save=None if args.plots == "show" else args.plots)
+
+def _esp_trace(args, port, record=None):
+    # The ESP32 path over the video, saved to args.output
+    import time
+    from preprocess import processdata
+    scheduler = None
+    if args.skip_threshold is not None or args.drop:
+        from framescheduler import FrameScheduler
+        scheduler = FrameScheduler(args.skip_threshold, drop=args.drop, max_fps=args.max_fps, fill=args.fill)
+    start = time.perf_counter()
+    trace = processdata(args.video, args.frames, args.window, port, args.baudrate, protocol=args.protocol,
+                        record=record, deflicker=args.deflicker, scheduler=scheduler)
+    elapsed = time.perf_counter() - start
+    answered = len(trace.valid())
+    print(f"{answered} vectors, {np.count_nonzero(trace.status == STATUS_FAILED)} failed, in {elapsed:.2f} s")
+    if scheduler is not None:
+        summary = scheduler.summary()
+        print(f"{summary['sent']} of {summary['frames']} frames sent, {summary['skipped']} skipped as static, "
+              f"{summary['dropped']} dropped")
+    if args.output:
+        trace.save(args.output)
+        print(f"Wrote {args.output}")
+    return trace
+
+def reference_command(args):
+    from opencvlk import flowReference
+    trace = flowReference(args.video, args.frames, args.engine, overlay=args.overlay)
+    print(f"{len(trace)} reference vectors")
+    trace.save(args.output)
+    print(f"Wrote {args.output}")
+
+def compare_command(args):
+    from evaluate import flow_errors
+    esp, reference = FlowTrace.load(args.esp).valid().align(FlowTrace.load(args.reference).valid())
+    metrics, _ = flow_errors(esp.uv, reference.uv, args.min_magnitude)
+    metrics["frames"] = len(esp)
+    print(json.dumps(metrics, indent=2))
+
+def record_command(args):
+    _esp_trace(args, args.port, record=args.session)
+
+def replay_command(args):
+    _esp_trace(args, ("replay-timed:" if args.timed else "replay:") + args.session)
+
+def bench_command(args):
+    import bench
+    return bench.main(args.bench_args)
+
+COMMANDS = {"run": run_command, "reference": reference_command, "compare": compare_command,
+            "record": record_command, "replay": replay_command, "bench": bench_command}
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="ESP32 optical flow against the OpenCV reference")
+    parser.add_argument("--config", help="JSON file of defaults for any flag, keyed by flag name")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def video_flags(sub):
+        sub.add_argument("--video", default="test.mp4", help="video in src/")
+        sub.add_argument("--frames", type=int, default=900, help="frames to read at most")
+
+    def engine_flag(sub):
+        sub.add_argument("--engine", default="farneback",
+                         help="OpenCV reference: farneback, dis-ultrafast, dis-fast, dis-medium or pyrlk")
+
+    def esp_flags(sub):
+        sub.add_argument("--port", default="COM5", help="serial port, emu or emu-baud for the emulator")
+        sub.add_argument("--baudrate", type=int, default=500000)
+        sub.add_argument("--window", type=int, default=2, help="frames in flight")
+        sub.add_argument("--protocol", choices=("raw", "framed"), default="raw")
+        sub.add_argument("--deflicker", action="store_true")
+
+    def scheduler_flags(sub):
+        sub.add_argument("--skip-threshold", type=float,
+                         help="skip frames whose mean absolute change from the last one sent is below this")
+        sub.add_argument("--drop", action="store_true", help="drop frames the link can't keep up with (live feeds)")
+        sub.add_argument("--max-fps", type=float, help="with --drop, send at most this many frames a second")
+        sub.add_argument("--fill", choices=("zero", "interpolate"), default="zero",
+                         help="flow given to frames that weren't sent")
+
+    run = commands.add_parser("run", help="ESP32 and OpenCV flow, filtered and plotted")
+    video_flags(run)
+    esp_flags(run)
+    engine_flag(run)
+    run.add_argument("--mode", choices=("thread", "process"), default="thread")
+    run.add_argument("--record", help="log the serial session to this file")
+    run.add_argument("--overlay", help="write the video with the OpenCV flow drawn on it here")
+    run.add_argument("--show", action="store_true", help="preview the OpenCV flow while it runs")
+    run.add_argument("--no-cache", action="store_true")
+    run.add_argument("--plots", default="show", help="show, none or a prefix to save <prefix>_magnitude.png ...")
+
+    reference = commands.add_parser("reference", help="OpenCV Farneback reference trace")
+    video_flags(reference)
+    engine_flag(reference)
+    reference.add_argument("--overlay", help="write the video with the flow drawn on it here")
+    reference.add_argument("--output", default="reference.npy")
+
+    compare = commands.add_parser("compare", help="error metrics between two saved traces")
+    compare.add_argument("esp")
+    compare.add_argument("reference")
+    compare.add_argument("--min-magnitude", type=float, default=0.1,
+                         help="shortest vectors, in pixels, whose angle is compared")
+
+    record = commands.add_parser("record", help="ESP32 path, logging the serial session")
+    video_flags(record)
+    esp_flags(record)
+    scheduler_flags(record)
+    record.add_argument("--session", default="flow.session")
+    record.add_argument("--output", help="save the trace here")
+
+    replay = commands.add_parser("replay", help="ESP32 path against a recorded session")
+    video_flags(replay)
+    esp_flags(replay)
+    scheduler_flags(replay)
+    replay.add_argument("session")
+    replay.add_argument("--timed", action="store_true", help="at the recorded timing")
+    replay.add_argument("--output", help="save the trace here")
+
+    bench = commands.add_parser("bench", help="bench.py, flags after the command go to it", add_help=False)
+    bench.add_argument("bench_args", nargs=argparse.REMAINDER)
+    return parser, commands
+
+def parse_args(argv=None):
+    """
+    Command line arguments, with defaults from --config where the command
+    line doesn't set them.
+    """
+    parser, commands = build_parser()
+    config_parser = argparse.ArgumentParser(add_help=False)
+    config_parser.add_argument("--config")
+    known, _ = config_parser.parse_known_args(argv)
+    if known.config:
+        with open(known.config) as f:
+            config = json.load(f)
+        if not isinstance(config, dict):
+            parser.error(f"{known.config} must hold a JSON object")
+        flags = {action.dest for sub in commands.choices.values() for action in sub._actions}
+        unknown = sorted(set(config) - flags)
+        if unknown:
+            parser.error(f"Unknown settings in {known.config}: {', '.join(unknown)}")
+        for sub in commands.choices.values():
+            sub.set_defaults(**{k: v for k, v in config.items()
+                                if any(action.dest == k for action in sub._actions)})
+    args, extra = parser.parse_known_args(argv)
+    if args.command == "bench":
+        args.bench_args = extra + args.bench_args  # bench.py parses its own flags
+    elif extra:
+        parser.error(f"unrecognized arguments: {' '.join(extra)}")
+    return args
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not any(arg in COMMANDS or arg in ("-h", "--help") for arg in argv):
+        argv = argv + ["run"]  # Plain python main.py runs the comparison as before
+    args = parse_args(argv)
+    return COMMANDS[args.command](args)
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
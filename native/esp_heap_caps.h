@@ -0,0 +1,18 @@
+/** @file esp_heap_caps.h
+*   Host stand-in for the ESP-IDF heap capabilities API, the archived sources
+*   only fall back to it when malloc fails so plain malloc is enough.
+*/
+
+#ifndef ESP_HEAP_CAPS_H
+#define ESP_HEAP_CAPS_H
+
+#include <stdlib.h>
+
+#define MALLOC_CAP_8BIT   (1 << 2)
+#define MALLOC_CAP_SPIRAM (1 << 10)
+
+#define heap_caps_malloc(size, caps) malloc(size)
+#define heap_caps_calloc(n, size, caps) calloc(n, size)
+#define heap_caps_free(ptr) free(ptr)
+
+#endif
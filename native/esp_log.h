@@ -0,0 +1,15 @@
+/** @file esp_log.h
+*   Host stand-in for ESP-IDF logging, errors and warnings go to stderr.
+*/
+
+#ifndef ESP_LOG_H
+#define ESP_LOG_H
+
+#include <stdio.h>
+
+#define ESP_LOGE(tag, fmt, ...) fprintf(stderr, "E (%s) " fmt "\n", tag, ##__VA_ARGS__)
+#define ESP_LOGW(tag, fmt, ...) fprintf(stderr, "W (%s) " fmt "\n", tag, ##__VA_ARGS__)
+#define ESP_LOGI(tag, fmt, ...) do { } while (0)
+#define ESP_LOGD(tag, fmt, ...) do { } while (0)
+
+#endif
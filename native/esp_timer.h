@@ -0,0 +1,19 @@
+/** @file esp_timer.h
+*   Host stand-in for the ESP-IDF high resolution timer.
+*/
+
+#ifndef ESP_TIMER_H
+#define ESP_TIMER_H
+
+#include <stdint.h>
+#include <time.h>
+
+/** @brief microseconds from a monotonic clock */
+static inline int64_t esp_timer_get_time(void)
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (int64_t)ts.tv_sec * 1000000 + ts.tv_nsec / 1000;
+}
+
+#endif
@@ -0,0 +1,59 @@
+/** @file motion_host.c
+*   Entry points for loading the archived motion estimation code from Python
+*   with ctypes, so the MotionEstContext layout stays on the C side.
+*/
+
+#include "motion.h"
+#include <string.h>
+
+/** @brief allocate and init a context
+*   @param method one of the motion.h algorithm selectors
+*   @param mbSize macro block size for block matching (rounded up to 2^n)
+*   @param search_param search range for block matching
+*   @return context or NULL
+*/
+MotionEstContext *me_create(int method, int width, int height, int mbSize, int search_param)
+{
+    MotionEstContext *ctx = calloc(1, sizeof(*ctx));
+    if (!ctx)
+        return NULL;
+    ctx->method = method;
+    ctx->width = width;
+    ctx->height = height;
+    ctx->mbSize = mbSize;
+    ctx->search_param = search_param;
+    if (!init_context(ctx)) {
+        free(ctx);
+        return NULL;
+    }
+    return ctx;
+}
+
+/** @brief run motion estimation of img_cur against img_prev */
+bool me_run(MotionEstContext *ctx, uint8_t *img_prev, uint8_t *img_cur)
+{
+    return motion_estimation(ctx, img_prev, img_cur);
+}
+
+/** @brief current motion vectors (mv_table[0]) */
+MotionVector16_t *me_vectors(MotionEstContext *ctx)
+{
+    return ctx->mv_table[0];
+}
+
+/** @brief blocks per row, per column and max mag² of the last run */
+void me_layout(MotionEstContext *ctx, int *b_width, int *b_height, int *max)
+{
+    *b_width = ctx->b_width;
+    *b_height = ctx->b_height;
+    *max = ctx->max;
+}
+
+void me_destroy(MotionEstContext *ctx)
+{
+    if (!ctx)
+        return;
+    for (int i = 0; i < 3; i++)
+        free(ctx->mv_table[i]);
+    free(ctx);
+}
@@ -0,0 +1,131 @@
+import ctypes
+import os
+import subprocess
+import sys
+import numpy as np
+
+# Builds the archived motion estimation sources (archive/*.c) for the host and
+# runs them through ctypes. native/ holds stand-ins for the ESP-IDF headers and
+# motion_host.c, the small entry points used from here.
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+ARCHIVE_DIR = os.path.join(ROOT, "archive")
+NATIVE_DIR = os.path.join(ROOT, "native")
+BUILD_DIR = os.path.join(NATIVE_DIR, "build")
+SOURCES = [os.path.join(ARCHIVE_DIR, name) for name in
+           ("motion.c", "lucas_kanade_opitcal_flow.c", "block_matching.c", "epzs.c", "convolution.c")]
+SOURCES.append(os.path.join(NATIVE_DIR, "motion_host.c"))
+LIBRARY = os.path.join(BUILD_DIR, "libmotion.dll" if sys.platform == "win32" else "libmotion.so")
+
+# Algorithm selectors from motion.h
+LK_OPTICAL_FLOW = 1
+BLOCK_MATCHING_ARPS = 2
+BLOCK_MATCHING_EPZS = 3
+
+# MotionVector16_t
+MOTION_VECTOR = np.dtype([("vx", np.int16), ("vy", np.int16), ("mag2", np.uint16)])
+
+_library = None
+
+
+def build_library(force=False, cc=None):
+    """
+    Compile the shared library unless it is newer than every source.
+    """
+    headers = [os.path.join(d, f) for d in (ARCHIVE_DIR, NATIVE_DIR) for f in os.listdir(d) if f.endswith(".h")]
+    if not force and os.path.exists(LIBRARY):
+        built = os.path.getmtime(LIBRARY)
+        if all(os.path.getmtime(src) <= built for src in SOURCES + headers):
+            return LIBRARY
+    os.makedirs(BUILD_DIR, exist_ok=True)
+    cc = cc or os.environ.get("CC", "cc")
+    command = [cc, "-O2", "-shared", "-fPIC", "-I" + NATIVE_DIR, "-I" + ARCHIVE_DIR, *SOURCES, "-o", LIBRARY, "-lm"]
+    subprocess.run(command, check=True)
+    return LIBRARY
+
+
+def load_library():
+    global _library
+    if _library is None:
+        lib = ctypes.CDLL(build_library())
+        lib.me_create.restype = ctypes.c_void_p
+        lib.me_create.argtypes = [ctypes.c_int] * 5
+        lib.me_run.restype = ctypes.c_bool
+        lib.me_run.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+        lib.me_vectors.restype = ctypes.c_void_p
+        lib.me_vectors.argtypes = [ctypes.c_void_p]
+        lib.me_layout.restype = None
+        lib.me_layout.argtypes = [ctypes.c_void_p] + [ctypes.POINTER(ctypes.c_int)] * 3
+        lib.me_destroy.restype = None
+        lib.me_destroy.argtypes = [ctypes.c_void_p]
+        _library = lib
+    return _library
+
+
+class NativeMotionEngine:
+    """
+    One MotionEstContext for frames of a fixed size. Calling it with two
+    grayscale uint8 frames returns the motion field as an (rows, cols, 2)
+    float32 array of (u, v), per pixel for LK and per block for ARPS/EPZS.
+
+    Contiguous uint8 frames are passed to C without copying and the result is
+    read straight out of the context's mv_table. The vectors are the integer
+    values the archived code produces. Block matching gives the offset of the
+    matching block in the previous frame, so it is negated to point along the
+    motion like the dense engines, and ARPS stores it as (dy, dx) so it is
+    swapped back to (u, v) as well.
+
+    EPZS predicts from the vectors of the previous two calls, so keep one
+    engine per stream of frames.
+    """
+
+    def __init__(self, method, width, height, block_size=8, search_param=7):
+        self.lib = load_library()
+        self.method = method
+        self.width = width
+        self.height = height
+        self.ctx = self.lib.me_create(method, width, height, block_size, search_param)
+        if not self.ctx:
+            raise RuntimeError("init_context failed")
+        b_width, b_height, max_mag2 = ctypes.c_int(), ctypes.c_int(), ctypes.c_int()
+        self.lib.me_layout(self.ctx, ctypes.byref(b_width), ctypes.byref(b_height), ctypes.byref(max_mag2))
+        self.shape = (height, width) if method == LK_OPTICAL_FLOW else (b_height.value, b_width.value)
+        self.block_size = 1 if method == LK_OPTICAL_FLOW else width // max(b_width.value, 1)
+        count = self.shape[0] * self.shape[1]
+        buffer = (ctypes.c_uint8 * (count * MOTION_VECTOR.itemsize)).from_address(self.lib.me_vectors(self.ctx))
+        self.vectors = np.frombuffer(buffer, dtype=MOTION_VECTOR).reshape(self.shape)
+
+    def __call__(self, prev, cur):
+        prev = np.ascontiguousarray(prev, dtype=np.uint8)
+        cur = np.ascontiguousarray(cur, dtype=np.uint8)
+        if prev.shape != (self.height, self.width) or cur.shape != prev.shape:
+            raise ValueError(f"frames must be {self.height}x{self.width} grayscale")
+        if self.method == LK_OPTICAL_FLOW:
+            # LK only writes pixels above its noise threshold, don't keep the last pair's
+            self.vectors.fill(0)
+        if not self.lib.me_run(self.ctx, prev.ctypes.data, cur.ctypes.data):
+            raise RuntimeError("motion_estimation failed")
+        flow = np.empty(self.shape + (2,), dtype=np.float32)
+        if self.method == BLOCK_MATCHING_ARPS:
+            np.negative(self.vectors["vy"], out=flow[..., 0], casting="unsafe")
+            np.negative(self.vectors["vx"], out=flow[..., 1], casting="unsafe")
+        elif self.method == BLOCK_MATCHING_EPZS:
+            np.negative(self.vectors["vx"], out=flow[..., 0], casting="unsafe")
+            np.negative(self.vectors["vy"], out=flow[..., 1], casting="unsafe")
+        else:
+            flow[..., 0] = self.vectors["vx"]
+            flow[..., 1] = self.vectors["vy"]
+        return flow
+
+    def close(self):
+        if self.ctx:
+            self.lib.me_destroy(self.ctx)
+            self.ctx = None
+            self.vectors = None
+
+    def __del__(self):
+        self.close()
+
+
+if __name__ == "__main__":
+    print(build_library(force="--force" in sys.argv))
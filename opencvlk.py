@@ -1,96 +1,381 @@
 import numpy as np
 import cv2 as cv
-import matplotlib.pyplot as plt
 import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from flowtrace import FlowTrace
+from framesource import VideoFrameSource, video_fps, video_frames
+from overlay import OverlayRenderer, open_overlay
 
+# pyr_scale, levels, winsize, iterations, poly_n, poly_sigma, flags of the centre window reference
+FARNEBACK_PARAMS = (0.5, 3, 5, 3, 5, 1.2, 0)
 
-def flowFarneback(videotitle,datacount,showVid):
-    # Open the video stream
-    path = os.path.join("src", videotitle)
-    cap = cv.VideoCapture(path)
+# Window, pyramid levels above the full frame and stopping criteria of the sparse tracker
+LK_WINDOW = (15, 15)
+LK_LEVELS = 3
+LK_CRITERIA = (cv.TERM_CRITERIA_EPS | cv.TERM_CRITERIA_COUNT, 30, 0.01)
+
+
+# Reference engines for the centre window of the frames, called with the
+# previous and current grayscale window (window x window pixels) and returning
+# (u, v) at the centre of the window and the dense flow over it, None for
+# engines that only compute the centre. One instance runs a whole video.
+class FarnebackReference:
+    window = 8
+
+    def __init__(self, params=FARNEBACK_PARAMS):
+        self.params = params
+
+    def __call__(self, prev, cur):
+        flow = cv.calcOpticalFlowFarneback(prev, cur, None, *self.params)
+        # Since (8,8) is in the middle of the 8x8 window it's at (4,4) in the array
+        return flow[4, 4, 0], flow[4, 4, 1], flow
+
+
+DIS_PRESETS = {"ultrafast": cv.DISOPTICAL_FLOW_PRESET_ULTRAFAST, "fast": cv.DISOPTICAL_FLOW_PRESET_FAST,
+               "medium": cv.DISOPTICAL_FLOW_PRESET_MEDIUM}
+
+
+class DISReference:
+    window = 16  # DIS wants a side of at least 16 pixels
+
+    def __init__(self, preset="fast"):
+        self.dis = cv.DISOpticalFlow_create(DIS_PRESETS[preset])
+
+    def __call__(self, prev, cur):
+        flow = self.dis.calc(prev, cur, None)
+        centre = self.window // 2
+        return flow[centre, centre, 0], flow[centre, centre, 1], flow
+
+
+class PyrLKReference:
+    window = 16
+
+    # Window and levels of archive/validation.py, which tracked (8, 8) of the 16x16 frames
+    def __init__(self, win_size=(5, 5), levels=2):
+        self.win_size = win_size
+        self.levels = levels
+        self.point = np.array([[[self.window // 2, self.window // 2]]], dtype=np.float32)
+
+    def __call__(self, prev, cur):
+        moved, status, _ = cv.calcOpticalFlowPyrLK(prev, cur, self.point, None, winSize=self.win_size,
+                                                   maxLevel=self.levels)
+        if status[0, 0] != 1:
+            return np.nan, np.nan, None
+        u, v = moved[0, 0] - self.point[0, 0]
+        return u, v, None
+
+
+REFERENCE_ENGINES = {
+    "farneback": FarnebackReference,
+    "dis-ultrafast": partial(DISReference, "ultrafast"),
+    "dis-fast": partial(DISReference, "fast"),
+    "dis-medium": partial(DISReference, "medium"),
+    "pyrlk": PyrLKReference,
+}
+
+
+def reference_engine(name):
+    if name not in REFERENCE_ENGINES:
+        raise ValueError(f"Unknown reference engine {name!r}, expected one of {sorted(REFERENCE_ENGINES)}")
+    return REFERENCE_ENGINES[name]()
+
+
+def flowReference(videotitle, datacount, engine="farneback", showVid=False, overlay=None):
+    # Open the video stream, without the preview or overlay only the centre window is needed
+    window = reference_engine(engine).window
+    frames = VideoFrameSource(videotitle, datacount, roi_size=None if showVid or overlay else window)
+    return flowReferenceFrames(frames, engine, showVid, overlay, video_fps(videotitle))
+
+
+def flowFarneback(videotitle,datacount,showVid,overlay=None):
+    return flowReference(videotitle, datacount, "farneback", showVid, overlay)
+
+
+# Runs a reference engine (a name in REFERENCE_ENGINES) over an iterable of BGR
+# frames and returns a FlowTrace of the (u, v) at the centre for every pair,
+# frame being the position of the second frame of the pair so it lines up with
+# the ESP32 flow vectors. overlay (an overlay.OverlayWriter or a video path
+# written at fps) records the frames with the flow in the window drawn on them
+# without a display, showVid shows them as they go
+def flowReferenceFrames(frames, engine="farneback", showVid=False, overlay=None, fps=30.0):
+    name = engine
+    engine = reference_engine(name)
+    frames = iter(frames)
 
     # Read the first frame
-    ret, frame1 = cap.read()
-    if not ret:
+    frame1 = next(frames, None)
+    if frame1 is None:
         print('No frames grabbed!')
-        exit()
-
-    # Convert the first frame to grayscale
-    prvs = cv.cvtColor(frame1, cv.COLOR_BGR2GRAY)
+        return FlowTrace()
 
     # Get the center of the frame and define the size of the window
-    frame_height, frame_width = prvs.shape
+    frame_height, frame_width = frame1.shape[:2]
     center = (frame_width // 2, frame_height // 2)
-    window_size = 8  # 8x8 center window
+    window_size = engine.window
+    if frame_width < window_size or frame_height < window_size:
+        raise ValueError(f"{frame_width}x{frame_height} frames are smaller than the {window_size}x{window_size} "
+                         f"window of {name}")
 
-    # Define the region of interest (ROI) as a 8x8 window around the center
+    # Define the region of interest (ROI) as a window around the center
     roi_top_left = (center[0] - window_size // 2, center[1] - window_size // 2)
     roi_bottom_right = (center[0] + window_size // 2, center[1] + window_size // 2)
+    roi = (slice(roi_top_left[1], roi_bottom_right[1]), slice(roi_top_left[0], roi_bottom_right[0]))
 
-    # List to store magnitudes at pixel (8, 8) of each frame
-    magnitude_angle_at_8_8 =[]
-    isFirst = True
-    while len(magnitude_angle_at_8_8) < datacount-5:
-        # Read the next frame
-        ret, frame2 = cap.read()
-        if not ret:
-            print('No frames grabbed!')
-            break
-        
-        # Convert the frame to grayscale
-        next_frame = cv.cvtColor(frame2, cv.COLOR_BGR2GRAY)
-        if isFirst:
-            isFirst = False
-            prvs = next_frame
-            continue
-        # Extract the 8x8 window (ROI) from the center of both current and previous frames
-        prvs_roi = prvs[roi_top_left[1]:roi_bottom_right[1], roi_top_left[0]:roi_bottom_right[0]]
-        next_roi = next_frame[roi_top_left[1]:roi_bottom_right[1], roi_top_left[0]:roi_bottom_right[0]]
-
-        # Calculate optical flow using Farneback method on the 8x8 window
-        flow = cv.calcOpticalFlowFarneback(prvs_roi, next_roi, None, 0.5, 3, 5, 3, 5, 1.2, 0)
-
-        # Convert flow to magnitude and angle
-        mag, ang = cv.cartToPolar(flow[..., 0], flow[..., 1])
-
-        # Get the magnitude at position (8,8) within the 8x8 region (corresponding to index (4,4) in the flow array)
-        magnitude_at_8_8 = mag[4, 4]  # Since (8,8) is in the middle of the 8x8 window, it's at (4,4) in the array
-        angle_at_8_8 = ang[4, 4]  
-        
-        # Store the magnitude at (8, 8)
-        magnitude_angle_at_8_8.append((magnitude_at_8_8, angle_at_8_8))
+    # Only the window is converted to grayscale
+    prvs_roi = cv.cvtColor(frame1[roi], cv.COLOR_BGR2GRAY)
+
+    # The window is coloured by its flow in a copy of the frame, or has an
+    # arrow at its centre for engines without dense flow
+    writer, owned = open_overlay(overlay, fps)
+    renderer = OverlayRenderer(roi)
+    preview = np.empty_like(frame1) if showVid else None
+    centre_point = np.array([center], dtype=np.float32)
+
+    def render(frame, dst, u, v, flow):
+        if flow is not None:
+            return renderer.render(frame, dst, flow=flow)
+        return renderer.render(frame, dst, points=centre_point, vectors=np.array([[u, v]], dtype=np.float32))
+
+    # Flow at the centre of each frame
+    flow_at_centre = FlowTrace()
+    try:
+        for frame_count, frame2 in enumerate(frames, start=1):
+            # Extract the window (ROI) from the center of the frame and convert it to grayscale
+            next_roi = cv.cvtColor(frame2[roi], cv.COLOR_BGR2GRAY)
+
+            # Calculate optical flow on the window
+            u, v, flow = engine(prvs_roi, next_roi)
+            if np.isnan(u):
+                flow_at_centre.failed(frame_count)
+            else:
+                flow_at_centre.append(frame_count, u, v)
+            if writer is not None:
+                # Dropped if the encoder is behind
+                buffer = writer.acquire(frame2.shape)
+                if buffer is not None:
+                    writer.submit(render(frame2, buffer, u, v, flow))
+            if showVid:
+                # Display the result (optional)
+                cv.imshow(f'Optical Flow in {window_size}x{window_size} Window', render(frame2, preview, u, v, flow))
+
+                # Exit on 'ESC' or save image on 's'
+                k = cv.waitKey(1) & 0xff
+                if k == 27:  # ESC key
+                    break
+                elif k == ord('s'):  # 's' key to save image
+                    cv.imwrite('opticalfb_window.png', cv.cvtColor(frame2, cv.COLOR_BGR2GRAY))
+                    cv.imwrite('opticalhsv_window.png', preview)
+
+            # Update previous frame for next iteration
+            prvs_roi = next_roi
+    finally:
+        # Cleanup
+        if owned:
+            writer.close()
         if showVid:
-            # Optional: Visualization code to show optical flow
-            hsv_small = np.zeros((window_size, window_size, 3), dtype=np.uint8)
-            hsv_small[..., 0] = ang * 180 / np.pi / 2  # Angle as hue
-            hsv_small[..., 2] = cv.normalize(mag, None, 0, 255, cv.NORM_MINMAX)  # Magnitude as value
-            hsv_small[..., 1] = 255  # Full saturation
-
-            # Convert HSV to BGR for visualization
-            hsv = np.zeros_like(frame2)
-            hsv[..., 1] = 255  # Set saturation to 255 for full saturation
-            hsv[roi_top_left[1]:roi_bottom_right[1], roi_top_left[0]:roi_bottom_right[0]] = hsv_small
-            bgr = cv.cvtColor(hsv, cv.COLOR_HSV2BGR)
-
-            # Overlay the optical flow visualization on the original frame
-            frame2_copy = frame2.copy()
-            frame2_copy[roi_top_left[1]:roi_bottom_right[1], roi_top_left[0]:roi_bottom_right[0]] = bgr[roi_top_left[1]:roi_bottom_right[1], roi_top_left[0]:roi_bottom_right[0]]
-            
-            # Display the result (optional)
-            cv.imshow('Optical Flow in 8x8 Window', frame2_copy)
-
-            # Wait for key press, exit on 'ESC' or save image on 's'
-            k = cv.waitKey(30) & 0xff
-            if k == 27:  # ESC key
-                break
-            elif k == ord('s'):  # 's' key to save image
-                cv.imwrite('opticalfb_window.png', next_frame)
-                cv.imwrite('opticalhsv_window.png', bgr)
-
-        # Update previous frame for next iteration
-        prvs = next_frame
-
-    # Cleanup
+            cv.destroyAllWindows()
+    return flow_at_centre
+
+
+# flowReferenceFrames with Farneback on the centre 8x8 window
+def flowFarnebackFrames(frames,showVid,overlay=None,fps=30.0):
+    return flowReferenceFrames(frames, "farneback", showVid, overlay, fps)
+
+
+# Centres of a cols x rows grid of cells covering a width x height frame as (x, y)
+def grid_points(width, height, grid=(8, 6)):
+    cols, rows = grid
+    xs = (np.arange(cols) + 0.5) * width / cols
+    ys = (np.arange(rows) + 0.5) * height / rows
+    x, y = np.meshgrid(xs, ys)
+    return np.stack([x.ravel(), y.ravel()], axis=1).astype(np.float32)
+
+
+# Runs Farneback once per frame pair and samples (u, v) in full resolution
+# pixels at every grid point. Returns a (pairs, points, 2) array where row k is
+# the pair ending at frame k + 1, and the (points, 2) grid point coordinates.
+#
+# mode "downscale" computes flow on the whole frame resized by scale.
+# mode "roi" cuts a roi_size square around every point, tiles them into one
+# mosaic with a gutter between tiles and computes flow on the mosaic.
+# overlay (an overlay.OverlayWriter or a video path written at fps) records
+# the frames with an arrow at every grid point.
+def flowFarnebackGrid(frames, grid=(8, 6), mode="downscale", scale=0.25, roi_size=24, overlay=None, fps=30.0):
+    frames = iter(frames)
+    frame1 = next(frames, None)
+    if frame1 is None:
+        print('No frames grabbed!')
+        return np.zeros((0, grid[0] * grid[1], 2), dtype=np.float32), np.zeros((0, 2), dtype=np.float32)
+
+    frame_height, frame_width = frame1.shape[:2]
+    points = grid_points(frame_width, frame_height, grid)
+
+    if mode == "downscale":
+        size = (max(int(round(frame_width * scale)), 1), max(int(round(frame_height * scale)), 1))
+        sx = np.minimum((points[:, 0] * size[0] / frame_width).astype(int), size[0] - 1)
+        sy = np.minimum((points[:, 1] * size[1] / frame_height).astype(int), size[1] - 1)
+        to_full = np.array([frame_width / size[0], frame_height / size[1]], dtype=np.float32)
+        params = (0.5, 3, 15, 3, 5, 1.2, 0)
+
+        def prepare(frame):
+            gray = cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+            return cv.resize(gray, size, interpolation=cv.INTER_AREA)
+    elif mode == "roi":
+        # Tiles sit side by side in a row per grid row, gutter replicates edges
+        gutter = max(roi_size // 6, 2)
+        cols, rows = grid
+        tile = roi_size + 2 * gutter
+        half = roi_size // 2
+        cx = np.clip(points[:, 0].astype(int), half, frame_width - half)
+        cy = np.clip(points[:, 1].astype(int), half, frame_height - half)
+        tiles = [(y - half, x - half) for x, y in zip(cx, cy)]
+        sx = np.tile(np.arange(cols) * tile + gutter + half, rows)
+        sy = np.repeat(np.arange(rows) * tile + gutter + half, cols)
+        to_full = np.array([1, 1], dtype=np.float32)
+        params = (0.5, 2, 9, 3, 5, 1.1, 0)
+        mosaic_bgr = np.zeros((rows * roi_size, cols * roi_size, 3), dtype=frame1.dtype)
+
+        def prepare(frame):
+            for i, (y0, x0) in enumerate(tiles):
+                r, c = divmod(i, cols)
+                mosaic_bgr[r * roi_size:(r + 1) * roi_size, c * roi_size:(c + 1) * roi_size] = \
+                    frame[y0:y0 + roi_size, x0:x0 + roi_size]
+            gray = cv.cvtColor(mosaic_bgr, cv.COLOR_BGR2GRAY)
+            # Give each tile its own border so flow doesn't leak between tiles
+            tiles_gray = gray.reshape(rows, roi_size, cols, roi_size).transpose(0, 2, 1, 3)
+            padded = np.pad(tiles_gray, ((0, 0), (0, 0), (gutter, gutter), (gutter, gutter)), mode="edge")
+            return np.ascontiguousarray(padded.transpose(0, 2, 1, 3).reshape(rows * tile, cols * tile))
+    else:
+        raise ValueError(f"Unknown mode {mode!r}, expected 'downscale' or 'roi'")
+
+    samples = []
+    prvs = prepare(frame1)
+    flow = None
+    writer, owned = open_overlay(overlay, fps)
+    renderer = OverlayRenderer()
+    try:
+        for frame2 in frames:
+            next_frame = prepare(frame2)
+            flow = cv.calcOpticalFlowFarneback(prvs, next_frame, flow, *params)
+            samples.append(flow[sy, sx] * to_full)
+            prvs = next_frame
+            if writer is not None:
+                buffer = writer.acquire(frame2.shape)
+                if buffer is not None:
+                    writer.submit(renderer.render(frame2, buffer, points=points, vectors=samples[-1]))
+    finally:
+        if owned:
+            writer.close()
+
+    if not samples:
+        return np.zeros((0, len(points), 2), dtype=np.float32), points
+    return np.stack(samples).astype(np.float32), points
+
+
+# Fills the free (NaN) slots of points with corners of gray at least
+# min_distance away from the points already tracked
+def _detect_points(gray, points, quality, min_distance):
+    free = np.flatnonzero(np.isnan(points[:, 0]))
+    if not len(free):
+        return
+    mask = np.full(gray.shape, 255, dtype=np.uint8)
+    for x, y in points[~np.isnan(points[:, 0])]:
+        cv.circle(mask, (int(x), int(y)), min_distance, 0, -1)
+    corners = cv.goodFeaturesToTrack(gray, len(free), quality, min_distance, mask=mask)
+    if corners is not None:
+        corners = corners.reshape(-1, 2)
+        points[free[:len(corners)]] = corners
+
+
+# Tracks up to max_points corners at full resolution with pyramidal Lucas
+# Kanade, each frame converted to grayscale once for both pairs it is part of
+# and the points carried from pair to pair. Points the tracker loses (or that
+# leave the frame) are replaced by new corners once fewer than
+# redetect * max_points are left. OpenCV's Python binding doesn't take the
+# pyramids of cv.buildOpticalFlowPyramid back, and tracking level by level on
+# pyramids kept from the previous pair is slower than letting
+# calcOpticalFlowPyrLK build them, so it does. Returns the
+# (pairs, max_points, 2) flow (u, v) of every point slot, row k being the pair
+# ending at frame k + 1, and the (pairs, max_points, 2) positions (x, y) they
+# start from in the first frame of the pair, both NaN where a slot has no point.
+def trackPyrLK(frames, max_points=300, win_size=LK_WINDOW, levels=LK_LEVELS, quality=0.01, min_distance=8,
+               redetect=0.9):
+    frames = iter(frames)
+    frame1 = next(frames, None)
+    if frame1 is None:
+        print('No frames grabbed!')
+        empty = np.zeros((0, max_points, 2), dtype=np.float32)
+        return empty, empty.copy()
+
+    prev_gray = cv.cvtColor(frame1, cv.COLOR_BGR2GRAY)
+    height, width = prev_gray.shape
+    points = np.full((max_points, 2), np.nan, dtype=np.float32)
+    _detect_points(prev_gray, points, quality, min_distance)
+
+    flows = []
+    starts = []
+    for frame2 in frames:
+        gray = cv.cvtColor(frame2, cv.COLOR_BGR2GRAY)
+        flow = np.full((max_points, 2), np.nan, dtype=np.float32)
+        starts.append(points.copy())
+        alive = np.flatnonzero(~np.isnan(points[:, 0]))
+        if len(alive):
+            moved, status, _ = cv.calcOpticalFlowPyrLK(prev_gray, gray, points[alive].reshape(-1, 1, 2), None,
+                                                       winSize=win_size, maxLevel=levels, criteria=LK_CRITERIA)
+            moved = moved.reshape(-1, 2)
+            tracked = (status.ravel() == 1) & (moved[:, 0] >= 0) & (moved[:, 0] < width) \
+                & (moved[:, 1] >= 0) & (moved[:, 1] < height)
+            flow[alive[tracked]] = moved[tracked] - points[alive[tracked]]
+            points[alive[tracked]] = moved[tracked]
+            points[alive[~tracked]] = np.nan
+        if np.count_nonzero(~np.isnan(points[:, 0])) < redetect * max_points:
+            _detect_points(gray, points, quality, min_distance)
+        flows.append(flow)
+        prev_gray = gray
+
+    if not flows:
+        empty = np.zeros((0, max_points, 2), dtype=np.float32)
+        return empty, empty.copy()
+    return np.stack(flows), np.stack(starts)
+
+
+# Reference flow for frames start..stop - 1 of a video, each sample labelled
+# with its frame number in the whole video. The segment starts one frame early
+# so the pair ending at its first frame isn't lost at the boundary.
+def _farneback_segment(videotitle, grid, bounds):
+    start, stop = bounds
+    first = max(start - 1, 0)
+    if grid is None:
+        frames = video_frames(videotitle, stop - first, roi_size=8, start=first)
+        trace = flowFarnebackFrames(frames, False)
+        trace.frame[:] += first
+        return trace
+    frames = video_frames(videotitle, stop - first, start=first)
+    return flowFarnebackGrid(frames, grid)[0]
+
+
+# Splits the first datacount frames into segments and computes the reference
+# flow for each segment in a process pool. Results come back stitched in frame
+# order, the same FlowTrace as flowFarneback gives or with grid the same array as
+# flowFarnebackGrid gives.
+def flowFarnebackSharded(videotitle, datacount, workers=None, segment_size=None, grid=None):
+    cap = cv.VideoCapture(os.path.join("src", videotitle))
+    frame_total = int(cap.get(cv.CAP_PROP_FRAME_COUNT))
     cap.release()
-    cv.destroyAllWindows()
-    return magnitude_angle_at_8_8
+    # The frame count in the header is only a hint, the last segment reads to the end
+    total = min(datacount, frame_total) if frame_total > 0 else datacount
+
+    workers = workers or os.cpu_count() or 1
+    if segment_size is None:
+        segment_size = max(-(-total // (workers * 4)), 2)
+    starts = list(range(0, max(total, 1), segment_size))
+    bounds = [(start, start + segment_size) for start in starts]
+    bounds[-1] = (bounds[-1][0], datacount)
+
+    with ProcessPoolExecutor(workers) as pool:
+        segments = list(pool.map(partial(_farneback_segment, videotitle, grid), bounds))
+
+    if grid is None:
+        return FlowTrace.concatenate(segments)
+    return np.concatenate(segments)
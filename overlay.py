@@ -0,0 +1,151 @@
+import queue
+import threading
+import cv2 as cv
+import numpy as np
+
+# Headless rendering of the flow onto the video, for reviewing runs on
+# machines without a display. OverlayRenderer draws into a copy of the frame:
+# the flow in a region of interest as colour (hue is the angle, brightness the
+# magnitude, like the old preview) and arrows at sample points for multi-point
+# flow. OverlayWriter encodes the frames to a video on its own thread from a
+# fixed set of reused buffers. When the encoder falls behind the flow waits for
+# it, so a review of a video file has every frame; with drop=True (live feeds)
+# frames are dropped (and counted) rather than holding up the flow computation.
+#
+#   with OverlayWriter("review.mp4", fps=30) as writer:
+#       buffer = writer.acquire(frame.shape)
+#       if buffer is not None:
+#           writer.submit(renderer.render(frame, buffer, flow=flow))
+
+ARROW_SCALE = 4.0  # Arrow length in pixels per pixel of flow
+
+
+class OverlayRenderer:
+    """
+    Draws flow over frames. roi is the (rows, cols) slices the dense flow
+    passed to render covers.
+    """
+
+    def __init__(self, roi=None, arrow_scale=ARROW_SCALE, color=(0, 255, 0)):
+        self.roi = roi
+        self.arrow_scale = arrow_scale
+        self.color = color
+        self._hsv = None
+
+    def _draw_roi(self, dst, flow):
+        mag, ang = cv.cartToPolar(flow[..., 0], flow[..., 1])
+        if self._hsv is None or self._hsv.shape[:2] != mag.shape:
+            self._hsv = np.empty(mag.shape + (3,), dtype=np.uint8)
+            self._hsv[..., 1] = 255  # Full saturation
+        self._hsv[..., 0] = ang * (90 / np.pi)  # Angle as hue, OpenCV hue goes to 180
+        self._hsv[..., 2] = cv.normalize(mag, None, 0, 255, cv.NORM_MINMAX)  # Magnitude as value
+        cv.cvtColor(self._hsv, cv.COLOR_HSV2BGR, dst=dst[self.roi])
+
+    def render(self, frame, dst, flow=None, points=None, vectors=None):
+        """
+        frame with flow (dense, over roi) and vectors ((points, 2) in pixels at
+        points (x, y)) drawn on it, into dst.
+        """
+        np.copyto(dst, frame)
+        if flow is not None and self.roi is not None:
+            self._draw_roi(dst, flow)
+        if points is not None and vectors is not None:
+            ends = points + np.nan_to_num(vectors) * self.arrow_scale
+            for (x0, y0), (x1, y1) in zip(np.rint(points).astype(int), np.rint(ends).astype(int)):
+                cv.arrowedLine(dst, (x0, y0), (x1, y1), self.color, 1, cv.LINE_AA, tipLength=0.3)
+        return dst
+
+
+class OverlayWriter:
+    """
+    Writes frames to a video at path on a background thread. acquire gives a
+    free buffer to draw a frame into, waiting for one when all of them are
+    still with the encoder, or with drop=True returning None at once, in which
+    case the frame is dropped. submit hands the buffer to the encoder, which
+    gives it back once written.
+    """
+
+    def __init__(self, path, fps=30.0, fourcc="mp4v", buffers=8, drop=False):
+        self.path = path
+        self.fps = fps
+        self.fourcc = fourcc
+        self.buffers = buffers
+        self.drop = drop
+        self.free = queue.Queue()
+        self.pending = queue.Queue()
+        self.writer = None
+        self.thread = None
+        self.shape = None
+        self.written = 0
+        self.dropped = 0
+        self.error = None
+
+    def _open(self, shape):
+        height, width = shape[:2]
+        self.writer = cv.VideoWriter(self.path, cv.VideoWriter_fourcc(*self.fourcc), self.fps, (width, height))
+        if not self.writer.isOpened():
+            raise OSError(f"Can't open {self.path} for writing with fourcc {self.fourcc}")
+        self.shape = shape
+        for _ in range(self.buffers):
+            self.free.put(np.empty(shape, dtype=np.uint8))
+        self.thread = threading.Thread(target=self._encode, daemon=True)
+        self.thread.start()
+
+    def _encode(self):
+        while True:
+            buffer = self.pending.get()
+            if buffer is None:
+                break
+            try:
+                if self.error is None:
+                    self.writer.write(buffer)
+                    self.written += 1
+            except Exception as e:
+                self.error = e
+            self.free.put(buffer)
+
+    def acquire(self, shape):
+        if self.writer is None:
+            self._open(tuple(shape))
+        elif tuple(shape) != self.shape:
+            raise ValueError(f"Frame shape {tuple(shape)} differs from the video's {self.shape}")
+        if not self.drop:
+            return self.free.get()
+        try:
+            return self.free.get_nowait()
+        except queue.Empty:
+            self.dropped += 1
+            return None
+
+    def submit(self, buffer):
+        self.pending.put(buffer)
+
+    def close(self):
+        if self.thread is not None:
+            self.pending.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.writer is not None:
+            self.writer.release()
+            self.writer = None
+            if self.dropped:
+                print(f"{self.dropped} frames left out of {self.path}, the encoder fell behind.")
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_overlay(overlay, fps=30.0):
+    """
+    (writer, owned) for an OverlayWriter or an output path, owned meaning the
+    caller opened it and closes it. A path gets a writer that keeps every
+    frame, pass an OverlayWriter with drop=True for a live feed.
+    """
+    if overlay is None or isinstance(overlay, OverlayWriter):
+        return overlay, False
+    return OverlayWriter(overlay, fps), True
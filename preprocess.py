@@ -1,22 +1,182 @@
 import cv2
 import os
-import serial
+import queue
+import threading
+import time
 import numpy as np
+from flowtrace import FlowTrace
+from framesource import VideoFrameSource, roi_bounds
+from serialproto import NO_FLOW, FieldLink, FramedLink
+from tracing import DECODE, TX_COMPLETE, TX_START
 
-# Used to process the center 16x16 region of the frame to grayscale
-def preprocess_frame(frame):
-    # Convert to grayscale
-    grayscale = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-    
-    # Get the center 16x16 region of the grayscale frame
-    height, width = grayscale.shape
-    start_x = (width - 16) // 2
-    start_y = (height - 16) // 2
-    center_16x16 = grayscale[start_y:start_y + 16, start_x:start_x + 16]
-    blurred_center = cv2.GaussianBlur(center_16x16, (5, 5), 0)  # Kernel size (5, 5), you can adjust it
-    
-    # Flatten the 16x16 region to a 1D array and return it
-    return blurred_center.flatten()
+BLUR_KERNEL = (5, 5)
+BLUR_HALO = BLUR_KERNEL[0] // 2  # Neighbouring pixels the blur needs around the 16x16 region
+
+DEFLICKER_HISTORY = 10  # MAXSIZE of archive/deflicker.h
+
+# Used to process the center 16x16 region of the frame to grayscale. Works the
+# same on a full frame or on a centred crop from framesource, only the 16x16
+# region and the halo of pixels around it for the blur are ever converted.
+# Runs a FramePreprocessor kept per thread so the intermediate images aren't
+# allocated again for every frame, the result goes to dst if given
+def preprocess_frame(frame, halo=BLUR_HALO, dst=None):
+    chains = _chains.__dict__
+    if halo not in chains:
+        chains[halo] = FramePreprocessor(halo)
+    return chains[halo](frame, dst)
+
+_chains = threading.local()
+
+# Python counterpart of deflicker() from archive/deflicker.c. Once `history`
+# frames have been seen every frame is scaled by get_factor(), the mean
+# brightness (mean pixel value) of the last `history` frames over its own, so
+# a frame brighter or darker than the ones around it is pulled back to their
+# level. The brightness history is a ring with a running sum instead of the C
+# queue's memmove and full sum on every frame
+class Deflicker:
+    def __init__(self, history=DEFLICKER_HISTORY):
+        self.history = history
+        self.brightness = np.zeros(history)
+        self.available = 0
+        self.next = 0  # Where the next brightness goes
+        self.total = 0.0
+
+    def push(self, brightness):
+        # Add a frame's brightness, returns its factor or None while the
+        # history is filling up
+        self.total += brightness - self.brightness[self.next]
+        self.brightness[self.next] = brightness
+        self.next = (self.next + 1) % self.history
+        if self.next == 0:
+            self.total = float(self.brightness.sum())  # Drop rounding error once per lap
+        self.available = min(self.available + 1, self.history)
+        if self.available < self.history:
+            return None
+        return self.get_factor(brightness)
+
+    def get_factor(self, brightness):
+        return self.total / self.history / brightness if brightness > 0 else 1.0
+
+    def factors(self, brightness):
+        # push() for an array of brightness values at once, NaN instead of None
+        brightness = np.asarray(brightness, dtype=np.float64)
+        if self.available < self.history:
+            past = self.brightness[:self.available]
+        else:
+            past = np.roll(self.brightness, -self.next)
+        values = np.concatenate([past, brightness])
+        sums = np.concatenate([[0.0], np.cumsum(values)])
+        end = np.arange(len(past), len(values)) + 1
+        window = sums[end] - sums[np.maximum(end - self.history, 0)]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            factors = np.where(brightness > 0, window / self.history / brightness, 1.0)
+        factors[end < self.history] = np.nan
+
+        last = values[-self.history:]
+        self.brightness[:len(last)] = last
+        self.available = len(last)
+        self.next = len(last) % self.history
+        self.total = float(last.sum())
+        return factors
+
+# preprocess_frame as a chain of stages for one stream of frames: crop the
+# 16x16 region plus the halo, grayscale, blur, deflicker (off unless asked
+# for) and quantise back to uint8 keeping the top `bits` bits. The crop, gray,
+# blurred and scaled images are buffers made for the first frame and written
+# with dst= outputs afterwards, pass dst (256 uint8) to reuse the output too.
+# Frames may also be grayscale already. stack() runs a batch of frames with one
+# call per stage
+class FramePreprocessor:
+    def __init__(self, halo=BLUR_HALO, blur=BLUR_KERNEL, deflicker=False, history=DEFLICKER_HISTORY, bits=8):
+        self.halo = halo
+        self.blur = blur
+        self.deflicker = Deflicker(history) if deflicker else None
+        self.mask = np.uint8((0xFF << (8 - bits)) & 0xFF)
+        self.shape = None
+
+    def _setup(self, shape):
+        height, width = shape[:2]
+        x0, y0, x1, y1 = roi_bounds(width, height, 16, self.halo)
+        start_x = (width - 16) // 2 - x0
+        start_y = (height - 16) // 2 - y0
+        self.crop = (slice(y0, y1), slice(x0, x1))
+        self.center = (slice(start_y, start_y + 16), slice(start_x, start_x + 16))
+        self.gray = np.empty((y1 - y0, x1 - x0), dtype=np.uint8)
+        self.blurred = np.empty_like(self.gray)
+        self.scaled = np.empty((16, 16), dtype=np.float32)
+        # Blurring crops stacked on top of each other only gives the same
+        # centre as blurring each on its own if the kernel stays inside the crop
+        radius = self.blur[1] // 2 if self.blur is not None else 0
+        self.tileable = start_y >= radius and (y1 - y0) - start_y - 16 >= radius
+        self.shape = shape
+
+    def __call__(self, frame, dst=None):
+        if frame.shape != self.shape:
+            self._setup(frame.shape)
+        if dst is None:
+            dst = np.empty(256, dtype=np.uint8)
+        out = dst.reshape(16, 16)
+
+        cropped = frame[self.crop]
+        if cropped.ndim == 3:
+            cv2.cvtColor(cropped, cv2.COLOR_BGR2GRAY, dst=self.gray)
+        else:
+            np.copyto(self.gray, cropped)
+        image = self.gray
+        if self.blur is not None:
+            cv2.GaussianBlur(self.gray, self.blur, 0, dst=self.blurred)
+            image = self.blurred
+        center = image[self.center]
+
+        factor = None
+        if self.deflicker is not None:
+            factor = self.deflicker.push(cv2.mean(center)[0])
+        if factor is None:
+            np.copyto(out, center)
+        else:
+            np.multiply(center, np.float32(factor), out=self.scaled)
+            np.minimum(self.scaled, 255, out=self.scaled)
+            np.copyto(out, self.scaled, casting="unsafe")  # Truncates like clip_uint8(img[i] * f)
+        if self.mask != 0xFF:
+            np.bitwise_and(out, self.mask, out=out)
+        return dst
+
+    def stack(self, frames, dst=None):
+        # (N, 256) uint8 for an (N, H, W[, 3]) stack, the same as calling the
+        # chain on each frame in turn
+        frames = np.asarray(frames)
+        if dst is None:
+            dst = np.empty((len(frames), 256), dtype=np.uint8)
+        if not len(frames):
+            return dst
+        if frames.shape[1:] != self.shape:
+            self._setup(frames.shape[1:])
+        if not self.tileable:
+            for frame, row in zip(frames, dst):
+                self(frame, row)
+            return dst
+
+        # Crops one under the other make a single image for cv2
+        cropped = np.ascontiguousarray(frames[(slice(None),) + self.crop])
+        count, rows, cols = cropped.shape[:3]
+        image = cropped.reshape((count * rows, cols) + cropped.shape[3:])
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        if self.blur is not None:
+            image = cv2.GaussianBlur(image, self.blur, 0)
+        center = image.reshape(count, rows, cols)[(slice(None),) + self.center]
+        out = dst.reshape(count, 16, 16)
+
+        if self.deflicker is None:
+            np.copyto(out, center)
+        else:
+            factors = self.deflicker.factors(center.mean(axis=(1, 2)))
+            factors = np.where(np.isnan(factors), 1.0, factors).astype(np.float32)
+            scaled = np.minimum(center * factors[:, None, None], 255)
+            np.copyto(out, scaled, casting="unsafe")
+        if self.mask != 0xFF:
+            np.bitwise_and(out, self.mask, out=out)
+        return dst
 
 def send_frame_to_esp32(frame_data, ser):
     ser.write(frame_data.tobytes())  # Send the flattened data
@@ -29,7 +189,7 @@ def read_ser(ser):
     else:
         return None
     
-def read_optical_flow_vector(ser):
+def read_optical_flow_vector(ser, trace=None):
     # Read 4 bytes: 2 bytes for u and 2 bytes for v components of optical flow
     data = ser.read(4)  # Expecting 4 bytes: 2 for u and 2 for v
     if len(data) == 4:
@@ -38,45 +198,300 @@ def read_optical_flow_vector(ser):
         return u, v
     else:
         print(f"Failed to read 4 bytes, received {len(data)} bytes.")
+        if trace is not None:
+            trace.count("short_reads" if data else "timeouts")
         return None, None
 
-def processdata(videoname, datacount):
-    # Path to your video file
-    src_path = os.path.join("src", videoname)
+# The original protocol of espSerial.ino: the raw 256 bytes of every frame,
+# and 4 bytes back for every frame but the first
+class RawLink:
+    def expects_reply(self, frame_count):
+        return frame_count > 0
 
-    cap = cv2.VideoCapture(src_path)
+    def send(self, ser, frame_count, frame_data):
+        send_frame_to_esp32(frame_data, ser)
+        return frame_data.nbytes
 
-    # Set up serial communication
-    ser = serial.Serial('COM5', 500000, timeout=2)
+    def read(self, ser, frame_count, trace=None):
+        return read_optical_flow_vector(ser, trace)
+
+    def reset(self):
+        pass
+
+# Link for the protocol name used by open_port and process_frames, "raw" or
+# "framed" (serialproto, the firmware built with FRAMED_PROTOCOL 1)
+def make_link(protocol='raw'):
+    if protocol == 'raw':
+        return RawLink()
+    if protocol == 'framed':
+        return FramedLink()
+    raise ValueError(f"Unknown protocol {protocol!r}, expected 'raw' or 'framed'")
+
+# Used to wait until the line has gone quiet and throw away whatever is left in
+# the host receive buffer, so late bytes of a partial reply can't shift the
+# following replies
+def drain_serial(ser, quiet_time=0.05):
+    while True:
+        time.sleep(quiet_time)
+        if ser.in_waiting == 0:
+            break
+        ser.reset_input_buffer()
 
-    frame_count = 0
-    flow_vectors = []  # To store the optical flow vectors for each frame
+# Sends frames to the ESP32 while up to `window` replies are outstanding and
+# yields (frame_count, u, v) in frame order. The first frame only primes the
+# ESP32 so it has no reply. When a reply comes back short every frame in flight
+# is reported with u = v = None and the stream is resynchronised before more
+# frames are sent, the next reply then belongs to the next frame sent.
+# A tracing.LinkTrace passed as trace gets every frame's tx and rx timestamps.
+# link is a RawLink (the default) or a serialproto.FramedLink.
+def stream_flow_vectors(ser, frames, window=2, quiet_time=0.05, trace=None, link=None):
+    if window < 1:
+        raise ValueError("window must be at least 1")
+    if link is None:
+        link = RawLink()
 
-    while frame_count < datacount:  # Loop to process up to 10 frames
-        ret, frame = cap.read()
-        if not ret:
-            break  # End of video
+    slots = threading.Semaphore(window)  # Free places in the window
+    pending = queue.Queue()  # Frame numbers whose reply is outstanding
+    lock = threading.Lock()  # Held while a frame is written
+    running = threading.Event()  # Cleared while resynchronising
+    stop = threading.Event()
+    errors = []
+    running.set()
 
-        # Process the frame
-        processed_frame = preprocess_frame(frame)
+    def sender():
+        try:
+            for frame_count, frame_data in enumerate(frames):
+                if link.expects_reply(frame_count):
+                    while not slots.acquire(timeout=0.1):
+                        if stop.is_set():
+                            return
+                while True:
+                    running.wait()
+                    if stop.is_set():
+                        return
+                    with lock:
+                        if running.is_set():
+                            if trace is not None:
+                                trace.stamp(frame_count, TX_START)
+                            sent = link.send(ser, frame_count, frame_data)
+                            if trace is not None:
+                                trace.stamp(frame_count, TX_COMPLETE)
+                                trace.count("frames_sent")
+                                trace.count("tx_bytes", sent)
+                            if link.expects_reply(frame_count):
+                                pending.put(frame_count)
+                            break
+        except Exception as e:
+            errors.append(e)
+        finally:
+            pending.put(None)
 
-        # Send the processed frame to ESP32
-        send_frame_to_esp32(processed_frame, ser)
+    thread = threading.Thread(target=sender, daemon=True)
+    thread.start()
 
-        # Wait to receive the optical flow after the frame is processed
-        if (frame_count > 0):
-            u, v = read_optical_flow_vector(ser)
+    try:
+        while True:
+            frame_count = pending.get()
+            if frame_count is None:
+                break
+
+            reply = link.read(ser, frame_count, trace)
+            if reply is NO_FLOW:
+                # Answered but without a vector, nothing to resync
+                slots.release()
+                if frame_count > 0:
+                    yield frame_count, None, None
+                continue
+            u, v = reply
+            if u is not None:
+                if trace is not None:
+                    trace.received(frame_count)
+                slots.release()
+                yield frame_count, u, v
+                continue
+
+            # Short read, hold the sender and fail everything already sent
+            running.clear()
+            with lock:
+                lost = [frame_count]
+                while True:
+                    try:
+                        frame_count = pending.get_nowait()
+                    except queue.Empty:
+                        break
+                    if frame_count is None:
+                        pending.put(None)
+                        break
+                    lost.append(frame_count)
+                drain_serial(ser, quiet_time)
+                link.reset()
+            if trace is not None:
+                trace.count("resyncs")
+                trace.count("lost_frames", len(lost))
+            for frame_count in lost:
+                slots.release()
+                yield frame_count, None, None
+            running.set()
+    finally:
+        stop.set()
+        running.set()
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+# Opens the serial link to the ESP32. "emu" gives an emulated board that replies
+# as fast as the host can read and "emu-baud" one paced like the real link,
+# running the firmware for the given protocol. "replay:<session>" serves a
+# session recorded with record=<session> back as fast as it is read, and
+# "replay-timed:<session>" at the recorded timing (serialrecord.py)
+def open_port(port='COM5', baudrate=500000, timeout=2, protocol='raw', record=None):
+    for prefix, timed in (("replay:", False), ("replay-timed:", True)):
+        if port.startswith(prefix):
+            from serialrecord import ReplaySerial
+            return ReplaySerial(port[len(prefix):], timed=timed, timeout=timeout)
+    if port in ("emu", "emu-baud"):
+        from esp32emu import EmulatedSerial, ESP32Device, FramedESP32Device
+        device = FramedESP32Device() if protocol == 'framed' else ESP32Device()
+        ser = EmulatedSerial(device, baudrate=baudrate, timeout=timeout, throttled=port == "emu-baud")
+    else:
+        import serial
+        ser = serial.Serial(port, baudrate, timeout=timeout)
+    if record is not None:
+        from serialrecord import RecordingSerial
+        ser = RecordingSerial(ser, record)
+    return ser
+
+# Preprocesses frames for the link with one FramePreprocessor into one buffer,
+# every link is done with a frame once it has been sent
+def preprocess_stream(frames, deflicker=False):
+    preprocessor = FramePreprocessor(deflicker=deflicker)
+    buffer = np.empty(256, dtype=np.uint8)
+    for frame in frames:
+        yield preprocessor(frame, buffer)
+
+# The trace numbers frames as they are sent, so with a scheduler leaving some
+# out the decode time of each source frame is kept and stamped as DECODE on the
+# frame sent from it, keeping the queue and total latencies on the same frame.
+# Returns the source frames timed and a wrapper for the scheduled frames
+def _decode_times(frames, trace, scheduler):
+    decode_ns = []
+
+    def timed(frames):
+        for frame in frames:
+            decode_ns.append(time.perf_counter_ns())
+            yield frame
+
+    def stamp_sent(frames):
+        for sent, frame in enumerate(frames):
+            trace.stamp(sent, DECODE, decode_ns[scheduler.source_frame(sent)])
+            yield frame
+
+    return timed(frames), stamp_sent
+
+# Runs the ESP32 path over an iterable of BGR frames, or of frames already
+# through preprocess_frame with preprocess=False, and returns a FlowTrace of
+# the scaled flow vectors, frame being the position of the second frame of the
+# pair in the iterable and frames without a reply marked STATUS_FAILED. A list of ports spreads the frames
+# over several boards with devicepool (framed protocol, no trace or record).
+# record=<path> logs the serial traffic to a session file for replay,
+# deflicker=True evens out the brightness of the frames before they are sent.
+# A framescheduler.FrameScheduler as scheduler leaves out static frames (and
+# frames the link can't keep up with), the trace then has filled in rows for them
+# and a reply spanning several frames is spread evenly over them
+def process_frames(frames, port='COM5', baudrate=500000, window=2, preprocess=True, trace=None, protocol='raw',
+                   record=None, deflicker=False, scheduler=None):
+    if isinstance(port, (list, tuple)):
+        if scheduler is not None:
+            raise ValueError("A scheduler can't be used with a list of ports")
+        from devicepool import process_frames_pool
+        return process_frames_pool(frames, port, baudrate, window, preprocess, deflicker=deflicker)
+
+    # Set up serial communication
+    link = make_link(protocol)
+    ser = open_port(port, baudrate, timeout=2, protocol=protocol, record=record)
+
+    flow_vectors = FlowTrace()  # To store the optical flow vectors for each frame
+
+    # Frames are preprocessed and sent on a separate thread while replies are read
+    if trace is not None and scheduler is not None:
+        frames, stamp_sent = _decode_times(frames, trace, scheduler)
+    elif trace is not None:
+        frames = trace.decoded(frames)
+    processed_frames = preprocess_stream(frames, deflicker) if preprocess else frames
+    if scheduler is not None:
+        processed_frames = scheduler.schedule(processed_frames)
+        if trace is not None:
+            processed_frames = stamp_sent(processed_frames)
+    try:
+        for frame_count, u, v in stream_flow_vectors(ser, processed_frames, window, trace=trace, link=link):
+            if scheduler is not None:
+                frame_count = scheduler.source_frame(frame_count)
             if u is not None and v is not None:
                 # Store the u, v values
                 scaled_u = u/100.0  # Scale the u component
                 scaled_v = v/100.0  # Scale the v component
-                flow_vectors.append((frame_count, scaled_u, scaled_v))
+                flow_vectors.append(frame_count, scaled_u, scaled_v, time.perf_counter())
             else:
                 print("Failed to receive optical flow data.")
+                flow_vectors.failed(frame_count, time.perf_counter())
+    finally:
+        # Close the serial port after processing is done
+        ser.close()
+        if scheduler is not None:
+            scheduler.close()
+    return flow_vectors if scheduler is None else scheduler.fill(flow_vectors)
+
+# Same as process_frames but also returns the (frames, 256) stack of
+# preprocessed frames that were sent
+def process_frames_with_stack(frames, port='COM5', baudrate=500000, window=2, trace=None, protocol='raw',
+                              record=None, deflicker=False):
+    preprocessor = FramePreprocessor(deflicker=deflicker)
+    stack = [np.empty((1024, 256), dtype=np.uint8), 0]  # Rows written into, grown by doubling
 
-        frame_count += 1
+    def keep(frames):
+        for frame in frames:
+            rows, count = stack
+            if count == len(rows):
+                stack[0] = np.concatenate([rows, np.empty_like(rows)])
+            stack[1] = count + 1
+            yield preprocessor(frame, stack[0][count])
+
+    if trace is not None:
+        frames = trace.decoded(frames)
+    flow_vectors = process_frames(keep(frames), port, baudrate, window, preprocess=False, trace=trace,
+                                  protocol=protocol, record=record)
+    return flow_vectors, stack[0][:stack[1]]
+
+# Runs the ESP32 path with the framed protocol asking for flow at every
+# interior point of the 16x16 region, or at points [(x, y), ...], in one reply
+# per frame. Returns the (frames - 1, 16, 16, 2) float32 field of (u, v), NaN
+# where the board computes nothing, indexed like dense_lucas_kanade
+def process_frames_dense(frames, port='COM5', baudrate=500000, window=2, points=None, preprocess=True, trace=None,
+                         record=None, deflicker=False):
+    link = FieldLink(points)
+    ser = open_port(port, baudrate, timeout=2, protocol='framed', record=record)
+    sent = [0]
+
+    def count(frames):
+        for frame in frames:
+            sent[0] += 1
+            yield frame
+
+    if trace is not None:
+        frames = trace.decoded(frames)
+    processed_frames = preprocess_stream(frames, deflicker) if preprocess else frames
+    try:
+        for frame_count, u, v in stream_flow_vectors(ser, count(processed_frames), window, trace=trace, link=link):
+            if u is None:
+                print("Failed to receive optical flow data.")
+    finally:
+        ser.close()
+    return link.flow_field(max(sent[0] - 1, 0))
 
-    # Close the serial port and video capture after processing is done
-    cap.release()
-    ser.close()
-    return flow_vectors
+def processdata(videoname, datacount, window=2, port='COM5', baudrate=500000, trace=None, protocol='raw',
+                record=None, deflicker=False, scheduler=None):
+    # Only the centre of each frame is decoded into the pipeline
+    frames = VideoFrameSource(videoname, datacount, roi_size=16, halo=BLUR_HALO)
+    return process_frames(frames, port, baudrate, window, trace=trace, protocol=protocol, record=record,
+                          deflicker=deflicker, scheduler=scheduler)
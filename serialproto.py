@@ -0,0 +1,563 @@
+import binascii
+import numpy as np
+
+# Framed serial protocol between the host and espSerial.ino (built with
+# FRAMED_PROTOCOL 1). Every frame goes out in a packet with a sync header,
+# version, sequence number and CRC, either raw or as the difference to the
+# previous frame, and every packet gets a reply carrying the same sequence
+# number, so lost or corrupted bytes are caught instead of shifting the stream.
+#
+# Host to board:  A5 5A | version | type | seq | length (2) | payload | crc (2)
+# Board to host:  A5 5A | version | reply type | seq | status | length (2) | payload | crc (2)
+#
+# Multi-byte fields are big endian. The CRC is CRC-16/CCITT-FALSE over
+# everything between the sync bytes and the CRC.
+#
+# Delta payloads code the residual cur - prev (mod 256), zigzagged so small
+# changes either way are small numbers, as 4-bit codes, high nibble first:
+#   1-14   that value
+#   0 n    n + 1 zeros
+#   15 h l the value (h << 4) | l
+# Blurred 16x16 crops of the dashcam clip average about 100 bytes this way.
+#
+# A CONFIG packet picks what the board replies with for every frame after it:
+#   MODE_POINT   REPLY_FLOW, (u, v) at (8, 8), the default
+#   MODE_FIELD   REPLY_FIELD, x0 y0 cols rows then (u, v) for every point of
+#                that rectangle row by row, all interior points 2..13
+#   MODE_POINTS  REPLY_POINTS, count then (u, v) for each configured point
+# CONFIG payload is the mode, then for MODE_POINTS a count and (x, y) bytes.
+#
+# A FRAME_PAIR packet carries both frames of a pair, the previous frame raw
+# then the current one raw or as a delta against it, and is answered with the
+# flow between them whatever the board received before, so any board can take
+# any pair (see devicepool.py). The current frame becomes the board's previous
+# frame as if the two had been sent one after the other.
+# Flow values are int16 scaled by 100 like the raw protocol.
+
+SYNC = b"\xa5\x5a"
+VERSION = 1
+HEADER_SIZE = 7  # sync, version, type, seq, length
+REPLY_HEADER_SIZE = 8  # sync, version, type, seq, status, length
+CRC_SIZE = 2
+FRAME_SIZE = 256
+
+# Packet types
+FRAME_RAW = 0x01
+FRAME_DELTA = 0x02
+FRAME_RESET = 0x03  # Raw frame starting a new stream, no flow is computed
+CONFIG = 0x04
+FRAME_PAIR = 0x05
+REPLY_FLOW = 0x81
+REPLY_FIELD = 0x82
+REPLY_POINTS = 0x83
+REPLY_TYPES = (REPLY_FLOW, REPLY_FIELD, REPLY_POINTS)
+
+# Reply modes
+MODE_POINT = 0
+MODE_FIELD = 1
+MODE_POINTS = 2
+FIELD_MARGIN = 2  # Points closer to the edge have no full 3x3 window of central differences
+FIELD_FIRST = FIELD_MARGIN
+FIELD_LAST = 15 - FIELD_MARGIN
+MAX_POINTS = (FIELD_LAST - FIELD_FIRST + 1) ** 2
+
+# Reply status
+STATUS_OK = 0
+STATUS_NO_FLOW = 1  # First frame of a stream
+STATUS_BAD_CRC = 2
+STATUS_NO_REFERENCE = 3  # Delta frame without a previous frame to apply it to
+STATUS_BAD_PACKET = 4  # Unknown version or type, or bad length
+
+MAX_PAYLOAD = 512
+MAX_REPLY_PAYLOAD = 1024
+
+
+def crc16(data):
+    return binascii.crc_hqx(data, 0xFFFF)
+
+
+def pack_packet(packet_type, seq, payload):
+    body = bytes([VERSION, packet_type, seq & 0xFF]) + len(payload).to_bytes(2, "big") + payload
+    return SYNC + body + crc16(body).to_bytes(2, "big")
+
+
+def pack_reply(seq, status, payload=b"", reply_type=REPLY_FLOW):
+    body = bytes([VERSION, reply_type, seq & 0xFF, status]) + len(payload).to_bytes(2, "big") + payload
+    return SYNC + body + crc16(body).to_bytes(2, "big")
+
+
+def zigzag(residual):
+    """
+    int8 residuals to 0..255 with 0, -1, 1, -2, ... as 0, 1, 2, 3, ...
+    """
+    residual = residual.astype(np.int8)
+    return ((residual.astype(np.int16) << 1) ^ (residual >> 7)).astype(np.uint8)
+
+
+def unzigzag(codes):
+    codes = codes.astype(np.uint8)
+    return (codes >> 1) ^ (np.uint8(0) - (codes & 1))
+
+
+def encode_delta(prev, cur):
+    """
+    Delta payload turning prev into cur, both flat uint8 frames.
+    """
+    codes = zigzag(cur.astype(np.uint8) - prev.astype(np.uint8)).tolist()
+    nibbles = []
+    i = 0
+    n = len(codes)
+    while i < n:
+        value = codes[i]
+        if value == 0:
+            run = 1
+            while i + run < n and run < 16 and codes[i + run] == 0:
+                run += 1
+            nibbles += (0, run - 1)
+            i += run
+            continue
+        if value < 15:
+            nibbles.append(value)
+        else:
+            nibbles += (15, value >> 4, value & 15)
+        i += 1
+    if len(nibbles) % 2:
+        nibbles.append(0)  # Padding, ignored once every pixel is decoded
+    packed = np.array(nibbles, dtype=np.uint8).reshape(-1, 2)
+    return ((packed[:, 0] << 4) | packed[:, 1]).tobytes()
+
+
+def decode_delta(prev, payload, size=FRAME_SIZE):
+    """
+    Apply a delta payload to prev, returns the new frame or None if the
+    payload doesn't decode to exactly size pixels.
+    """
+    data = np.frombuffer(payload, dtype=np.uint8)
+    nibbles = np.empty(len(data) * 2, dtype=np.uint8)
+    nibbles[0::2] = data >> 4
+    nibbles[1::2] = data & 15
+    nibbles = nibbles.tolist()
+    codes = []
+    i = 0
+    while len(codes) < size and i < len(nibbles):
+        value = nibbles[i]
+        if value == 0:
+            if i + 1 >= len(nibbles):
+                return None
+            codes += [0] * (nibbles[i + 1] + 1)
+            i += 2
+        elif value == 15:
+            if i + 2 >= len(nibbles):
+                return None
+            codes.append((nibbles[i + 1] << 4) | nibbles[i + 2])
+            i += 3
+        else:
+            codes.append(value)
+            i += 1
+    if len(codes) != size or len(nibbles) - i > 1:
+        return None
+    return prev.astype(np.uint8) + unzigzag(np.array(codes, dtype=np.uint8))
+
+
+class FrameEncoder:
+    """
+    Host side: packs each frame as a delta against the last frame sent when
+    that is shorter than the raw frame. The first frame, and the first after
+    reset(), is sent as FRAME_RESET so the board starts over from it.
+    """
+
+    def __init__(self, delta=True):
+        self.delta = delta
+        self.reference = None
+        self.seq = 0
+
+    def reset(self):
+        self.reference = None
+
+    def next_seq(self):
+        seq = self.seq
+        self.seq = (self.seq + 1) & 0xFF
+        return seq
+
+    def encode(self, frame):
+        """
+        (packet, seq, packet type) for a flat uint8 frame.
+        """
+        frame = np.ascontiguousarray(frame, dtype=np.uint8).reshape(-1)
+        packet_type, payload = FRAME_RAW, frame.tobytes()
+        if self.reference is None:
+            packet_type = FRAME_RESET
+        elif self.delta:
+            delta = encode_delta(self.reference, frame)
+            if len(delta) < len(payload):
+                packet_type, payload = FRAME_DELTA, delta
+        seq = self.next_seq()
+        # Copied, the caller may reuse the frame's buffer for the next one
+        if self.reference is None:
+            self.reference = np.empty(FRAME_SIZE, dtype=np.uint8)
+        np.copyto(self.reference, frame)
+        return pack_packet(packet_type, seq, payload), seq, packet_type
+
+
+class PacketParser:
+    """
+    Splits a byte stream into packets. feed() returns the complete packets
+    as (type, seq, payload, crc_ok) tuples, bytes before a sync header or in
+    a header that can't be right are skipped. parse_reply=True reads the
+    board's reply format and gives (type, seq, status, payload, crc_ok).
+    """
+
+    def __init__(self, parse_reply=False):
+        self.buffer = bytearray()
+        self.header_size = REPLY_HEADER_SIZE if parse_reply else HEADER_SIZE
+        self.parse_reply = parse_reply
+
+    def needed(self):
+        """
+        Bytes still missing before the next packet can be complete.
+        """
+        start = self.buffer.find(SYNC)
+        if start < 0:
+            return self.header_size + CRC_SIZE
+        available = len(self.buffer) - start
+        if available < self.header_size:
+            return self.header_size + CRC_SIZE - available
+        length = int.from_bytes(self.buffer[start + self.header_size - 2:start + self.header_size], "big")
+        return max(self.header_size + length + CRC_SIZE - available, 1)
+
+    def feed(self, data):
+        self.buffer += data
+        packets = []
+        while True:
+            start = self.buffer.find(SYNC)
+            if start < 0:
+                # Keep a trailing first sync byte, the second may be next
+                del self.buffer[:max(len(self.buffer) - 1, 0)]
+                return packets
+            del self.buffer[:start]
+            if len(self.buffer) < self.header_size:
+                return packets
+            length = int.from_bytes(self.buffer[self.header_size - 2:self.header_size], "big")
+            if self.buffer[2] != VERSION or length > (MAX_REPLY_PAYLOAD if self.parse_reply else MAX_PAYLOAD):
+                del self.buffer[:1]  # Not a real header, hunt for the next sync
+                continue
+            end = self.header_size + length + CRC_SIZE
+            if len(self.buffer) < end:
+                return packets
+            body = bytes(self.buffer[2:end - CRC_SIZE])
+            crc_ok = crc16(body) == int.from_bytes(self.buffer[end - CRC_SIZE:end], "big")
+            payload = body[self.header_size - 2:]
+            if self.parse_reply:
+                packets.append((body[1], body[2], body[3], payload, crc_ok))
+            else:
+                packets.append((body[1], body[2], payload, crc_ok))
+            del self.buffer[:end]
+
+
+class FrameDecoder:
+    """
+    Board side: turns packets back into frames and says which reply each
+    one gets, as done by espSerial.ino. handle() returns (status, frame)
+    where frame is the previous and current frame to compute flow on, or
+    None when there is nothing to compute.
+    """
+
+    def __init__(self):
+        self.reference = None
+
+    def handle(self, packet_type, payload, crc_ok):
+        if not crc_ok:
+            return STATUS_BAD_CRC, None
+        if packet_type == FRAME_PAIR:
+            if not FRAME_SIZE < len(payload) <= 2 * FRAME_SIZE:
+                return STATUS_BAD_PACKET, None
+            prev = np.frombuffer(payload[:FRAME_SIZE], dtype=np.uint8).copy()
+            if len(payload) == 2 * FRAME_SIZE:
+                frame = np.frombuffer(payload[FRAME_SIZE:], dtype=np.uint8).copy()
+            else:
+                frame = decode_delta(prev, payload[FRAME_SIZE:])
+                if frame is None:
+                    self.reference = None  # The firmware has already overwritten it
+                    return STATUS_BAD_PACKET, None
+            self.reference = frame
+            return STATUS_OK, (prev, frame)
+        if packet_type in (FRAME_RAW, FRAME_RESET):
+            if len(payload) != FRAME_SIZE:
+                return STATUS_BAD_PACKET, None
+            frame = np.frombuffer(payload, dtype=np.uint8).copy()
+        elif packet_type == FRAME_DELTA:
+            if self.reference is None:
+                return STATUS_NO_REFERENCE, None
+            frame = decode_delta(self.reference, payload)
+            if frame is None:
+                return STATUS_BAD_PACKET, None
+        else:
+            return STATUS_BAD_PACKET, None
+        prev, self.reference = self.reference, frame
+        if packet_type == FRAME_RESET or prev is None:
+            return STATUS_NO_FLOW, None
+        return STATUS_OK, (prev, frame)
+
+
+def pack_pair(seq, prev, cur, delta=True):
+    """
+    FRAME_PAIR packet for two flat uint8 frames, the second as a delta when
+    that is shorter.
+    """
+    prev = np.ascontiguousarray(prev, dtype=np.uint8).reshape(-1)
+    cur = np.ascontiguousarray(cur, dtype=np.uint8).reshape(-1)
+    second = cur.tobytes()
+    if delta:
+        coded = encode_delta(prev, cur)
+        if len(coded) < len(second):
+            second = coded
+    return pack_packet(FRAME_PAIR, seq, prev.tobytes() + second)
+
+
+def pack_config(seq, mode, points=()):
+    payload = bytes([mode])
+    if mode == MODE_POINTS:
+        payload += bytes([len(points)]) + bytes(c for point in points for c in point)
+    return pack_packet(CONFIG, seq, payload)
+
+
+def parse_config(payload):
+    """
+    (mode, points) of a CONFIG payload, None if it isn't valid.
+    """
+    if not payload or payload[0] not in (MODE_POINT, MODE_FIELD, MODE_POINTS):
+        return None
+    mode = payload[0]
+    if mode != MODE_POINTS:
+        return (mode, ()) if len(payload) == 1 else None
+    if len(payload) < 2 or len(payload) != 2 + 2 * payload[1] or not 0 < payload[1] <= MAX_POINTS:
+        return None
+    points = [(payload[i], payload[i + 1]) for i in range(2, len(payload), 2)]
+    if not all(FIELD_FIRST <= c <= FIELD_LAST for point in points for c in point):
+        return None
+    return mode, points
+
+
+def pack_flow_values(scaled):
+    """
+    int16 big endian bytes of scaled flow values, keeping the low 16 bits of
+    each like the firmware's (uint8_t) casts.
+    """
+    return (np.asarray(scaled, dtype=np.int64) & 0xFFFF).astype(">u2").tobytes()
+
+
+def wire_bytes(frames, delta=True):
+    """
+    Bytes the host sends for frames (flat uint8) with the framed protocol.
+    """
+    encoder = FrameEncoder(delta)
+    return sum(len(encoder.encode(frame)[0]) for frame in frames)
+
+
+NO_FLOW = "no flow"  # Reply without a flow vector, see FramedLink.read
+
+
+class FramedLink:
+    """
+    Host end of the framed protocol for preprocess.stream_flow_vectors. Every
+    frame gets a reply. read() returns (u, v), (None, None) when the reply is
+    missing, corrupt or for another packet, or NO_FLOW when the board answered
+    without a vector (the first frame after a reset).
+    """
+
+    def __init__(self, delta=True):
+        self.encoder = FrameEncoder(delta)
+        self.seqs = {}  # Sequence number of each frame whose reply is outstanding
+
+    def expects_reply(self, frame_count):
+        return True
+
+    def send(self, ser, frame_count, frame_data):
+        packet, seq, _ = self.encoder.encode(frame_data)
+        self.seqs[frame_count] = seq
+        ser.write(packet)
+        return len(packet)
+
+    def reset(self):
+        # After a resync the board's previous frame is unknown, start over
+        self.encoder.reset()
+        self.seqs.clear()
+
+    def _read_reply(self, ser, seq, trace=None):
+        """
+        (reply type, status, payload) of the next reply if it is intact and
+        for packet seq, otherwise None.
+        """
+        header = ser.read(REPLY_HEADER_SIZE)
+        if len(header) < REPLY_HEADER_SIZE:
+            print(f"Failed to read reply header, received {len(header)} bytes.")
+            if trace is not None:
+                trace.count("short_reads" if header else "timeouts")
+            return None
+        length = int.from_bytes(header[6:8], "big")
+        if header[:2] != SYNC or header[2] != VERSION or header[3] not in REPLY_TYPES or length > MAX_REPLY_PAYLOAD:
+            print("Bad reply header.")
+            if trace is not None:
+                trace.count("bad_replies")
+            return None
+        rest = ser.read(length + CRC_SIZE)
+        if len(rest) < length + CRC_SIZE:
+            print(f"Failed to read reply, received {len(rest)} of {length + CRC_SIZE} bytes.")
+            if trace is not None:
+                trace.count("short_reads")
+            return None
+        if crc16(header[2:] + rest[:length]) != int.from_bytes(rest[length:], "big"):
+            print("Reply CRC mismatch.")
+            if trace is not None:
+                trace.count("crc_errors")
+            return None
+        status = header[5]
+        if header[4] != seq or status not in (STATUS_OK, STATUS_NO_FLOW):
+            print(f"Reply for packet {header[4]} with status {status}, expected packet {seq}.")
+            if trace is not None:
+                trace.count("bad_replies")
+            return None
+        return header[3], status, rest[:length]
+
+    def _decode(self, frame_count, reply_type, payload):
+        if reply_type != REPLY_FLOW or len(payload) != 4:
+            return None
+        u = int.from_bytes(payload[0:2], "big", signed=True)
+        v = int.from_bytes(payload[2:4], "big", signed=True)
+        return u, v
+
+    def read(self, ser, frame_count, trace=None):
+        reply = self._read_reply(ser, self.seqs.pop(frame_count, None), trace)
+        if reply is None:
+            return None, None
+        reply_type, status, payload = reply
+        if status == STATUS_NO_FLOW:
+            return NO_FLOW
+        values = self._decode(frame_count, reply_type, payload)
+        if values is None:
+            print(f"Unexpected reply type {reply_type:#x} with {len(payload)} bytes.")
+            if trace is not None:
+                trace.count("bad_replies")
+            return None, None
+        return values
+
+
+class PairLink(FramedLink):
+    """
+    Framed protocol sending every item as a self-contained (prev, cur) pair
+    in a FRAME_PAIR packet, so no state is kept between items and resyncs
+    need no restart. Every pair is answered with a vector.
+    """
+
+    def send(self, ser, frame_count, pair):
+        seq = self.encoder.next_seq()
+        packet = pack_pair(seq, pair[0], pair[1], self.encoder.delta)
+        self.seqs[frame_count] = seq
+        ser.write(packet)
+        return len(packet)
+
+    def read(self, ser, frame_count, trace=None):
+        reply = super().read(ser, frame_count, trace)
+        if reply is NO_FLOW:
+            # A pair always has a vector, the board didn't take it as a pair
+            print("Reply without flow for a frame pair.")
+            if trace is not None:
+                trace.count("bad_replies")
+            return None, None
+        return reply
+
+
+class FieldLink(FramedLink):
+    """
+    Framed protocol asking the board for flow at every interior point
+    (points=None) or at a list of (x, y) points. Replies are decoded with
+    np.frombuffer straight into field, a (frames, 16, 16, 2) int16 buffer of
+    scaled (u, v) indexed by frame_count - 1, and read() returns the u and v
+    planes of that frame as views. valid marks the points the board fills in.
+    """
+
+    def __init__(self, points=None, delta=True, capacity=1024):
+        super().__init__(delta)
+        if points is None:
+            self.mode, self.points = MODE_FIELD, ()
+        else:
+            self.points = [(int(x), int(y)) for x, y in points]
+            if parse_config(bytes([MODE_POINTS, len(self.points)]) + bytes(c for p in self.points for c in p)) is None:
+                raise ValueError(f"points must be 1 to {MAX_POINTS} (x, y) pairs within "
+                                 f"{FIELD_FIRST}..{FIELD_LAST}")
+            self.mode = MODE_POINTS
+            xs, ys = np.array(self.points).T
+            self.xs, self.ys = xs, ys
+        self.valid = np.zeros((16, 16), dtype=bool)
+        if self.mode == MODE_FIELD:
+            self.valid[FIELD_FIRST:FIELD_LAST + 1, FIELD_FIRST:FIELD_LAST + 1] = True
+        else:
+            self.valid[self.ys, self.xs] = True
+        self.field = np.zeros((capacity, 16, 16, 2), dtype=np.int16)
+        self.received = np.zeros(capacity, dtype=bool)
+        self.frames = 0  # Highest frame_count decoded
+        self.configured = False
+        self.config_seqs = {}  # Frames sent right after a CONFIG packet
+
+    def send(self, ser, frame_count, frame_data):
+        sent = 0
+        if not self.configured:
+            seq = self.encoder.next_seq()
+            packet = pack_config(seq, self.mode, self.points)
+            ser.write(packet)
+            sent += len(packet)
+            self.config_seqs[frame_count] = seq
+            self.configured = True
+        return sent + super().send(ser, frame_count, frame_data)
+
+    def reset(self):
+        super().reset()
+        # Send the configuration again, in case the board restarted
+        self.configured = False
+        self.config_seqs.clear()
+
+    def _decode(self, frame_count, reply_type, payload):
+        index = frame_count - 1
+        if index >= len(self.field):
+            grown = np.zeros((max(2 * len(self.field), index + 1),) + self.field.shape[1:], dtype=np.int16)
+            grown[:len(self.field)] = self.field
+            received = np.zeros(len(grown), dtype=bool)
+            received[:len(self.received)] = self.received
+            self.field, self.received = grown, received
+        if reply_type == REPLY_FIELD and len(payload) >= 4:
+            x0, y0, cols, rows = payload[:4]
+            if len(payload) != 4 + 4 * cols * rows or x0 + cols > 16 or y0 + rows > 16:
+                return None
+            values = np.frombuffer(payload, dtype=">i2", offset=4).reshape(rows, cols, 2)
+            self.field[index, y0:y0 + rows, x0:x0 + cols] = values
+        elif reply_type == REPLY_POINTS and payload and len(payload) == 1 + 4 * payload[0]:
+            if payload[0] != len(self.points):
+                return None
+            self.field[index, self.ys, self.xs] = np.frombuffer(payload, dtype=">i2", offset=1).reshape(-1, 2)
+        else:
+            return None
+        self.received[index] = True
+        self.frames = max(self.frames, frame_count)
+        return self.field[index, ..., 0], self.field[index, ..., 1]
+
+    def read(self, ser, frame_count, trace=None):
+        if frame_count in self.config_seqs:
+            ack = self._read_reply(ser, self.config_seqs.pop(frame_count), trace)
+            if ack is None:
+                self.seqs.pop(frame_count, None)
+                return None, None
+        return super().read(ser, frame_count, trace)
+
+    def flow_field(self, pairs=None):
+        """
+        (pairs, 16, 16, 2) float32 (u, v) in pixels, NaN at points the board
+        doesn't compute and for frames without a reply. pairs defaults to the
+        last frame with a reply.
+        """
+        pairs = self.frames if pairs is None else pairs
+        field = np.full((pairs, 16, 16, 2), np.nan, dtype=np.float32)
+        count = min(pairs, self.frames)
+        field[:count] = self.field[:count] / np.float32(100)
+        field[:, ~self.valid] = np.nan
+        field[:count][~self.received[:count]] = np.nan
+        return field
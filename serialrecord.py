@@ -0,0 +1,274 @@
+import argparse
+import mmap
+import os
+import struct
+import threading
+import time
+import numpy as np
+
+# Record and replay of the serial link to the ESP32. RecordingSerial wraps the
+# port a run talks to and logs every write and every read, with when it
+# happened, to a session file; ReplaySerial plays the replies of a session back
+# to the same code without the board, as fast as the host reads them or at the
+# recorded timing. open_port(..., record=path) records and
+# open_port("replay:path") / open_port("replay-timed:path") replays, so
+#
+#   processdata("DashcamFootage.mp4", 900, record="dashcam.session")
+#   main.preprocess_video_data("DashcamFootage.mp4", port="replay:dashcam.session")
+#
+# Session file: a header, then records one after the other, each a kind, the
+# length of its data, nanoseconds since the recording started and the data.
+# Reads are recorded as they returned, a read that came back short (a timeout)
+# as RX_SHORT, and bytes thrown away by reset_input_buffer as DISCARD.
+
+MAGIC = b"OFSERIAL"
+VERSION = 1
+FILE_HEADER = struct.Struct("<8sHId")  # magic, version, baudrate, start (seconds since the epoch)
+RECORD = struct.Struct("<BIq")  # kind, length, nanoseconds since start
+
+TX = 1  # Bytes written to the board
+RX = 2  # A read that got every byte asked for
+RX_SHORT = 3  # A read that timed out with fewer bytes
+DISCARD = 4  # Bytes thrown away by reset_input_buffer
+KINDS = {TX: "tx", RX: "rx", RX_SHORT: "rx_short", DISCARD: "discard"}
+
+
+class RecordingSerial:
+    """
+    Wraps an open serial port (or EmulatedSerial) and logs the traffic to
+    path. Writes and reads may come from different threads.
+    """
+
+    def __init__(self, ser, path):
+        self.ser = ser
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(FILE_HEADER.pack(MAGIC, VERSION, int(getattr(ser, "baudrate", 0) or 0), time.time()))
+        self.start_ns = time.perf_counter_ns()
+        self.lock = threading.Lock()
+
+    def _log(self, kind, data):
+        with self.lock:
+            self.file.write(RECORD.pack(kind, len(data), time.perf_counter_ns() - self.start_ns))
+            self.file.write(data)
+
+    def __getattr__(self, name):
+        # port, baudrate, timeout, ... of the wrapped port
+        return getattr(self.ser, name)
+
+    def write(self, data):
+        data = bytes(data)
+        written = self.ser.write(data)
+        self._log(TX, data)
+        return written
+
+    def read(self, size=1):
+        data = self.ser.read(size)
+        self._log(RX if len(data) >= size else RX_SHORT, data)
+        return data
+
+    @property
+    def in_waiting(self):
+        return self.ser.in_waiting
+
+    def reset_input_buffer(self):
+        # Read what is waiting instead so the thrown away bytes are logged
+        waiting = self.ser.in_waiting
+        data = self.ser.read(waiting) if waiting else b""
+        self._log(DISCARD, data)
+
+    def close(self):
+        self.ser.close()
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
+
+
+class SessionLog:
+    """
+    A session file mapped into memory. kinds, offsets, lengths and times_ns
+    are arrays with one entry per record, data(i) is the data of record i
+    without copying.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < FILE_HEADER.size:
+            raise ValueError(f"{path} is not a session file")
+        magic, version, self.baudrate, self.start = FILE_HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} session file")
+        kinds, offsets, lengths, times = [], [], [], []
+        pos = FILE_HEADER.size
+        while pos + RECORD.size <= len(self.map):
+            kind, length, t = RECORD.unpack_from(self.map, pos)
+            if pos + RECORD.size + length > len(self.map):
+                break  # Cut off while recording
+            kinds.append(kind)
+            offsets.append(pos + RECORD.size)
+            lengths.append(length)
+            times.append(t)
+            pos += RECORD.size + length
+        self.kinds = np.array(kinds, dtype=np.uint8)
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.lengths = np.array(lengths, dtype=np.int64)
+        self.times_ns = np.array(times, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def data(self, i):
+        return memoryview(self.map)[self.offsets[i]:self.offsets[i] + self.lengths[i]]
+
+    def joined(self, kind):
+        """
+        The data of every record of kind, concatenated.
+        """
+        return b"".join(self.data(i) for i in np.flatnonzero(self.kinds == kind))
+
+    def summary(self):
+        out = {"records": len(self), "baudrate": self.baudrate,
+               "seconds": float(self.times_ns[-1]) / 1e9 if len(self) else 0.0}
+        for kind, name in KINDS.items():
+            mask = self.kinds == kind
+            out[f"{name}_records"] = int(mask.sum())
+            out[f"{name}_bytes"] = int(self.lengths[mask].sum())
+        return out
+
+    def close(self):
+        self.map.close()
+
+
+class ReplaySerial:
+    """
+    Serial port serving the reads of a recorded session. Every read gets the
+    bytes its recorded counterpart got, ending short where the recording
+    timed out, and only once as many bytes have been written as had been by
+    then, so replies never run ahead of the frames they answer. timed=True
+    also holds every read back until its recorded time. Written bytes are
+    checked against the recording, mismatched counts the ones that differ.
+    """
+
+    def __init__(self, path, timed=False, timeout=2):
+        self.log = SessionLog(path)
+        self.port = "replay:" + path
+        self.baudrate = self.log.baudrate
+        self.timeout = timeout
+        self.timed = timed
+        self.is_open = True
+        self.tx = self.log.joined(TX)
+        # Reads in order, with the bytes written before each was recorded
+        tx_before = np.cumsum(np.where(self.log.kinds == TX, self.log.lengths, 0))
+        self.reads = np.flatnonzero(self.log.kinds != TX)
+        self.tx_before = tx_before[self.reads]
+        self.cursor = 0  # Next read record
+        self.offset = 0  # Bytes of it already served
+        self.bytes_written = 0
+        self.mismatched = 0
+        self.start_ns = time.perf_counter_ns()
+        self._cond = threading.Condition()
+
+    def write(self, data):
+        data = bytes(data)
+        with self._cond:
+            expected = self.tx[self.bytes_written:self.bytes_written + len(data)]
+            if expected != data:
+                if not self.mismatched:
+                    print(f"Replay diverges from the recording at byte {self.bytes_written} written.")
+                got = np.frombuffer(data[:len(expected)], dtype=np.uint8)
+                self.mismatched += int(np.count_nonzero(got != np.frombuffer(expected, dtype=np.uint8)))
+                self.mismatched += len(data) - len(expected)
+            self.bytes_written += len(data)
+            self._cond.notify_all()
+        return len(data)
+
+    def _wait_ready(self, deadline):
+        # Wait for the writes the current read depends on, and its recorded time
+        record = self.reads[self.cursor]
+        while self.bytes_written < self.tx_before[self.cursor]:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            self._cond.wait(remaining)
+        while self.timed:
+            delay = (self.log.times_ns[record] - (time.perf_counter_ns() - self.start_ns)) / 1e9
+            if delay <= 0:
+                break
+            self._cond.wait(delay)
+        return True
+
+    def read(self, size=1):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        out = bytearray()
+        with self._cond:
+            while len(out) < size and self.cursor < len(self.reads):
+                record = self.reads[self.cursor]
+                kind = self.log.kinds[record]
+                if kind == DISCARD or not self._wait_ready(deadline):
+                    break  # These bytes weren't there to read when recorded
+                data = self.log.data(record)
+                take = min(size - len(out), len(data) - self.offset)
+                out += data[self.offset:self.offset + take]
+                self.offset += take
+                if self.offset == len(data):
+                    self.cursor += 1
+                    self.offset = 0
+                    if kind == RX_SHORT:
+                        break
+        return bytes(out)
+
+    @property
+    def in_waiting(self):
+        with self._cond:
+            if self.cursor < len(self.reads) and self.log.kinds[self.reads[self.cursor]] == DISCARD:
+                return int(self.log.lengths[self.reads[self.cursor]])
+            return 0
+
+    def reset_input_buffer(self):
+        with self._cond:
+            if self.cursor < len(self.reads) and self.log.kinds[self.reads[self.cursor]] == DISCARD:
+                self.cursor += 1
+                self.offset = 0
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.is_open:
+            self.is_open = False
+            self.log.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or replay recorded serial sessions")
+    commands = parser.add_subparsers(dest="command", required=True)
+    info = commands.add_parser("info", help="record and byte counts of a session")
+    info.add_argument("session")
+    check = commands.add_parser("check", help="rerun the ESP path against a session, warns if it sends other bytes")
+    check.add_argument("session")
+    check.add_argument("video", help="video in src/ the session was recorded on")
+    check.add_argument("--frames", type=int, default=900)
+    check.add_argument("--protocol", choices=("raw", "framed"), default="raw")
+    check.add_argument("--timed", action="store_true", help="replay at the recorded timing")
+    args = parser.parse_args()
+
+    if args.command == "info":
+        log = SessionLog(args.session)
+        for key, value in log.summary().items():
+            print(f"{key}: {value}")
+        log.close()
+        return
+
+    from preprocess import processdata
+    port = ("replay-timed:" if args.timed else "replay:") + os.fspath(args.session)
+    start = time.perf_counter()
+    vectors = processdata(args.video, args.frames, port=port, protocol=args.protocol)
+    elapsed = time.perf_counter() - start
+    answered = len(vectors.valid())
+    print(f"{answered} vectors, {len(vectors) - answered} failed, in {elapsed:.2f} s ({len(vectors) / elapsed:.0f} fps)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+import heapq
+import math
+from collections import defaultdict, deque
+import numpy as np
+
+# Incremental versions of the moving average and median filter used by
+# main.filter_data. Samples go in one at a time through update() and filtered
+# samples come out as soon as they are known, flush() returns the rest once
+# the stream ends. Fed a whole array they give the same output as the batch
+# filters, up to float rounding in the moving average.
+
+TWO_PI = 2 * np.pi
+
+
+class MovingAverage:
+    """
+    Mean of the last window_size samples in O(1) per sample, like
+    np.convolve(..., mode='valid') nothing comes out until the window is full.
+    The running sum is compensated and rebuilt from the window every
+    window_size samples so it doesn't drift on long streams.
+    """
+
+    def __init__(self, window_size):
+        self.window_size = window_size
+        self.window = deque()
+        self.total = 0.0
+        self.compensation = 0.0
+        self.count = 0
+
+    def _add(self, value):
+        # Kahan summation
+        y = value - self.compensation
+        t = self.total + y
+        self.compensation = (t - self.total) - y
+        self.total = t
+
+    def update(self, value):
+        self.window.append(value)
+        self._add(value)
+        if len(self.window) > self.window_size:
+            self._add(-self.window.popleft())
+        self.count += 1
+        if self.count % self.window_size == 0:
+            self.total = math.fsum(self.window)
+            self.compensation = 0.0
+        if len(self.window) < self.window_size:
+            return []
+        return [self.total / self.window_size]
+
+    def flush(self):
+        return []
+
+
+class CircularMovingAverage:
+    """
+    Mean direction of the last window_size angles in radians, returned in
+    [0, 2*pi). Averages unit vectors so 359 and 1 degrees average to 0.
+    """
+
+    def __init__(self, window_size):
+        self.cos = MovingAverage(window_size)
+        self.sin = MovingAverage(window_size)
+
+    def update(self, angle):
+        c = self.cos.update(math.cos(angle))
+        s = self.sin.update(math.sin(angle))
+        return [math.atan2(y, x) % TWO_PI for x, y in zip(c, s)]
+
+    def flush(self):
+        return []
+
+
+class RunningMedian:
+    """
+    Median filter matching scipy.ndimage.median_filter(size=size) with its
+    default reflect boundary. Output i needs samples up to i + (size - 1 - size // 2)
+    so it lags the input by that many samples, flush() fills in the end by
+    reflection. The window is split over two heaps, the rank + 1 smallest
+    samples in a max-heap and the rest in a min-heap, so the median is the
+    top of the first. Samples leaving the window are only marked and taken
+    off when they reach a top, O(log size) per sample.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.left = size // 2  # Samples before the centre
+        self.right = size - self.left - 1  # Samples after the centre
+        self.rank = size // 2
+        self.head = []  # First samples, until there are enough to reflect
+        self.window = deque()
+        self._reset_heaps()
+        self.primed = False
+
+    def _reset_heaps(self):
+        self.low = []  # Negated, so heapq gives the largest of the low samples
+        self.high = []
+        self.low_count = 0  # Samples in each heap still in the window
+        self.high_count = 0
+        self.removed = defaultdict(int)  # Samples marked as out of the window
+        self.stale = 0
+
+    def _prune(self, heap, sign):
+        # Take marked samples off the top
+        while heap and self.removed[sign * heap[0]]:
+            value = sign * heapq.heappop(heap)
+            self.removed[value] -= 1
+            self.stale -= 1
+
+    def _balance(self):
+        while self.low_count > self.rank + 1:
+            heapq.heappush(self.high, -heapq.heappop(self.low))
+            self.low_count -= 1
+            self.high_count += 1
+            self._prune(self.low, -1)
+        while self.low_count < self.rank + 1 and self.high_count:
+            heapq.heappush(self.low, -heapq.heappop(self.high))
+            self.high_count -= 1
+            self.low_count += 1
+            self._prune(self.high, 1)
+
+    def _remove(self, value):
+        self.removed[value] += 1
+        self.stale += 1
+        if value <= -self.low[0]:
+            self.low_count -= 1
+            self._prune(self.low, -1)
+        else:
+            self.high_count -= 1
+            self._prune(self.high, 1)
+        if self.stale > self.size:
+            # Rebuild once the marked samples outnumber the window
+            ordered = sorted(self.window)
+            self._reset_heaps()
+            self.low = [-value for value in reversed(ordered[:self.rank + 1])]
+            self.high = ordered[self.rank + 1:]
+            self.low_count, self.high_count = len(self.low), len(self.high)
+            return
+        self._balance()
+
+    def _push(self, value):
+        self.window.append(value)
+        if not self.low or value <= -self.low[0]:
+            heapq.heappush(self.low, -value)
+            self.low_count += 1
+        else:
+            heapq.heappush(self.high, value)
+            self.high_count += 1
+        self._balance()
+        if len(self.window) > self.size:
+            self._remove(self.window.popleft())
+        if len(self.window) == self.size:
+            return [-self.low[0]]
+        return []
+
+    def update(self, value):
+        if self.primed:
+            return self._push(value)
+        self.head.append(value)
+        if len(self.head) < self.size:
+            return []
+        # Sample -k reflects to sample k - 1
+        self.primed = True
+        out = []
+        for value in self.head[self.left - 1::-1] if self.left else []:
+            out += self._push(value)
+        for value in self.head:
+            out += self._push(value)
+        self.head = []
+        return out
+
+    def flush(self):
+        if not self.primed:
+            if not self.head:
+                return []
+            # Shorter than one window, reflections wrap more than once
+            from scipy.ndimage import median_filter
+            out = median_filter(np.array(self.head), size=self.size).tolist()
+            self.head = []
+            return out
+        # Sample n - 1 + k reflects to sample n - k
+        tail = list(self.window)[-self.right:] if self.right else []
+        out = []
+        for value in reversed(tail):
+            out += self._push(value)
+        self.primed = False
+        self.window.clear()
+        self._reset_heaps()
+        return out
+
+
+class Unwrap:
+    """
+    Adds multiples of 2*pi to each angle so it is within pi of the previous
+    one, like np.unwrap, so a median over angles doesn't see the wrap.
+    """
+
+    def __init__(self):
+        self.previous = None
+
+    def update(self, angle):
+        if self.previous is not None:
+            angle -= TWO_PI * round((angle - self.previous) / TWO_PI)
+        self.previous = angle
+        return [angle]
+
+    def flush(self):
+        return []
+
+
+class Wrap:
+    """
+    Maps angles back into [0, 2*pi).
+    """
+
+    def update(self, angle):
+        return [angle % TWO_PI]
+
+    def flush(self):
+        return []
+
+
+class StreamFilter:
+    """
+    Chain of stages, each taking one sample and returning the samples it can
+    pass on. The default is the moving average then median filter of
+    main.filter_data, circular=True swaps in the angle aware stages.
+    """
+
+    def __init__(self, moving_avg_window_size=5, median_filter_size=8, circular=False):
+        if circular:
+            self.stages = [CircularMovingAverage(moving_avg_window_size), Unwrap(),
+                           RunningMedian(median_filter_size), Wrap()]
+        else:
+            self.stages = [MovingAverage(moving_avg_window_size), RunningMedian(median_filter_size)]
+
+    def update(self, value):
+        samples = [value]
+        for stage in self.stages:
+            samples = [out for sample in samples for out in stage.update(sample)]
+        return samples
+
+    def flush(self):
+        # Whatever a stage flushes still goes through the stages after it
+        out = []
+        for stage in self.stages:
+            out = [o for sample in out for o in stage.update(sample)] + stage.flush()
+        return out
+
+    def __call__(self, data):
+        """
+        Filter a whole array, same output as main.filter_data.
+        """
+        out = []
+        for value in data:
+            out += self.update(float(value))
+        out += self.flush()
+        return np.array(out)
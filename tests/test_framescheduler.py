@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+from flowtrace import STATUS_OK, STATUS_SKIPPED, FlowTrace
+from framescheduler import FrameScheduler
+
+
+def _frames(values):
+    return [np.full(256, value, dtype=np.uint8) for value in values]
+
+
+@pytest.mark.parametrize("fill", ["zero", "interpolate"])
+def test_reply_after_skip_is_spread_per_frame(fill):
+    # Frames 2 and 3 match frame 1 and are skipped, the reply for frame 4 is
+    # the flow over frames 1 to 4
+    scheduler = FrameScheduler(skip_threshold=1.0, fill=fill)
+    sent = list(scheduler.schedule(_frames([0, 50, 50, 50, 100, 150])))
+    assert len(sent) == 4
+    assert scheduler.sent == [0, 1, 4, 5] and scheduler.skipped == [2, 3]
+
+    # Replies by sent index, as process_frames maps them to source frames
+    replies = {1: (1.0, -0.5), 2: (3.0, -1.5), 3: (1.0, -0.5)}
+    trace = FlowTrace()
+    for index, (u, v) in replies.items():
+        trace.append(scheduler.source_frame(index), u, v)
+    filled = scheduler.fill(trace)
+
+    np.testing.assert_array_equal(filled.frame, [1, 2, 3, 4, 5])
+    np.testing.assert_allclose(filled.u, 1.0)
+    np.testing.assert_allclose(filled.v, -0.5)
+    np.testing.assert_array_equal(filled.status, [STATUS_OK, STATUS_SKIPPED, STATUS_SKIPPED, STATUS_OK, STATUS_OK])
+    assert len(filled.valid()) == 3
+
+
+def test_trailing_skips_use_fill():
+    scheduler = FrameScheduler(skip_threshold=1.0, fill="zero")
+    list(scheduler.schedule(_frames([0, 50, 50, 50])))
+    trace = FlowTrace()
+    trace.append(scheduler.source_frame(1), 2.0, 1.0)
+    filled = scheduler.fill(trace)
+    np.testing.assert_allclose(filled.u, [2.0, 0.0, 0.0])
+    np.testing.assert_allclose(filled.v, [1.0, 0.0, 0.0])
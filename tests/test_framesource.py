@@ -0,0 +1,50 @@
+import threading
+import numpy as np
+import pytest
+from framesource import run_consumers
+
+
+def _frames(count=2000):
+    for i in range(count):
+        yield np.full((16, 16), i % 256, dtype=np.uint8)
+
+
+def _count(frames):
+    return sum(1 for _ in frames)
+
+
+def _fail_before_reading(frames):
+    raise OSError("could not open port")
+
+
+def _fail_after_reading(frames):
+    for i, _ in enumerate(frames):
+        if i == 10:
+            raise OSError("link lost")
+
+
+def _run(consumers):
+    # run_consumers used to wait forever on a consumer that stopped early
+    outcome = {}
+
+    def target():
+        try:
+            outcome["result"] = run_consumers(_frames(), consumers, mode="process")
+        except Exception as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout=60)
+    assert not thread.is_alive(), "run_consumers hung"
+    return outcome
+
+
+@pytest.mark.parametrize("failing", [_fail_before_reading, _fail_after_reading])
+def test_process_consumer_error_is_raised(failing):
+    outcome = _run([failing, _count])
+    assert isinstance(outcome.get("error"), OSError)
+
+
+def test_process_consumers_see_every_frame():
+    assert _run([_count, _count])["result"] == [2000, 2000]
@@ -0,0 +1,43 @@
+import os
+import pytest
+import main
+import preprocess
+from flowcache import FlowCache
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def link_calls(monkeypatch):
+    # Records what open_port and stream_flow_vectors are called with
+    calls = {"open_port": [], "stream": []}
+    open_port, stream_flow_vectors = preprocess.open_port, preprocess.stream_flow_vectors
+
+    def recording_open_port(port, baudrate=500000, timeout=2, protocol='raw', record=None):
+        calls["open_port"].append(protocol)
+        return open_port(port, baudrate, timeout, protocol, record)
+
+    def recording_stream(ser, frames, window=2, quiet_time=0.05, trace=None, link=None):
+        calls["stream"].append((window, type(link).__name__))
+        return stream_flow_vectors(ser, frames, window, quiet_time, trace, link)
+
+    monkeypatch.setattr(preprocess, "open_port", recording_open_port)
+    monkeypatch.setattr(preprocess, "stream_flow_vectors", recording_stream)
+    monkeypatch.chdir(ROOT)
+    return calls
+
+
+def test_run_passes_window_and_protocol_to_the_link(link_calls):
+    main.main(["run", "--video", "DashcamFootage.mp4", "--frames", "30", "--port", "emu", "--protocol", "framed",
+               "--window", "4", "--plots", "none", "--no-cache"])
+    assert link_calls["open_port"] == ["framed"]
+    assert link_calls["stream"] == [(4, "FramedLink")]
+
+
+def test_cached_frames_keep_window_and_protocol(link_calls, tmp_path):
+    cache = FlowCache(str(tmp_path))
+    for _ in range(2):  # The second run sends the cached frames
+        main.preprocess_video_data("DashcamFootage.mp4", max_frames=30, port="emu", cache=cache, window=3,
+                                   protocol="framed")
+    assert link_calls["open_port"] == ["framed", "framed"]
+    assert link_calls["stream"] == [(3, "FramedLink"), (3, "FramedLink")]
@@ -0,0 +1,59 @@
+import time
+import cv2 as cv
+import overlay
+from overlay import OverlayWriter
+
+
+class SlowVideoWriter:
+    # Stands in for cv.VideoWriter, slower than frames are handed to it
+    def __init__(self, *args):
+        self.frames = 0
+
+    def isOpened(self):
+        return True
+
+    def write(self, frame):
+        time.sleep(0.002)
+        self.frames += 1
+
+    def release(self):
+        pass
+
+
+def _write(writer, frames=40):
+    for _ in range(frames):
+        buffer = writer.acquire((16, 16, 3))
+        if buffer is not None:
+            writer.submit(buffer)
+    encoder = writer.writer
+    writer.close()
+    return encoder.frames
+
+
+def test_overlay_keeps_every_frame(monkeypatch):
+    monkeypatch.setattr(overlay.cv, "VideoWriter", SlowVideoWriter)
+    writer = OverlayWriter("overlay.mp4", buffers=1)
+    assert _write(writer) == 40
+    assert writer.dropped == 0
+
+
+def test_overlay_drops_frames_for_live_feeds(monkeypatch):
+    monkeypatch.setattr(overlay.cv, "VideoWriter", SlowVideoWriter)
+    writer = OverlayWriter("overlay.mp4", buffers=1, drop=True)
+    written = _write(writer)
+    assert writer.dropped > 0
+    assert written + writer.dropped == 40
+
+
+def test_overlay_video_has_every_frame(tmp_path):
+    path = str(tmp_path / "overlay.mp4")
+    with OverlayWriter(path, buffers=1) as writer:
+        for i in range(30):
+            buffer = writer.acquire((64, 64, 3))
+            buffer[:] = i
+            writer.submit(buffer)
+    capture = cv.VideoCapture(path)
+    count = 0
+    while capture.read()[0]:
+        count += 1
+    assert count == 30
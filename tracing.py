@@ -0,0 +1,248 @@
+import argparse
+import os
+import threading
+import time
+import numpy as np
+
+# Per-frame timing of the ESP32 round trip. A LinkTrace passed to
+# preprocess.stream_flow_vectors (or process_frames/processdata) stamps every
+# frame when it is decoded, when it starts and finishes going out on the
+# serial port and when its reply has been read, counts timeouts, short reads
+# and resyncs, and keeps latency histograms as replies come in. Stamping is a
+# clock read and an array store, nothing is formatted until export.
+#
+# The stages tell a slow link from a slow board: "tx" is writing the frame,
+# "rx" from the end of the write to the end of the reply, which is the board's
+# compute plus the reply on the wire plus any frames queued ahead in the window,
+# "queue" is how long a decoded frame waited for a free place in the window.
+
+DECODE, TX_START, TX_COMPLETE, RX_COMPLETE = range(4)
+EVENTS = ("decode", "tx_start", "tx_complete", "rx_complete")
+STAGES = {
+    "queue": (DECODE, TX_START),
+    "tx": (TX_START, TX_COMPLETE),
+    "rx": (TX_COMPLETE, RX_COMPLETE),
+    "total": (DECODE, RX_COMPLETE),
+}
+COUNTERS = ("frames_sent", "tx_bytes", "replies", "timeouts", "short_reads", "bad_replies", "crc_errors",
+            "resyncs", "lost_frames")
+CHUNK_BITS = 12
+
+
+class LatencyHistogram:
+    """
+    Log-linear histogram of durations in nanoseconds like HdrHistogram:
+    exact below 2**sub_bits units, above that every power of two is split in
+    2**(sub_bits - 1) buckets, so any value is kept to within
+    2**-(sub_bits - 1) of itself (1.6% with the default) in a few KiB.
+    """
+
+    def __init__(self, unit_ns=1000, highest_ns=60 * 10 ** 9, sub_bits=7):
+        self.unit_ns = unit_ns
+        self.sub_bits = sub_bits
+        self.half = 1 << (sub_bits - 1)
+        self.counts = [0] * (self._index(highest_ns // unit_ns) + 1)
+        self.count = 0
+        self.total_ns = 0
+        self.min_ns = None
+        self.max_ns = None
+
+    def _index(self, units):
+        if units < 2 * self.half:
+            return units
+        shift = units.bit_length() - self.sub_bits
+        return 2 * self.half + (shift - 1) * self.half + (units >> shift) - self.half
+
+    def _bounds(self, index):
+        """
+        [low, high) of bucket index in nanoseconds.
+        """
+        if index < 2 * self.half:
+            return index * self.unit_ns, (index + 1) * self.unit_ns
+        shift, mantissa = divmod(index - 2 * self.half, self.half)
+        shift += 1
+        low = (mantissa + self.half) << shift
+        return low * self.unit_ns, (low + (1 << shift)) * self.unit_ns
+
+    def record(self, value_ns):
+        value_ns = max(int(value_ns), 0)
+        self.counts[min(self._index(value_ns // self.unit_ns), len(self.counts) - 1)] += 1
+        self.count += 1
+        self.total_ns += value_ns
+        if self.min_ns is None or value_ns < self.min_ns:
+            self.min_ns = value_ns
+        if self.max_ns is None or value_ns > self.max_ns:
+            self.max_ns = value_ns
+
+    def percentile(self, q):
+        """
+        Duration in nanoseconds below which q percent of the values fall, the
+        middle of the bucket it lands in. None when empty.
+        """
+        if not self.count:
+            return None
+        target = max(int(np.ceil(q / 100.0 * self.count)), 1)
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                low, high = self._bounds(index)
+                return min(max((low + high) // 2, self.min_ns), self.max_ns)
+        return self.max_ns
+
+    def cumulative(self, bounds_ns):
+        """
+        Number of values <= each of bounds_ns, to bucket boundary accuracy.
+        """
+        out = []
+        seen = 0
+        index = 0
+        for bound in bounds_ns:
+            while index < len(self.counts) and self._bounds(index)[1] <= bound:
+                seen += self.counts[index]
+                index += 1
+            out.append(seen)
+        return out
+
+
+class LinkTrace:
+    """
+    Timestamps and counters for one run. Frames are numbered like
+    stream_flow_vectors numbers them, from 0. Timestamps are
+    time.perf_counter_ns() values, stored in fixed size chunks that are never
+    moved so the sender and reader threads can stamp without a lock.
+    """
+
+    def __init__(self):
+        self.start_ns = time.perf_counter_ns()
+        self.chunks = []
+        self.frames = 0
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.histograms = {stage: LatencyHistogram() for stage in STAGES}
+        self.grow_lock = threading.Lock()
+
+    def _row(self, frame):
+        chunk = frame >> CHUNK_BITS
+        if chunk >= len(self.chunks):
+            with self.grow_lock:
+                while chunk >= len(self.chunks):
+                    self.chunks.append(np.zeros((1 << CHUNK_BITS, len(EVENTS)), dtype=np.int64))
+        return self.chunks[chunk][frame & ((1 << CHUNK_BITS) - 1)]
+
+    def stamp(self, frame, event, ns=None):
+        self._row(frame)[event] = time.perf_counter_ns() if ns is None else ns
+        if frame >= self.frames:
+            self.frames = frame + 1
+
+    def count(self, counter, n=1):
+        self.counters[counter] += n
+
+    def decoded(self, frames):
+        """
+        Pass frames through, stamping each as decoded when the source hands
+        it over. Frames already stamped further up the pipeline keep their
+        first stamp.
+        """
+        for frame_count, frame in enumerate(frames):
+            if not self._row(frame_count)[DECODE]:
+                self.stamp(frame_count, DECODE)
+            yield frame
+
+    def received(self, frame):
+        """
+        Stamp the reply for frame and add its latencies to the histograms.
+        """
+        self.stamp(frame, RX_COMPLETE)
+        self.count("replies")
+        row = self._row(frame)
+        for stage, (first, last) in STAGES.items():
+            if row[first] and row[last]:
+                self.histograms[stage].record(row[last] - row[first])
+
+    def timestamps(self):
+        """
+        (frames, 4) array of seconds since the trace started, NaN where an
+        event never happened.
+        """
+        if not self.frames:
+            return np.empty((0, len(EVENTS)))
+        rows = np.concatenate(self.chunks)[:self.frames]
+        return np.where(rows > 0, (rows - self.start_ns) / 1e9, np.nan)
+
+    def summary(self):
+        out = dict(self.counters)
+        for stage, histogram in self.histograms.items():
+            for q in (50, 99):
+                value = histogram.percentile(q)
+                out[f"{stage}_p{q}_ms"] = None if value is None else value / 1e6
+        return out
+
+    def write_csv(self, path):
+        times = self.timestamps()
+        with open(path, "w") as f:
+            f.write("frame," + ",".join(EVENTS) + "\n")
+            for frame, row in enumerate(times):
+                f.write(f"{frame}," + ",".join("" if np.isnan(t) else f"{t:.9f}" for t in row) + "\n")
+
+    def write_prometheus(self, path, prefix="opticalflow", bounds_s=None):
+        """
+        Snapshot of the counters and histograms in the Prometheus text format,
+        written to a temporary file and moved into place so a node_exporter
+        textfile collector never reads half a file.
+        """
+        if bounds_s is None:
+            bounds_s = [1e-4 * 2 ** i for i in range(17)]  # 0.1 ms to 6.5 s
+        lines = []
+        for counter in COUNTERS:
+            name = f"{prefix}_link_{counter}_total"
+            lines += [f"# TYPE {name} counter", f"{name} {self.counters[counter]}"]
+
+        name = f"{prefix}_frame_latency_seconds"
+        lines.append(f"# HELP {name} Time between per-frame events of the ESP32 round trip")
+        lines.append(f"# TYPE {name} histogram")
+        for stage, histogram in self.histograms.items():
+            cumulative = histogram.cumulative([int(b * 1e9) for b in bounds_s])
+            for bound, n in zip(bounds_s, cumulative):
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bound:g}"}} {n}')
+            lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.total_ns / 1e9:.9f}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+
+        name = f"{prefix}_frame_latency_quantile_seconds"
+        lines.append(f"# TYPE {name} gauge")
+        for stage, histogram in self.histograms.items():
+            for q in (0.5, 0.9, 0.99, 0.999):
+                value = histogram.percentile(q * 100)
+                if value is not None:
+                    lines.append(f'{name}{{stage="{stage}",quantile="{q}"}} {value / 1e9:.9f}')
+
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, path)
+
+
+def main():
+    from preprocess import processdata
+    parser = argparse.ArgumentParser(description="Trace the ESP32 round trip for a video")
+    parser.add_argument("video", help="video in src/")
+    parser.add_argument("--frames", type=int, default=900)
+    parser.add_argument("--port", default="COM5")
+    parser.add_argument("--baudrate", type=int, default=500000)
+    parser.add_argument("--window", type=int, default=2)
+    parser.add_argument("--csv", help="per-frame timestamps")
+    parser.add_argument("--prometheus", help="metrics snapshot")
+    args = parser.parse_args()
+
+    trace = LinkTrace()
+    processdata(args.video, args.frames, args.window, args.port, args.baudrate, trace=trace)
+    for key, value in trace.summary().items():
+        print(f"{key}: {'-' if value is None else value}")
+    if args.csv:
+        trace.write_csv(args.csv)
+    if args.prometheus:
+        trace.write_prometheus(args.prometheus)
+
+
+if __name__ == "__main__":
+    main()